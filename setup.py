@@ -17,6 +17,7 @@ requires = [
     'pyramid_chameleon',
     'pyramid_debugtoolbar',
     'pyramid_mailer',
+    'pyramid_retry',
     'pyramid_tm',
     'pyramid_zodbconn',
     'repoze.folder',
@@ -25,6 +26,13 @@ requires = [
     'waitress',
     ]
 
+extras_require = {
+    'asgi': ['uvicorn'],
+    'relstorage': ['RelStorage>=3.0'],
+    'signature': ['cryptography'],
+    'zeo': ['ZEO>=5'],
+    }
+
 setup(name='travis_notify',
       version='0.1.dev0',
       description='travis_notify',
@@ -45,6 +53,7 @@ setup(name='travis_notify',
       include_package_data=True,
       zip_safe=False,
       install_requires=requires,
+      extras_require=extras_require,
       tests_require=requires,
       test_suite="travis_notify",
       entry_points="""\
@@ -52,5 +61,15 @@ setup(name='travis_notify',
       main = travis_notify:main
       [paste.filter_app_factory]
       translogger = travis_notify.translogger:make_filter
+      profiler = travis_notify.profiler:make_filter
+      [console_scripts]
+      travis_notify_mailq = travis_notify.mailqueue:main
+      travis_notify_export = travis_notify.export:main
+      travis_notify_migrate = travis_notify.migrate:main
+      travis_notify_bench = travis_notify.benchmark:main
+      travis_notify_load = travis_notify.bulkload:main
+      travis_notify_compact = travis_notify.retention:main
+      travis_notify_serve = travis_notify.prefork:main
+      travis_notify_ingest = travis_notify.ingest:main
       """,
       )
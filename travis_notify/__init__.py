@@ -1,20 +1,75 @@
+import logging
+import time
+
 from pyramid.config import Configurator
 from pyramid_zodbconn import get_connection
-from .models import appmaker
+import transaction
+from .models import configure_history
+from .startup import startup
+
+logger = logging.getLogger('travis_notify.startup')
+
+READ_METHODS = ('GET', 'HEAD')
+READ_ONLY = 'travis_notify.read_only'
+
+
+def tm_activate_hook(request):
+    """ ``tm.activate_hook``:  run GET / HEAD requests outside of any
+    transaction, on a read-only connection (see :func:`root_factory`).
+    """
+    if request.method in READ_METHODS:
+        request.environ[READ_ONLY] = True
+        return False
+    return True
+
+
+def get_read_connection(request):
+    """ Return a connection for reading, in a private transaction manager.
+
+    It comes from the database named by ``travis_notify.read_only_db``
+    (e.g., ``readonly`` for ``zodbconn.uri.readonly = zeo://...?read_only=1``)
+    if set, else from the primary database;  nothing ever commits it.
+    """
+    conn = getattr(request, '_read_zodb_conn', None)
+    if conn is None:
+        registry = request.registry
+        name = registry.settings.get('travis_notify.read_only_db', '')
+        db = registry._zodb_databases[name]
+        conn = db.open(transaction_manager=transaction.TransactionManager())
+
+        def finished(request):
+            conn.transaction_manager.abort()
+            conn.close()
+
+        request.add_finished_callback(finished)
+        request._read_zodb_conn = conn
+    return conn
 
 
 def root_factory(request):
-    conn = get_connection(request)
-    return appmaker(conn.root())
+    if request.environ.get(READ_ONLY):
+        conn = get_read_connection(request)
+    else:
+        conn = get_connection(request)
+    return conn.root()['app_root']
 
 
 def main(global_config, config=None, **settings):
     """ This function returns a Pyramid WSGI application.
     """
+    start = time.perf_counter()
     if config is None:  # pragma: no cover
         config = Configurator(root_factory=root_factory, settings=settings)
+    settings = config.registry.settings
+    settings.setdefault('tm.activate_hook', tm_activate_hook)
+    configure_history(settings)
+    startup(config.registry)
     config.include('pyramid_chameleon')
     config.add_static_view('static', 'static', cache_max_age=3600)
+    config.include('.pagecache')
+    config.include('.metrics')
     config.include('.views')
     config.scan()
-    return config.make_wsgi_app()
+    app = config.make_wsgi_app()
+    logger.info('Started in %.2fs', time.perf_counter() - start)
+    return app
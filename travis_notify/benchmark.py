@@ -0,0 +1,337 @@
+""" Benchmark harness for the webhook ingest path.
+
+Drives the WSGI app built by :func:`travis_notify.main` (with
+``pyramid_retry``, ``pyramid_tm``, ``pyramid_zodbconn`` and
+``pyramid_mailer.testing``'s dummy mailer) with synthetic, correctly signed
+Travis notifications, and reports throughput and p50 / p99 latency for each
+combination of payload size (jobs in the build matrix), repo count and
+concurrency, on a choice of storages.
+
+With ``--group-commit``, concurrent webhooks are committed together (see
+``.groupcommit``).
+
+With ``--signature``, requests carry a ``Signature`` header (verified
+against a throwaway key pair) instead of the token, and the per-request
+cost of verification is reported on its own.
+
+Run ``travis_notify_bench --help`` for options.
+"""
+import argparse
+from hashlib import sha256
+from json import dumps
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from pyramid.config import Configurator
+from webob import Request
+
+TOKEN = 'BENCHMARK'
+
+
+def make_app(storage_uri='memory://', **settings):
+    """Return the travis_notify WSGI app, configured for benchmarking.
+    """
+    from . import main
+    from . import root_factory
+    base = {
+        'pyramid.includes': '\n'.join(['pyramid_retry',
+                                       'pyramid_tm',
+                                       'pyramid_zodbconn',
+                                       'pyramid_mailer.testing',
+                                      ]),
+        'zodbconn.uri': storage_uri,
+        'retry.attempts': '3',
+        'travis_notify.token': TOKEN,
+        'travis_notify.recipients': 'bench@example.com',
+    }
+    base.update(settings)
+    config = Configurator(root_factory=root_factory, settings=base,
+                          package='travis_notify')
+    return main({}, config, **base)
+
+
+def close_app(app):
+    """Stop ``app``'s group committer, if any, and close its databases.
+    """
+    committer = getattr(app.registry, '_travis_notify_committer', None)
+    if committer is not None:
+        committer.stop()
+    for db in app.registry._zodb_databases.values():
+        db.close()
+
+
+def make_payload(number, jobs=1, owner='owner', repo='repo'):
+    """Return a synthetic Travis payload with ``jobs`` matrix entries.
+    """
+    return {
+        'id': number,
+        'number': str(number),
+        'type': 'push',
+        'status': 0 if number % 5 else 1,  # every fifth build fails
+        'status_message': 'Passed' if number % 5 else 'Failed',
+        'branch': 'master',
+        'commit': '%040x' % number,
+        'compare_url': 'https://github.com/%s/%s/compare/a...b' % (owner,
+                                                                   repo),
+        'build_url': 'https://travis-ci.org/%s/%s/builds/%d' % (owner, repo,
+                                                                number),
+        'committer_name': 'J. Random Hacker',
+        'committer_email': 'jrandom@example.com',
+        'message': 'Commit message for build %d' % number,
+        'repository': {'name': repo, 'owner_name': owner},
+        'matrix': [{'id': number * 1000 + job,
+                    'number': '%d.%d' % (number, job),
+                    'config': {'language': 'python',
+                               'python': '3.%d' % (job % 10),
+                               'script': ['tox'],
+                              },
+                    'status': 0,
+                   } for job in range(jobs)],
+    }
+
+
+def make_request(slug, payload, token=TOKEN, private_key=None):
+    """Return a signed webhook request for ``payload``.
+
+    If ``private_key`` is passed, sign the payload with it (as Travis does)
+    rather than sending the token-based ``Authorization`` header.
+    """
+    body = dumps(payload)
+    request = Request.blank('/', method='POST', POST={'payload': body})
+    request.headers['Travis-Repo-Slug'] = slug
+    if private_key is not None:
+        request.headers['Signature'] = sign(private_key, body)
+    else:
+        request.headers['Authorization'] = sha256(
+            (slug + token).encode('utf-8')).hexdigest()
+    return request
+
+
+def make_key_pair(directory):
+    """Generate an RSA key pair;  write the public key to ``directory``.
+
+    Return ``(private_key, public_key_path)``.
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    private_key = rsa.generate_private_key(public_exponent=65537,
+                                           key_size=2048)
+    path = os.path.join(directory, 'travis.pem')
+    with open(path, 'wb') as f:
+        f.write(private_key.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo))
+    return private_key, path
+
+
+def sign(private_key, body):
+    from base64 import b64encode
+    from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+    from cryptography.hazmat.primitives.hashes import SHA1
+    signature = private_key.sign(body.encode('utf-8'), PKCS1v15(), SHA1())
+    return b64encode(signature).decode('ascii')
+
+
+def verify_cost(private_key, jobs, rounds=1000):
+    """Return the mean time (seconds) to verify one signed payload.
+    """
+    from .signature import verify_signature
+    public_key = private_key.public_key()
+    body = dumps(make_payload(1, jobs))
+    signature = sign(private_key, body)
+    start = time.perf_counter()
+    for i in range(rounds):
+        verify_signature(public_key, body, signature)
+    return (time.perf_counter() - start) / rounds
+
+
+STORAGES = ('memory', 'file', 'zeo', 'sqlite')
+
+
+def make_storage(kind, concurrency=1):
+    """Create an empty storage of ``kind``;  return ``(uri, cleanup)``.
+
+    - ``memory``:  MappingStorage (which resolves no conflicts, so suits
+      one thread only).
+    - ``file``:  FileStorage in a temporary directory.
+    - ``zeo``:  ZEO client of an in-process server for such a FileStorage.
+    - ``sqlite``:  RelStorage on SQLite (requires ``RelStorage``).
+
+    The connection pool is sized for ``concurrency`` threads.
+    """
+    tmpdir = tempfile.mkdtemp()
+    stop = None
+    path = os.path.join(tmpdir, 'Data.fs')
+    if kind == 'memory':
+        uri = 'memory://?'
+    elif kind == 'file':
+        uri = 'file://%s?' % path
+    elif kind == 'zeo':
+        import ZEO
+        (host, port), stop = ZEO.server(path)
+        uri = 'zeo://%s:%d?cache_size=64MB&' % (host, port)
+    elif kind == 'sqlite':
+        uri = 'sqlite://?data_dir=%s&cache_local_mb=64&' % tmpdir
+    else:
+        raise ValueError(kind)
+    uri += 'connection_pool_size=%d' % max(concurrency + 1, 7)  # + committer
+
+    def cleanup():
+        if stop is not None:
+            stop()
+        shutil.rmtree(tmpdir)
+
+    return uri, cleanup
+
+
+def percentile(values, pct):
+    """Return the ``pct`` percentile of ``values`` (nearest rank).
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def run(app, requests, concurrency=1):
+    """Send ``requests`` through ``app`` from ``concurrency`` threads.
+
+    Return ``(elapsed, latencies, errors)``;  ``errors`` lists the status
+    (or exception class name) of each failed request.
+    """
+    pending = list(reversed(requests))
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                request = pending.pop()
+            start = time.perf_counter()
+            try:
+                status = request.get_response(app).status
+            except Exception as e:  # e.g., unretried ConflictError
+                status = e.__class__.__name__
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if status != '200 OK':
+                    errors.append(status)
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, errors
+
+
+def bench(app, count, jobs, repos, concurrency, private_key=None):
+    """Run one benchmark configuration;  return a result mapping.
+    """
+    requests = []
+    for number in range(count):
+        repo = 'repo%d' % (number % repos)
+        payload = make_payload(number, jobs, repo=repo)
+        requests.append(make_request('owner/%s' % repo, payload,
+                                     private_key=private_key))
+    elapsed, latencies, errors = run(app, requests, concurrency)
+    return {
+        'jobs': jobs,
+        'repos': repos,
+        'concurrency': concurrency,
+        'requests': count,
+        'errors': len(errors),
+        'throughput': count / elapsed,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+    }
+
+
+HEADER = '%6s %6s %6s %8s %7s %10s %9s %9s' % (
+    'jobs', 'repos', 'conc', 'requests', 'errors', 'req/s', 'p50 ms',
+    'p99 ms')
+
+
+def format_result(result):
+    return '%6d %6d %6d %8d %7d %10.1f %9.2f %9.2f' % (
+        result['jobs'], result['repos'], result['concurrency'],
+        result['requests'], result['errors'], result['throughput'],
+        result['p50'] * 1000, result['p99'] * 1000)
+
+
+def _int_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+def main(argv=sys.argv, out=sys.stdout):
+    parser = argparse.ArgumentParser(
+        description='Benchmark travis_notify webhook ingestion.')
+    parser.add_argument('--storage', choices=STORAGES, default='file',
+                        help='A temporary FileStorage (default), ZEO server '
+                             'or SQLite RelStorage, or MappingStorage '
+                             '(concurrency 1 only).')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='Requests per configuration.')
+    parser.add_argument('--jobs', type=_int_list, default=[1, 10, 50],
+                        help='Comma-separated build matrix sizes.')
+    parser.add_argument('--repos', type=_int_list, default=[1, 10, 100],
+                        help='Comma-separated repo counts.')
+    parser.add_argument('--concurrency', type=_int_list, default=[1, 4, 16],
+                        help='Comma-separated client thread counts.')
+    parser.add_argument('--signature', action='store_true',
+                        help='Sign requests instead of using the token '
+                             '(requires "cryptography").')
+    parser.add_argument('--group-commit', type=int, default=None,
+                        metavar='DELAY',
+                        help='Commit concurrent webhooks together, waiting '
+                             'up to DELAY ms for each batch.')
+    args = parser.parse_args(argv[1:])
+    if args.storage == 'memory' and max(args.concurrency) > 1:
+        # MappingStorage resolves no conflicts:  concurrent requests fail.
+        parser.error('--storage memory requires --concurrency 1')
+
+    settings = {}
+    if args.group_commit is not None:
+        settings['travis_notify.group_commit'] = 'true'
+        settings['travis_notify.group_commit_delay'] = str(args.group_commit)
+    private_key = None
+    keydir = None
+    if args.signature:
+        keydir = tempfile.mkdtemp()
+        private_key, key_file = make_key_pair(keydir)
+        settings['travis_notify.signature'] = 'true'
+        settings['travis_notify.signature_key_file'] = key_file
+        # Read at start-up, so that no request waits for the first load.
+        settings['travis_notify.signature_key_cache'] = key_file
+        for jobs in args.jobs:
+            out.write('signature verify (%d jobs): %.1f us\n' % (
+                jobs, verify_cost(private_key, jobs) * 1000000))
+
+    out.write(HEADER + '\n')
+    for jobs in args.jobs:
+        for repos in args.repos:
+            for concurrency in args.concurrency:
+                uri, cleanup = make_storage(args.storage, concurrency)
+                try:
+                    app = make_app(uri, **settings)
+                    try:
+                        result = bench(app, args.requests, jobs, repos,
+                                       concurrency, private_key)
+                    finally:
+                        close_app(app)
+                finally:
+                    cleanup()
+                out.write(format_result(result) + '\n')
+                out.flush()
+    if keydir is not None:
+        shutil.rmtree(keydir)
@@ -0,0 +1,156 @@
+""" Bulk-load owners, repos and historical payloads from NDJSON.
+
+Each line of the input is a JSON object, either:
+
+- ``{"owner": "zopefoundation", "repo": "zope.interface"}``, creating the
+  repo (and its owner) if needed;  an optional ``"payload"`` member holds
+  a Travis payload to push onto its history;  or
+
+- a Travis payload, as exported by ``travis_notify_export``, whose
+  ``repository`` names its owner and repo.
+
+Each repo's payloads are pushed in file order, so history should be listed
+oldest first (e.g., reverse an export with ``tac``).
+"""
+import argparse
+import itertools
+from json import loads
+import logging
+import sys
+import time
+
+import transaction
+
+from .dedupe import delivery_key
+from .models import BuildRecord
+
+logger = logging.getLogger('travis_notify.bulkload')
+
+
+def iter_records(lines):
+    """Yield ``(owner_name, repo_name, payload_or_None)`` for each line.
+    """
+    for lineno, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            info = loads(line)
+        except ValueError as e:
+            raise ValueError('Line %d: %s' % (lineno, e))
+        if 'repository' in info:
+            repository = info['repository']
+            yield repository['owner_name'], repository['name'], info
+        elif 'owner' in info and 'repo' in info:
+            yield info['owner'], info['repo'], info.get('payload')
+        else:
+            raise ValueError('Line %d: no owner / repo' % lineno)
+
+
+def bulk_load(root, records, keep_raw=False, chunk_size=5000,
+              savepoint_size=500, commit=None, savepoint=None, report=None):
+    """Create the repos and push the payloads in ``records`` under ``root``.
+
+    ``records`` yields ``(owner_name, repo_name, payload_or_None)``.  They
+    are applied in chunks of ``chunk_size`` payloads, grouped by repo (in
+    file order within each repo), so that each chunk loads and writes each
+    repo's objects once.  ``savepoint`` is called after every
+    ``savepoint_size`` payloads (to bound memory within a transaction),
+    ``commit`` after each chunk, and ``report``, if passed, after each
+    commit with ``(repos, items)`` counted so far.  Return ``(repos, items)``.
+    """
+    totals = [0, 0]
+    chunk = []
+    payloads = 0
+    for record in records:
+        chunk.append(record)
+        if record[2] is not None:
+            payloads += 1
+            if payloads == chunk_size:
+                _load_chunk(root, chunk, keep_raw, savepoint_size, savepoint,
+                            totals)
+                _commit(commit, report, totals)
+                chunk = []
+                payloads = 0
+    if chunk:
+        _load_chunk(root, chunk, keep_raw, savepoint_size, savepoint, totals)
+    _commit(commit, report, totals)
+    return tuple(totals)
+
+
+def _load_chunk(root, chunk, keep_raw, savepoint_size, savepoint, totals):
+    chunk.sort(key=lambda x: (x[0], x[1]))  # stable:  keeps per-repo order
+    pushed = 0
+    for (owner_name, repo_name), group in itertools.groupby(
+            chunk, lambda x: (x[0], x[1])):
+        owner = root.find_create(owner_name)
+        if repo_name not in owner:
+            totals[0] += 1
+        repo = owner.find_create(repo_name)
+        for owner_name, repo_name, payload in group:
+            if payload is None:
+                continue
+            repo.pushItem(BuildRecord.fromPayload(payload, keep_raw),
+                          delivery_key(payload))
+            totals[1] += 1
+            pushed += 1
+            if savepoint is not None and pushed % savepoint_size == 0:
+                savepoint()
+
+
+def _commit(commit, report, totals):
+    if commit is not None:
+        commit()
+        if report is not None:
+            report(*totals)
+
+
+def main(argv=sys.argv, out=sys.stdout):  # pragma: no cover
+    """Console script:  load NDJSON files (or stdin) into the database.
+    """
+    from pyramid.paster import bootstrap
+    from pyramid.paster import setup_logging
+    parser = argparse.ArgumentParser(
+        description='Bulk-load repos and build history from NDJSON.')
+    parser.add_argument('config_uri')
+    parser.add_argument('files', nargs='*',
+                        help='NDJSON files (default stdin)')
+    parser.add_argument('--chunk-size', type=int, default=5000,
+                        help='Payloads per transaction.')
+    parser.add_argument('--savepoint-size', type=int, default=500,
+                        help='Payloads per savepoint.')
+    parser.add_argument('--keep-raw', action='store_true',
+                        help='Keep each full payload, compressed.')
+    args = parser.parse_args(argv[1:])
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+    start = time.perf_counter()
+
+    def report(repos, items):
+        elapsed = time.perf_counter() - start
+        out.write('%d repos, %d items in %.1fs (%.1f items/s)\n' % (
+            repos, items, elapsed, items / (elapsed or 1)))
+        out.flush()
+
+    def records():
+        if not args.files:
+            for record in iter_records(sys.stdin):
+                yield record
+        for path in args.files:
+            with open(path, 'rb') as f:
+                for record in iter_records(f):
+                    yield record
+
+    try:
+        bulk_load(env['root'], records(), args.keep_raw,
+                  args.chunk_size, args.savepoint_size,
+                  commit=transaction.commit,
+                  savepoint=lambda: transaction.savepoint(True),
+                  report=report)
+    except BaseException:
+        transaction.abort()
+        raise
+    finally:
+        env['closer']()
@@ -0,0 +1,75 @@
+""" Detect webhook notifications which Travis redelivers.
+
+Travis retries a notification when the webhook times out, so the same
+build / job / status may arrive several times.  Each delivery is identified
+by :func:`delivery_key`;  ``Repo`` keeps a bounded ``DeliveryLog`` of the
+keys it has stored, and :class:`RecentDeliveries` remembers the keys
+committed by this process, so that most duplicates are dropped without even
+loading the repo.
+"""
+from collections import OrderedDict
+from hashlib import md5
+import threading
+
+import transaction
+
+
+def delivery_key(payload):
+    """Return a key identifying ``payload``'s build, jobs and status.
+    """
+    jobs = ','.join(str(job.get('id'))
+                    for job in payload.get('matrix') or ())
+    return '%s:%s:%s:%s' % (payload.get('id'),
+                            md5(jobs.encode('utf-8')).hexdigest()[:16],
+                            payload.get('status'),
+                            payload.get('status_message'),
+                           )
+
+
+class RecentDeliveries(object):
+    """Bounded LRU of ``(slug, delivery key)`` pairs committed in-process.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return True
+            return False
+
+    def add(self, key):
+        with self._lock:
+            self._entries[key] = True
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def add_on_commit(self, key, txn=None):
+        """Remember ``key`` only if the current transaction commits.
+        """
+        def _hook(succeeded):
+            if succeeded:
+                self.add(key)
+        if txn is None:
+            txn = transaction.get()
+        txn.addAfterCommitHook(_hook)
+
+
+def get_recent_deliveries(registry):
+    """Return the registry's :class:`RecentDeliveries`, creating it if needed.
+
+    Its size is set by ``travis_notify.dedupe_cache_size``.
+    """
+    recent = getattr(registry, '_travis_notify_deliveries', None)
+    if recent is None:
+        size = int(registry.settings.get('travis_notify.dedupe_cache_size',
+                                         10000))
+        recent = registry._travis_notify_deliveries = RecentDeliveries(size)
+    return recent
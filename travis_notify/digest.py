@@ -0,0 +1,352 @@
+""" Coalesce per-build notifications into one summary mail per commit.
+
+A large build matrix fires many webhooks for the same owner / repo /
+branch / commit within seconds.  When ``travis_notify.digest_window`` is
+set (in seconds), ``generate_notification_mail`` hands each notification to
+a :class:`DigestBuffer` instead, which emits a single summary mail for each
+key once its window has elapsed.
+
+Until then, buffered notifications are recorded in a :class:`DigestJournal`
+(under ``travis_notify.digest_journal_path``, by default the ``digests``
+directory of ``travis_notify.mail_queue_path``), so that those held by a
+process which crashes or is restarted are recovered, and mailed, by the
+next process to buffer a notification.
+"""
+import atexit
+from collections import OrderedDict
+from email.message import Message
+import itertools
+from json import dumps
+from json import loads
+import logging
+import os
+import threading
+import time
+
+import transaction
+
+from .mailqueue import SENDER
+from .mailqueue import send_message
+
+logger = logging.getLogger('travis_notify.digest')
+
+STATUSES = ('OK', 'FAILED', 'UNKNOWN')
+
+DIGEST_TEMPLATE = """\
+Status: %(summary)s
+
+Repository: %(owner)s/%(repo)s
+Branch: %(branch)s
+Commit: %(commit)s
+
+%(table)s
+
+Builds:
+%(builds)s
+"""
+
+
+def digest_key(payload):
+    """Return the ``(owner, repo, branch, commit)`` key for ``payload``.
+    """
+    repository = payload.get('repository', {})
+    return (repository.get('owner_name'),
+            repository.get('name'),
+            payload.get('branch'),
+            payload.get('commit'),
+           )
+
+
+def overall_status(statuses):
+    """Reduce a sequence of statuses:  any FAILED wins, then any UNKNOWN.
+    """
+    statuses = set(statuses)
+    if 'FAILED' in statuses:
+        return 'FAILED'
+    if 'UNKNOWN' in statuses or not statuses:
+        return 'UNKNOWN'
+    return 'OK'
+
+
+def build_digest_message(key, entries, sender, to):
+    """Build the summary mail for ``entries``, a list of (status, payload).
+    """
+    owner, repo, branch, commit = key
+    counts = dict((status, 0) for status in STATUSES)
+    builds = []
+    for status, payload in entries:
+        counts[status] += 1
+        builds.append('  %-8s #%s %s %s' % (status,
+                                            payload.get('number', '?'),
+                                            payload.get('status_message', ''),
+                                            payload.get('build_url', ''),
+                                           ))
+    table = ['%-8s %s' % ('Status', 'Count')]
+    table.extend('%-8s %d' % (status, counts[status]) for status in STATUSES)
+    summary = overall_status(status for status, payload in entries)
+    message = Message()
+    message['From'] = sender
+    message['To'] = to
+    message['Subject'] = '%s: %s [Travis-CI] (%d builds)' % (
+        summary, repo, len(entries))
+    message.set_payload(DIGEST_TEMPLATE % {
+        'summary': summary,
+        'owner': owner,
+        'repo': repo,
+        'branch': branch,
+        'commit': commit,
+        'table': '\n'.join(table),
+        'builds': '\n'.join(builds),
+    })
+    return message
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # pragma: no cover
+        pass
+    return True
+
+
+class DigestJournal(object):
+    """One file per buffered notification, under ``path/<pid>``.
+
+    Files are removed once their digest has been emitted;  those left
+    behind by processes no longer running are taken over by
+    :meth:`recover`.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._counter = itertools.count()
+
+    def _dir(self):
+        # By pid at write time:  a buffer created before forking workers
+        # must not share a directory between them.
+        path = os.path.join(self.path, str(os.getpid()))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    def write(self, status, payload):
+        """Record ``(status, payload)``;  return its filename.
+        """
+        filename = os.path.join(self._dir(), '%020d-%d.json' % (
+            time.time() * 1000000, next(self._counter)))
+        with open(filename + '.tmp', 'w') as f:
+            f.write(dumps({'status': status, 'payload': payload}))
+        os.rename(filename + '.tmp', filename)
+        return filename
+
+    def remove(self, filenames):
+        for filename in filenames:
+            try:
+                os.remove(filename)
+            except OSError:  # pragma: no cover
+                pass
+
+    def recover(self):
+        """Move the records of processes no longer running into this one's
+        directory;  return their ``(filename, status, payload)``, oldest
+        first.
+        """
+        if not os.path.isdir(self.path):
+            return []
+        result = []
+        for name in sorted(os.listdir(self.path)):
+            if not name.isdigit() or int(name) == os.getpid():
+                continue
+            if _alive(int(name)):
+                continue
+            old_dir = os.path.join(self.path, name)
+            for filename in sorted(os.listdir(old_dir)):
+                source = os.path.join(old_dir, filename)
+                if not filename.endswith('.json'):  # interrupted write
+                    self.remove([source])
+                    continue
+                target = os.path.join(self._dir(), filename)
+                try:
+                    os.rename(source, target)  # racing another recoverer?
+                except OSError:
+                    continue
+                with open(target) as f:
+                    record = loads(f.read())
+                result.append((target, record['status'], record['payload']))
+            try:
+                os.rmdir(old_dir)
+            except OSError:  # pragma: no cover
+                pass
+        return result
+
+
+class DigestBuffer(object):
+    """Buffer notifications per key, emitting each key once per ``window``.
+
+    ``emit`` is called with ``(key, entries)``, where ``entries`` is the
+    list of ``(status, payload)`` pairs added during the window.
+
+    If ``journal`` (a :class:`DigestJournal`) is passed, each notification
+    is recorded there until its digest has been emitted.
+    """
+    def __init__(self, window, emit, clock=time.time, journal=None):
+        self.window = window
+        self.emit = emit
+        self.clock = clock
+        self.journal = journal
+        self._pending = OrderedDict()  # key -> (opened, entries, filenames)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def add(self, payload, status):
+        filename = None
+        if self.journal is not None:
+            filename = self.journal.write(status, payload)
+        self._buffer(payload, status, filename)
+
+    def _buffer(self, payload, status, filename=None):
+        key = digest_key(payload)
+        with self._lock:
+            opened, entries, filenames = self._pending.setdefault(
+                key, (self.clock(), [], []))
+            entries.append((status, payload))
+            if filename is not None:
+                filenames.append(filename)
+
+    def recover(self):
+        """Buffer the notifications journaled by processes no longer
+        running;  return how many.
+        """
+        if self.journal is None:
+            return 0
+        recovered = self.journal.recover()
+        for filename, status, payload in recovered:
+            self._buffer(payload, status, filename)
+        if recovered:
+            logger.info('Recovered %d buffered notification(s)',
+                        len(recovered))
+            self.start()
+        return len(recovered)
+
+    def add_on_commit(self, payload, status, txn=None):
+        """Buffer ``payload`` only if the current transaction commits.
+        """
+        def _hook(succeeded):
+            if succeeded:
+                self.add(payload, status)
+                self.start()
+        if txn is None:
+            txn = transaction.get()
+        txn.addAfterCommitHook(_hook)
+
+    def due(self, now=None):
+        """Remove and return ``(key, entries)`` for each expired window.
+        """
+        return [(key, entries) for key, entries, filenames in self._due(now)]
+
+    def _due(self, now=None):
+        if now is None:
+            now = self.clock()
+        result = []
+        with self._lock:
+            # Keys are ordered by the time their window opened.
+            for key, (opened, entries, filenames) in list(
+                    self._pending.items()):
+                if opened + self.window > now:
+                    break
+                del self._pending[key]
+                result.append((key, entries, filenames))
+        return result
+
+    def flush(self, now=None):
+        """Emit all expired windows;  return the number of mails emitted.
+
+        The journal keeps the notifications of digests which could not be
+        emitted, for the next process to recover.
+        """
+        due = self._due(now)
+        for key, entries, filenames in due:
+            try:
+                self.emit(key, entries)
+            except Exception:
+                logger.exception('Could not emit digest for %s', key)
+            else:
+                if self.journal is not None:
+                    self.journal.remove(filenames)
+        return len(due)
+
+    def flush_all(self):
+        return self.flush(float('inf'))
+
+    def start(self):
+        """Start the background flusher thread, if not already running.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='travis_notify-digest')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush_all()
+
+    def _run(self):
+        interval = max(self.window / 4.0, 0.1)
+        while not self._stop.wait(interval):
+            self.flush()
+
+
+_lock = threading.Lock()
+
+
+def journal_path_from_settings(settings):
+    """Return ``travis_notify.digest_journal_path``, defaulting to the
+    ``digests`` directory of ``travis_notify.mail_queue_path`` (None if
+    neither is set).
+    """
+    path = settings.get('travis_notify.digest_journal_path')
+    if path:
+        return path
+    queue_path = settings.get('travis_notify.mail_queue_path')
+    if queue_path:
+        return os.path.join(queue_path, 'digests')
+    return None
+
+
+def get_digest(registry):
+    """Return the registry's :class:`DigestBuffer`, creating it if needed
+    (and recovering the notifications journaled by dead processes).
+    """
+    digest = getattr(registry, '_travis_notify_digest', None)
+    if digest is None:
+        with _lock:
+            digest = getattr(registry, '_travis_notify_digest', None)
+            if digest is None:
+                settings = registry.settings
+                window = float(settings.get('travis_notify.digest_window', 0))
+                journal_path = journal_path_from_settings(settings)
+                digest = DigestBuffer(
+                    window, _make_emitter(registry),
+                    journal=journal_path and DigestJournal(journal_path))
+                digest.recover()
+                registry._travis_notify_digest = digest
+    return digest
+
+
+def _make_emitter(registry):
+    def emit(key, entries):
+        to = registry.settings['travis_notify.recipients']
+        message = build_digest_message(key, entries, SENDER, to)
+        with transaction.manager:
+            send_message(registry, message, SENDER, to)
+
+    return emit
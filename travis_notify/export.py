@@ -0,0 +1,87 @@
+""" Streaming NDJSON export of a repo's full build history.
+"""
+import argparse
+from json import dumps
+import os
+import sys
+
+import transaction
+
+from .models import BuildRecord
+
+
+def iter_ndjson(repo):
+    """Yield one encoded JSON line per item stored in ``repo``.
+    """
+    for item in repo.iterExport():
+        if isinstance(item, BuildRecord):
+            item = item.asDict()
+        yield (dumps(item, sort_keys=True) + '\n').encode('utf-8')
+
+
+def export_to_file(repo, path):
+    """Write ``repo`` as NDJSON to ``path``.
+
+    The lines go to a temporary file, renamed to ``path`` once complete:  an
+    export which fails leaves no truncated file behind.
+    """
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as out:
+            for line in iter_ndjson(repo):
+                out.write(line)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def export_app_iter(repo):
+    """Return a WSGI ``app_iter`` streaming ``repo`` as NDJSON.
+
+    The request's own ZODB connection is closed before the response body
+    is iterated, so the iterator opens a private connection to the same
+    database (in its own transaction manager) for the duration of the
+    export.
+    """
+    jar = getattr(repo, '_p_jar', None)
+    if jar is None:
+        return iter_ndjson(repo)
+    return _iter_private(jar.db(), repo._p_oid)
+
+
+def _iter_private(db, oid):
+    conn = db.open(transaction_manager=transaction.TransactionManager())
+    try:
+        for line in iter_ndjson(conn.get(oid)):
+            yield line
+    finally:
+        conn.transaction_manager.abort()
+        conn.close()
+
+
+def main(argv=sys.argv, out=None):  # pragma: no cover
+    """Console script:  export ``owner/repo`` as NDJSON to stdout / a file.
+    """
+    from pyramid.paster import bootstrap
+    parser = argparse.ArgumentParser(
+        description="Export a repo's build history as NDJSON.")
+    parser.add_argument('config_uri')
+    parser.add_argument('slug', help='owner/repo')
+    parser.add_argument('-o', '--output', help='Output file (default stdout)')
+    args = parser.parse_args(argv[1:])
+    owner_name, repo_name = args.slug.split('/')
+    env = bootstrap(args.config_uri)
+    try:
+        repo = env['root'][owner_name][repo_name]
+        if out is None and args.output:
+            export_to_file(repo, args.output)
+        else:
+            if out is None:
+                out = sys.stdout.buffer
+            for line in iter_ndjson(repo):
+                out.write(line)
+            out.flush()
+    finally:
+        env['closer']()
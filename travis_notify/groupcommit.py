@@ -0,0 +1,158 @@
+""" Group commit for the ``webhook`` view.
+
+By default each notification is stored in its own transaction, which costs
+an ``fsync`` on FileStorage.  With ``travis_notify.group_commit`` enabled,
+the view instead hands the notification to a :class:`GroupCommitter`,
+whose thread stores up to ``travis_notify.group_commit_size``
+notifications, gathered for at most ``travis_notify.group_commit_delay``
+milliseconds after the first, in a single transaction (via
+``.ingest.make_batch_applier``, so each goes through the view's own
+``process_notification``).  The view waits for that transaction to commit
+before acknowledging the request, and fails if its notification could not
+be stored.  It waits at most ``travis_notify.group_commit_timeout``
+seconds, answering 503 after that so that Travis redelivers:  the
+notification is dropped if its batch has not started yet, else it is
+stored and the redelivery ignored (see ``.dedupe``).
+"""
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import logging
+import threading
+import time
+
+from pyramid.settings import asbool
+
+logger = logging.getLogger('travis_notify.groupcommit')
+
+_lock = threading.Lock()
+
+
+class GroupCommitter(object):
+    """Pass items submitted from concurrent threads to ``apply_batch`` in
+    batches, from a thread of its own.
+
+    ``apply_batch(items)`` returns the exception raised by each item, or
+    None if it was applied.
+    """
+    def __init__(self, apply_batch, max_items=50, max_delay=0.01,
+                 clock=time.monotonic, timeout=30.0):
+        self.apply_batch = apply_batch
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.clock = clock
+        self._pending = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def submit(self, item):
+        """Queue ``item``;  return a future for the outcome of its batch.
+        """
+        future = Future()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError('GroupCommitter stopped')
+            self._pending.append((item, future))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self.run, name='travis_notify-group-commit')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def store(self, item):
+        """Submit ``item`` and wait up to ``timeout`` seconds for its batch
+        to commit.
+
+        Return False if it has not by then;  re-raise its exception if it
+        could not be applied.
+        """
+        future = self.submit(item)
+        try:
+            future.result(self.timeout)
+        except FutureTimeoutError:
+            dropped = future.cancel()
+            logger.warning('Group commit timed out after %gs (%s)',
+                           self.timeout,
+                           'dropped' if dropped else 'still committing')
+            return False
+        return True
+
+    def take(self):
+        """Wait for the next batch:  up to ``max_items``, gathered for up to
+        ``max_delay`` seconds after the first, leaving out items whose
+        futures were cancelled.  Return [] once stopped.
+        """
+        with self._cond:
+            while True:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                deadline = self.clock() + self.max_delay
+                while (len(self._pending) < self.max_items
+                       and not self._stopped):
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = [(item, future)
+                         for item, future in self._pending[:self.max_items]
+                         if future.set_running_or_notify_cancel()]
+                del self._pending[:self.max_items]
+                if batch or (self._stopped and not self._pending):
+                    return batch
+
+    def commit(self, batch):
+        """Apply ``batch``, and resolve its futures.
+        """
+        try:
+            errors = self.apply_batch([item for item, future in batch])
+        except Exception as e:
+            logger.exception('Failed to commit %d items', len(batch))
+            errors = [e] * len(batch)
+        for (item, future), error in zip(batch, errors):
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def run(self):
+        while True:
+            batch = self.take()
+            if not batch:
+                break
+            self.commit(batch)
+
+    def stop(self, timeout=None):
+        """Commit what has been submitted, then stop the thread.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+def get_group_committer(registry):
+    """Return the registry's :class:`GroupCommitter`, creating it if needed,
+    or None unless ``travis_notify.group_commit`` is enabled.
+    """
+    committer = getattr(registry, '_travis_notify_committer', None)
+    if committer is None:
+        settings = registry.settings
+        if not asbool(settings.get('travis_notify.group_commit', False)):
+            return None
+        from .ingest import make_batch_applier
+        with _lock:
+            committer = getattr(registry, '_travis_notify_committer', None)
+            if committer is None:
+                committer = GroupCommitter(
+                    make_batch_applier(registry),
+                    int(settings.get('travis_notify.group_commit_size', 50)),
+                    float(settings.get('travis_notify.group_commit_delay',
+                                       10)) / 1000,
+                    timeout=float(settings.get(
+                        'travis_notify.group_commit_timeout', 30)))
+                registry._travis_notify_committer = committer
+    return committer
@@ -0,0 +1,410 @@
+""" Asynchronous (ASGI) front end for webhook ingestion.
+
+:class:`IngestApp` accepts Travis notifications on an asyncio event loop,
+so that many slow clients cost a coroutine each rather than a server
+thread.  It checks each request with the same
+:class:`~travis_notify.views.TravisAuthorizationCheck` as the ``webhook``
+view, appends the payload to a local :class:`WriteAheadLog` (batching the
+``fsync`` of concurrent requests), and acknowledges Travis once the entry
+is on disk.
+
+An :class:`Applier` thread then reads the log in batches, and applies each
+batch to the database in one transaction, using the view's own
+:func:`~travis_notify.views.process_notification` (so redeliveries are
+dropped, and mail is generated, exactly as for the ``webhook`` view).  It
+records its position in the log after each commit (skipping, and logging,
+records which cannot be applied);  after a crash, the entries since then
+are applied again, and dropped as redeliveries.
+
+Run it with ``travis_notify_ingest`` (requires ``travis_notify[asgi]``).
+The ingest process opens the database itself:  share a FileStorage with
+the WSGI processes through a ZEO server (see ``travis_notify_serve``).
+"""
+import argparse
+import asyncio
+from json import dumps
+from json import loads
+import logging
+import os
+import sys
+import threading
+
+from pyramid.httpexceptions import HTTPForbidden
+from pyramid.request import Request
+import transaction
+from ZODB.POSException import ConflictError
+
+from .metrics import CONFLICT_RETRIES
+from .views import TravisAuthorizationCheck
+from .views import process_notification
+
+logger = logging.getLogger('travis_notify.ingest')
+
+SEGMENT_SIZE = 16 * 1024 * 1024
+MAX_BODY = 1024 * 1024
+
+
+class WriteAheadLog(object):
+    """Durable, append-only log of JSON records, in numbered segment files.
+
+    Positions in the log are ``(segment, offset)`` tuples.  Opening the log
+    starts a new segment, so that older segments (perhaps ending in a torn
+    record) are never appended to.  :meth:`checkpoint` records a position as
+    applied, and removes the segments before it.
+    """
+    def __init__(self, path, segment_size=SEGMENT_SIZE, fsync=os.fsync):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.segment_size = segment_size
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        segments = self.segments()
+        self.segment = segments and segments[-1] + 1 or 1
+        self._file = open(self._segment_path(self.segment), 'ab')
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, '%010d.wal' % segment)
+
+    def segments(self):
+        return sorted(int(x[:-4]) for x in os.listdir(self.path)
+                      if x.endswith('.wal'))
+
+    def append(self, records):
+        """Append ``records`` and flush them to disk.
+        """
+        data = b''.join(dumps(x).encode('utf-8') + b'\n' for x in records)
+        with self._lock:
+            self._file.write(data)
+            self._file.flush()
+            self._fsync(self._file.fileno())
+            if self._file.tell() >= self.segment_size:
+                self._file.close()
+                self.segment += 1
+                self._file = open(self._segment_path(self.segment), 'ab')
+
+    def read(self, position, limit=1000):
+        """Return up to ``limit`` complete records after ``position``, and
+        the position following them.
+
+        Only segments which were already closed when the read began are
+        read past:  records appended to the current one after we reached
+        its end (and before it was rotated) must not be skipped.
+        """
+        with self._lock:
+            current = self.segment
+        segment, offset = position
+        records = []
+        while len(records) < limit:
+            try:
+                f = open(self._segment_path(segment), 'rb')
+            except FileNotFoundError:
+                f = None
+            if f is not None:
+                with f:
+                    f.seek(offset)
+                    for line in f:
+                        if not line.endswith(b'\n'):  # torn, or being written
+                            break
+                        records.append(loads(line.decode('utf-8')))
+                        offset += len(line)
+                        if len(records) == limit:
+                            break
+            if len(records) == limit or segment >= current:
+                break
+            segment, offset = segment + 1, 0
+        return records, (segment, offset)
+
+    @property
+    def _checkpoint_path(self):
+        return os.path.join(self.path, 'checkpoint')
+
+    def load_checkpoint(self):
+        """Return the last checkpointed position (or the log's start).
+        """
+        try:
+            with open(self._checkpoint_path) as f:
+                return tuple(loads(f.read()))
+        except FileNotFoundError:
+            segments = self.segments()
+            return (segments and segments[0] or self.segment, 0)
+
+    def checkpoint(self, position):
+        """Record ``position`` as applied;  remove earlier segments.
+        """
+        tmp = self._checkpoint_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(dumps(list(position)))
+            f.flush()
+            self._fsync(f.fileno())
+        os.replace(tmp, self._checkpoint_path)
+        for segment in self.segments():
+            if segment >= position[0]:
+                break
+            os.remove(self._segment_path(segment))
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class AsyncAppender(object):
+    """Append records to a :class:`WriteAheadLog` from coroutines.
+
+    Records appended while a write is in progress are written (and
+    fsync'ed) together by the next one, in ``executor``.
+    """
+    def __init__(self, wal, on_append=None, executor=None):
+        self.wal = wal
+        self.on_append = on_append
+        self.executor = executor
+        self._pending = []
+        self._writing = False
+
+    async def append(self, record):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((record, future))
+        if not self._writing:
+            self._writing = True
+            loop.create_task(self._write(loop))
+        await future
+
+    async def _write(self, loop):
+        try:
+            while self._pending:
+                batch, self._pending = self._pending, []
+                try:
+                    await loop.run_in_executor(
+                        self.executor, self.wal.append, [x[0] for x in batch])
+                except Exception as e:
+                    for record, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for record, future in batch:
+                    if not future.done():  # e.g., client disconnected
+                        future.set_result(None)
+                if self.on_append is not None:
+                    self.on_append()
+        finally:
+            self._writing = False
+
+
+class Applier(object):
+    """Apply the records of a :class:`WriteAheadLog` in batches, via
+    ``apply_batch(records)``, checkpointing after each.
+    """
+    def __init__(self, wal, apply_batch, batch_size=500, interval=1.0):
+        self.wal = wal
+        self.apply_batch = apply_batch
+        self.batch_size = batch_size
+        self.interval = interval
+        self.position = wal.load_checkpoint()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def run_once(self):
+        """Apply the next batch;  return the number of records applied.
+        """
+        records, position = self.wal.read(self.position, self.batch_size)
+        if records:
+            self.apply_batch(records)
+        if position != self.position:
+            self.wal.checkpoint(position)
+            self.position = position
+        return len(records)
+
+    def notify(self):
+        """Wake the thread:  records have been appended.
+        """
+        self._wake.set()
+
+    def run(self):
+        while True:
+            try:
+                applied = self.run_once()
+            except Exception:
+                logger.exception('Failed to apply batch at %s', self.position)
+                applied = 0
+            if self._stopped and not applied:
+                break
+            if not applied:
+                self._wake.wait(self.interval)
+                self._wake.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run,
+                                        name='travis_notify-applier')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Apply what has been logged, then stop the thread.
+        """
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+def make_batch_applier(registry, attempts=3):
+    """Return an ``apply_batch(records)`` storing records under the root of
+    ``registry``'s database, one transaction per batch.
+
+    Each record is a mapping, whose ``slug`` names the repo and whose
+    ``payload`` is the JSON-encoded notification.  Conflicts are retried
+    (and, after ``attempts``, raised);  if a batch fails otherwise, its
+    records are applied one per transaction.  ``apply_batch`` returns the
+    exception raised by each record, or None if it was applied.
+    """
+    from pyramid.scripting import prepare
+
+    def _apply(records):
+        env = prepare(registry=registry)
+        try:
+            for number, attempt in enumerate(
+                    transaction.manager.attempts(attempts)):
+                if number:
+                    CONFLICT_RETRIES.inc()
+                with attempt:
+                    for record in records:
+                        process_notification(env['root'], env['request'],
+                                             record['slug'],
+                                             loads(record['payload']))
+        finally:
+            env['closer']()
+
+    def apply_batch(records):
+        try:
+            _apply(records)
+        except ConflictError:
+            raise
+        except Exception as e:
+            if len(records) == 1:
+                logger.exception('Failed to apply record: %r', records[0])
+                return [e]
+            return [apply_batch([record])[0] for record in records]
+        return [None] * len(records)
+
+    return apply_batch
+
+
+class IngestApp(object):
+    """ASGI application accepting Travis notifications (see module doc).
+    """
+    def __init__(self, registry, wal, applier=None, max_body=MAX_BODY):
+        self.registry = registry
+        self.check = TravisAuthorizationCheck(None, registry)
+        self.applier = applier
+        notify = applier is not None and applier.notify or None
+        self.appender = AsyncAppender(wal, notify)
+        self.max_body = max_body
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            status, body = await self.ingest(scope, receive)
+            await send({'type': 'http.response.start',
+                        'status': status,
+                        'headers': [(b'content-type', b'application/json'),
+                                    (b'content-length',
+                                     str(len(body)).encode('ascii'))],
+                       })
+            await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.applier is not None:
+                    self.applier.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.applier is not None:
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, self.applier.stop)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def ingest(self, scope, receive):
+        """Return ``(status, body)`` for the request.
+        """
+        if scope['method'] != 'POST':
+            return 405, b'{"error": "method not allowed"}'
+        chunks = []
+        size = 0
+        more = True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return 400, b'{"error": "disconnected"}'
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body:
+                return 413, b'{"error": "too large"}'
+            chunks.append(chunk)
+            more = message.get('more_body', False)
+        headers = [(name.decode('latin-1'), value.decode('latin-1'))
+                   for name, value in scope['headers']]
+        request = Request.blank(scope['path'], method='POST',
+                                headers=headers, body=b''.join(chunks))
+        request.registry = self.registry
+        try:
+            authorized = self.check(None, request)
+        except HTTPForbidden:
+            authorized = False
+        if not authorized:
+            return 403, b'{"error": "forbidden"}'
+        payload = request.POST.get('payload')
+        slug = request.headers['Travis-Repo-Slug']
+        try:
+            loads(payload)
+            owner_name, repo_name = slug.split('/')
+        except (TypeError, ValueError):
+            return 400, b'{"error": "bad payload"}'
+        await self.appender.append({'slug': slug, 'payload': payload})
+        return 200, b'null'
+
+
+def make_ingest_app(registry):
+    """Return an :class:`IngestApp` for ``registry``'s settings and database.
+    """
+    settings = registry.settings
+    wal = WriteAheadLog(settings['travis_notify.ingest_wal_path'])
+    applier = Applier(
+        wal, make_batch_applier(registry),
+        batch_size=int(settings.get('travis_notify.ingest_batch_size', 500)))
+    return IngestApp(registry, wal, applier)
+
+
+def main(argv=sys.argv):  # pragma: no cover
+    """Console script:  serve the ASGI ingest front end.
+    """
+    from pyramid.paster import bootstrap
+    from pyramid.paster import setup_logging
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('travis_notify_ingest requires uvicorn '
+                 '(install travis_notify[asgi])')
+    parser = argparse.ArgumentParser(
+        description='Accept Travis notifications asynchronously.')
+    parser.add_argument('config_uri')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6544)
+    args = parser.parse_args(argv[1:])
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+    app = make_ingest_app(env['registry'])
+    try:
+        uvicorn.run(app, host=args.host, port=args.port, lifespan='on',
+                    log_config=None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        app.applier.stop()  # apply whatever was acknowledged
+        app.appender.wal.close()
+        env['closer']()
@@ -0,0 +1,293 @@
+""" Durable outbound mail queue, decoupled from the webhook request.
+
+The webhook only drops messages into a maildir (via
+:class:`repoze.sendmail.delivery.QueuedMailDelivery`, so nothing is queued
+unless the request's transaction commits);  a separate process runs a
+:class:`DeliveryWorkerPool` which drains the maildir over SMTP, reusing one
+SMTP session per batch and retrying transient failures with backoff.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from email.header import decode_header
+from email.header import make_header
+from email.parser import Parser
+import logging
+import os
+import shutil
+import smtplib
+import sys
+import threading
+import time
+
+from pyramid.settings import asbool
+from pyramid_mailer import get_mailer
+from repoze.sendmail.delivery import QueuedMailDelivery
+from repoze.sendmail.maildir import Maildir
+
+from .metrics import MAILS
+from .metrics import STAGE_SECONDS
+
+logger = logging.getLogger('travis_notify.mailqueue')
+
+SENDER = 'travis_notify@palladion.com'
+
+_queues = {}
+
+
+def get_queue(path):
+    """Return the (shared) :class:`MailQueue` for ``path``.
+    """
+    queue = _queues.get(path)
+    if queue is None:
+        queue = _queues[path] = MailQueue(path)
+    return queue
+
+
+def split_addresses(addresses):
+    """Normalize a settings value (string or sequence) to a list.
+    """
+    if isinstance(addresses, str):
+        addresses = addresses.replace(',', ' ').split()
+    return list(addresses)
+
+
+class MailQueue(object):
+    """Enqueue messages into a maildir as part of the current transaction.
+    """
+    def __init__(self, path, delivery_factory=QueuedMailDelivery):
+        self.path = path
+        Maildir(path, create=True)
+        self._delivery = delivery_factory(path)
+
+    def put(self, fromaddr, toaddrs, message):
+        return self._delivery.send(fromaddr, split_addresses(toaddrs), message)
+
+
+def send_message(registry, message, fromaddr, toaddrs):
+    """Send ``message`` as part of the current transaction.
+
+    Use the queue at ``travis_notify.mail_queue_path`` if configured,
+    falling back to the configured mailer.
+    """
+    queue_path = registry.settings.get('travis_notify.mail_queue_path')
+    with STAGE_SECONDS.time('mail'):
+        if queue_path:
+            get_queue(queue_path).put(fromaddr, toaddrs, message)
+        else:
+            get_mailer(registry).send(message)
+    MAILS.inc()
+
+
+def parse_queued(fp):
+    """Return ``(fromaddr, toaddrs, message)`` for a queued message file.
+
+    Strips the envelope headers added by ``QueuedMailDelivery``.
+    """
+    message = Parser().parse(fp)
+    fromaddr = _decode(message['X-Actually-From'])
+    toaddrs = [x.strip() for x in _decode(message['X-Actually-To']).split(',')
+               if x.strip()]
+    del message['X-Actually-From']
+    del message['X-Actually-To']
+    return fromaddr, toaddrs, message
+
+
+def _decode(value):
+    if value is None:
+        return ''
+    return str(make_header(decode_header(value)))
+
+
+def smtp_factory_from_settings(settings, prefix='mail.'):
+    """Return a callable opening an SMTP session configured as for
+    ``pyramid_mailer`` (``mail.host``, ``mail.port``, ``mail.username``,
+    ``mail.password``, ``mail.tls``, ``mail.ssl``).
+    """
+    host = settings.get(prefix + 'host', 'localhost')
+    port = int(settings.get(prefix + 'port', 25))
+    username = settings.get(prefix + 'username')
+    password = settings.get(prefix + 'password')
+    tls = asbool(settings.get(prefix + 'tls', False))
+    ssl = asbool(settings.get(prefix + 'ssl', False))
+
+    def smtp_factory():
+        klass = ssl and smtplib.SMTP_SSL or smtplib.SMTP
+        smtp = klass(host, port)
+        if tls:
+            smtp.starttls()
+        if username:
+            smtp.login(username, password)
+        return smtp
+
+    return smtp_factory
+
+
+class DeliveryWorkerPool(object):
+    """Drain a maildir queue over SMTP using a pool of worker threads.
+
+    - Pending messages are split into batches of ``batch_size``;  each
+      worker delivers one batch over a single SMTP session.
+
+    - Transient failures (connection errors, 4xx replies) are retried after
+      ``backoff * 2 ** (attempts - 1)`` seconds, up to ``max_attempts``.
+
+    - Permanent failures (5xx replies, refused recipients) and messages
+      which run out of attempts are moved into the ``failed`` subdirectory.
+
+    Only one pool should drain a given queue directory at a time.
+    """
+    def __init__(self, queue_path, smtp_factory,
+                 workers=2,
+                 batch_size=20,
+                 max_attempts=5,
+                 backoff=30.0,
+                 clock=time.time,
+                ):
+        self.maildir = Maildir(queue_path, create=True)
+        self.failed_path = os.path.join(queue_path, 'failed')
+        if not os.path.isdir(self.failed_path):
+            os.makedirs(self.failed_path)
+        self.smtp_factory = smtp_factory
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.clock = clock
+        self._attempts = {}  # filename -> (attempts, not_before)
+        self._lock = threading.Lock()
+
+    def pending(self):
+        """Return queued filenames which are due for (re)delivery.
+        """
+        now = self.clock()
+        result = []
+        with self._lock:
+            for filename in self.maildir:
+                attempts, not_before = self._attempts.get(filename, (0, 0))
+                if not_before <= now:
+                    result.append(filename)
+        return result
+
+    def batches(self, filenames):
+        size = self.batch_size
+        return [filenames[i:i + size] for i in range(0, len(filenames), size)]
+
+    def deliver(self, batch):
+        """Deliver ``batch`` over one SMTP session;  return the count sent.
+        """
+        try:
+            smtp = self.smtp_factory()
+        except (smtplib.SMTPException, OSError):
+            logger.warning('Cannot connect to SMTP server', exc_info=True)
+            for filename in batch:
+                self._retry(filename)
+            return 0
+        sent = 0
+        try:
+            for i, filename in enumerate(batch):
+                try:
+                    with open(filename) as f:
+                        fromaddr, toaddrs, message = parse_queued(f)
+                except (IOError, OSError):  # removed out from under us
+                    continue
+                try:
+                    smtp.sendmail(fromaddr, toaddrs, message.as_string())
+                except smtplib.SMTPResponseException as e:
+                    if 500 <= e.smtp_code <= 599:
+                        self._fail(filename)
+                    else:
+                        self._retry(filename)
+                except smtplib.SMTPRecipientsRefused:
+                    self._fail(filename)
+                except (smtplib.SMTPException, OSError):
+                    logger.warning('SMTP session lost', exc_info=True)
+                    for rest in batch[i:]:
+                        self._retry(rest)
+                    break
+                else:
+                    self._done(filename)
+                    sent += 1
+        finally:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+        return sent
+
+    def run_once(self):
+        """Deliver everything currently due;  return the count sent.
+        """
+        batches = self.batches(self.pending())
+        if not batches:
+            return 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return sum(executor.map(self.deliver, batches))
+
+    def run_forever(self, interval=5.0, stop=None):
+        if stop is None:  # pragma: no cover
+            stop = threading.Event()
+        while not stop.is_set():
+            sent = self.run_once()
+            if sent:
+                logger.info('Delivered %d message(s)', sent)
+            stop.wait(interval)
+
+    def _done(self, filename):
+        with self._lock:
+            self._attempts.pop(filename, None)
+        _remove(filename)
+
+    def _retry(self, filename):
+        with self._lock:
+            attempts, _ = self._attempts.get(filename, (0, 0))
+            attempts += 1
+            if attempts < self.max_attempts:
+                delay = self.backoff * 2 ** (attempts - 1)
+                self._attempts[filename] = (attempts, self.clock() + delay)
+                return
+        logger.error('Giving up on %s after %d attempts', filename, attempts)
+        self._fail(filename)
+
+    def _fail(self, filename):
+        with self._lock:
+            self._attempts.pop(filename, None)
+        target = os.path.join(self.failed_path, os.path.basename(filename))
+        try:
+            shutil.move(filename, target)
+        except (IOError, OSError):  # pragma: no cover
+            pass
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:  # pragma: no cover
+        pass
+
+
+def main(argv=sys.argv):  # pragma: no cover
+    """Console script:  run the delivery workers for the configured queue.
+    """
+    from pyramid.paster import get_appsettings
+    from pyramid.paster import setup_logging
+    parser = argparse.ArgumentParser(
+        description='Deliver queued travis_notify mail.')
+    parser.add_argument('config_uri')
+    parser.add_argument('--once', action='store_true',
+                        help='Drain the queue once, then exit.')
+    parser.add_argument('--interval', type=float, default=5.0)
+    args = parser.parse_args(argv[1:])
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    pool = DeliveryWorkerPool(
+        settings['travis_notify.mail_queue_path'],
+        smtp_factory_from_settings(settings),
+        workers=int(settings.get('travis_notify.mail_workers', 2)),
+        batch_size=int(settings.get('travis_notify.mail_batch_size', 20)),
+        max_attempts=int(settings.get('travis_notify.mail_max_attempts', 5)),
+        backoff=float(settings.get('travis_notify.mail_backoff', 30)),
+    )
+    if args.once:
+        pool.run_once()
+    else:
+        pool.run_forever(args.interval)
@@ -0,0 +1,233 @@
+""" In-process counters and latency histograms, served as Prometheus text.
+
+The webhook's hot path records:
+
+- ``travis_notify_webhooks_received_total``:  requests carrying Travis
+  credentials (checked by ``views.TravisAuthorizationCheck``);
+
+- ``travis_notify_webhooks_rejected_total``:  those refused as forbidden;
+
+- ``travis_notify_webhooks_duplicated_total``:  redeliveries dropped by
+  ``views.process_notification``;
+
+- ``travis_notify_mails_total``:  messages sent (or queued) by
+  ``mailqueue.send_message``;
+
+- ``travis_notify_conflict_retries_total``:  requests (or ingest batches)
+  retried after a conflict;
+
+- ``travis_notify_stage_seconds``:  the time spent in each stage (``auth``,
+  ``push_item``, ``commit`` and ``mail``);
+
+- ``travis_notify_request_seconds``:  the time spent serving each request,
+  by method (``other`` for methods outside ``REQUEST_METHODS``, so that
+  clients cannot add series).
+
+The tween sits directly below the WSGI ingress, and answers GETs of
+``travis_notify.metrics_path`` (e.g. ``/metrics``;  unset by default, which
+serves nothing) itself, so scraping never opens a ZODB connection.  Values are per
+process:  scrape each worker of ``travis_notify_serve`` (or sum them).
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+from pyramid.response import Response
+from pyramid.tweens import INGRESS
+from pyramid.tweens import MAIN
+import transaction
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """Monotonic, thread-safe counter.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, '', self.value
+
+
+class Histogram(object):
+    """Thread-safe histogram of observations, in cumulative ``buckets``,
+    optionally split by the value of a single ``label``.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._series = {}  # label value -> [bucket counts, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [
+                    [0] * len(self.buckets), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, label_value=None, clock=time.perf_counter):
+        """Observe the time spent in the ``with`` block.
+        """
+        start = clock()
+        try:
+            yield
+        finally:
+            self.observe(clock() - start, label_value)
+
+    def _labels(self, label_value, **extra):
+        labels = []
+        if self.label is not None:
+            labels.append((self.label, label_value))
+        labels.extend(sorted(extra.items()))
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % x for x in labels)
+
+    def samples(self):
+        with self._lock:
+            series = sorted((k, list(v[0]), v[1])
+                            for k, v in self._series.items())
+        for label_value, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       self._labels(label_value, le=_format(bound)),
+                       cumulative)
+            yield self.name + '_sum', self._labels(label_value), total
+            yield self.name + '_count', self._labels(label_value), cumulative
+
+
+class Metrics(object):
+    """Collection of metrics, rendered in the Prometheus text format.
+    """
+    def __init__(self):
+        self._metrics = []
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                if isinstance(value, float):
+                    value = _format(value)
+                lines.append('%s%s %s' % (name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+WEBHOOKS_RECEIVED = metrics.add(Counter(
+    'travis_notify_webhooks_received_total',
+    'Requests carrying Travis credentials.'))
+WEBHOOKS_REJECTED = metrics.add(Counter(
+    'travis_notify_webhooks_rejected_total',
+    'Requests refused by the authorization check.'))
+WEBHOOKS_DUPLICATED = metrics.add(Counter(
+    'travis_notify_webhooks_duplicated_total',
+    'Redelivered notifications dropped.'))
+MAILS = metrics.add(Counter(
+    'travis_notify_mails_total',
+    'Notification mails sent or queued.'))
+CONFLICT_RETRIES = metrics.add(Counter(
+    'travis_notify_conflict_retries_total',
+    'Requests or ingest batches retried after a conflict.'))
+STAGE_SECONDS = metrics.add(Histogram(
+    'travis_notify_stage_seconds',
+    'Time spent in each stage of processing a notification.',
+    label='stage'))
+REQUEST_SECONDS = metrics.add(Histogram(
+    'travis_notify_request_seconds',
+    'Time spent serving each request.',
+    label='method'))
+
+
+def time_commit(txn=None, clock=time.perf_counter):
+    """Observe the ``commit`` stage of ``txn`` (by default, the current
+    transaction), if it commits.
+    """
+    if txn is None:
+        txn = transaction.get()
+    try:
+        txn.data(time_commit)
+        return  # already timed
+    except KeyError:
+        txn.set_data(time_commit, True)
+    started = []
+
+    def _before():
+        started.append(clock())
+
+    def _after(succeeded):
+        if succeeded and started:
+            STAGE_SECONDS.observe(clock() - started[0], 'commit')
+
+    txn.addBeforeCommitHook(_before)
+    txn.addAfterCommitHook(_after)
+
+
+def count_retry(event):
+    """Subscriber for ``pyramid_retry``'s ``IBeforeRetry``.
+    """
+    CONFLICT_RETRIES.inc()
+
+
+REQUEST_METHODS = frozenset(
+    ('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'PATCH'))
+
+
+def metrics_tween_factory(handler, registry):
+    path = registry.settings.get('travis_notify.metrics_path')
+
+    def metrics_tween(request):
+        if path and request.path == path and request.method == 'GET':
+            return Response(text=metrics.render(),
+                            content_type=CONTENT_TYPE, charset='utf-8')
+        method = request.method
+        if method not in REQUEST_METHODS:
+            method = 'other'
+        with REQUEST_SECONDS.time(method):
+            return handler(request)
+
+    return metrics_tween
+
+
+def includeme(config):
+    config.add_tween('travis_notify.metrics.metrics_tween_factory',
+                     under=INGRESS,
+                     over=('travis_notify.pagecache.page_cache_tween_factory',
+                           MAIN))
+    config.add_subscriber(count_retry, 'pyramid_retry.IBeforeRetry')
@@ -0,0 +1,110 @@
+""" Rewrite stored history from raw payload dicts into ``BuildRecord``s
+(moving raw payloads stored inline in older records to ``RawPayload``s).
+"""
+import argparse
+import logging
+import sys
+
+import transaction
+
+from .models import BuildRecord
+from .models import RecentStack
+from .models import Repo
+from .models import as_record
+
+logger = logging.getLogger('travis_notify.migrate')
+
+
+def _convert(items, keep_raw):
+    converted = [as_record(x, keep_raw) for x in items]
+    changed = any(new is not old for new, old in zip(converted, items))
+    return converted, changed
+
+
+def migrate_repo(repo, keep_raw=False, commit=None):
+    """Convert ``repo``'s recent and archived items in place.
+
+    Layers keep their generations and order;  a recent history predating
+    ``RecentStack`` is copied into one.  ``commit``, if passed, is called
+    after each archive layer is rewritten (e.g. to commit a transaction);
+    each layer is then deactivated.  Return the number of items converted.
+    """
+    if not isinstance(repo._recent, RecentStack):
+        recent = RecentStack()
+        recent.__setstate__(repo._recent.__getstate__())
+        repo._recent = recent
+    count = 0
+    for layer in repo._recent._layers:
+        layer._stack[:], changed = _convert(layer._stack, keep_raw)
+        if changed:
+            count += len(layer._stack)
+            repo._recent._p_changed = True
+    layer = repo._archive._head
+    while layer is not None:
+        layer._stack[:], changed = _convert(layer._stack, keep_raw)
+        if changed:
+            count += len(layer._stack)
+            layer._p_changed = True
+            if commit is not None:
+                commit()
+        next_layer = layer._next
+        layer._p_deactivate()
+        layer = next_layer
+    return count
+
+
+def _unindexed(repo):
+    # True if ``repo`` predates its history index, or was pushed to (so
+    # creating the index) before being migrated.
+    if repo._index is None:
+        return True
+    count = sum(1 for x in repo.iterExport()
+                if isinstance(x, (dict, BuildRecord)))
+    return len(repo._index) < count
+
+
+def migrate(root, keep_raw=False, commit=None):
+    """Migrate every repo under ``root``, index its history and archive
+    layers (if it predates either index, or holds builds missing from its
+    history index), and record its newest item on the
+    status boards;  return the number of items converted.
+    """
+    count = 0
+    for owner_name in list(root.keys()):
+        owner = root[owner_name]
+        for repo_name in list(owner.keys()):
+            repo = owner[repo_name]
+            if isinstance(repo, Repo):
+                converted = migrate_repo(repo, keep_raw, commit)
+                if _unindexed(repo):
+                    repo.reindex()
+                if repo._archived is None:
+                    repo.index_layers()
+                repo.record_latest()
+                if commit is not None:
+                    commit()
+                logger.info('%s/%s: converted %d items',
+                            owner_name, repo_name, converted)
+                count += converted
+    return count
+
+
+def main(argv=sys.argv):  # pragma: no cover
+    """Console script:  migrate the configured database in place.
+    """
+    from pyramid.paster import bootstrap
+    from pyramid.paster import setup_logging
+    parser = argparse.ArgumentParser(
+        description='Rewrite stored Travis payloads as compact records.')
+    parser.add_argument('config_uri')
+    parser.add_argument('--keep-raw', action='store_true',
+                        help='Keep each full payload, compressed.')
+    args = parser.parse_args(argv[1:])
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+    try:
+        count = migrate(env['root'], args.keep_raw, transaction.commit)
+        transaction.commit()
+        logger.info('Converted %d items', count)
+    finally:
+        env['closer']()
@@ -1,42 +1,840 @@
+import calendar
+from collections import namedtuple
+import heapq
 import itertools
+from json import dumps
+from json import loads
+import os
+import threading
+import time
+import zlib
 
 from appendonly import AppendStack
 from appendonly import Archive
+from BTrees.Length import Length
+from BTrees.LLBTree import LLTreeSet
+from BTrees.LOBTree import LOBTree
+from BTrees.OLBTree import OLBTree
+from BTrees.OOBTree import OOBTree
 from persistent import Persistent
 from repoze.folder import Folder
 import transaction
+from ZODB.POSException import ConflictError
 
 
-class Root(Folder):
+FAILED_MESSAGES = ('broken', 'failed', 'still failing')
+
+
+def build_time(item):
+    """Return the ``finished_at`` time of a payload / record, in seconds
+    since the epoch (None if missing or unparseable).
+    """
+    finished_at = item.get('finished_at')
+    if not finished_at:
+        return None
+    try:
+        return calendar.timegm(time.strptime(finished_at,
+                                             '%Y-%m-%dT%H:%M:%SZ'))
+    except (TypeError, ValueError):
+        return None
+
+
+def status_summary(payload):
+    """Classify a Travis payload as 'OK', 'FAILED' or 'UNKNOWN'.
+    """
+    if payload.get('status') == 0:
+        return 'OK'
+    if (payload.get('status_message') or '').lower() in FAILED_MESSAGES:
+        return 'FAILED'
+    return 'UNKNOWN'
+
+
+RECORD_FIELDS = (
+    'id',
+    'number',
+    'type',
+    'status',
+    'status_message',
+    'branch',
+    'commit',
+    'compare_url',
+    'build_url',
+    'committer_name',
+    'committer_email',
+    'message',
+    'finished_at',
+    'repository_name',
+    'owner_name',
+    'raw',
+)
+
+
+class RawPayload(Persistent):
+    """A full Travis payload, as zlib-compressed JSON.
+
+    A persistent object of its own, so that the history layers holding
+    build records only pickle a reference to it, and reading history never
+    loads it.
+    """
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def fromPayload(cls, payload):
+        data = dumps(payload, sort_keys=True).encode('utf-8')
+        return cls(zlib.compress(data))
+
+    def load(self):
+        return loads(zlib.decompress(self.data).decode('utf-8'))
+
+
+class BuildRecord(namedtuple('BuildRecord', RECORD_FIELDS)):
+    """Compact, immutable record of the payload fields we actually use.
+
+    Stored in place of the decoded Travis payload (which carries the whole
+    build matrix and config).  ``raw`` optionally refers to the full
+    payload, stored on the side as a :class:`RawPayload` (records written
+    before that hold its compressed bytes inline).
+
+    Supports the mapping-style access used by templates (``record['commit']``)
+    for compatibility with histories still holding payload dicts.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def fromPayload(cls, payload, keep_raw=False):
+        repository = payload.get('repository') or {}
+        raw = None
+        if keep_raw:
+            raw = RawPayload.fromPayload(payload)
+        values = [payload.get(name) for name in RECORD_FIELDS[:-3]]
+        values.extend([repository.get('name'),
+                       repository.get('owner_name'),
+                       raw,
+                      ])
+        return cls(*values)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return super(BuildRecord, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    @property
+    def payload(self):
+        """The full payload, if it was kept;  else None.
+        """
+        raw = self.raw
+        if raw is None:
+            return None
+        if isinstance(raw, bytes):  # stored inline
+            return loads(zlib.decompress(raw).decode('utf-8'))
+        payload = raw.load()
+        raw._p_deactivate()  # e.g., don't fill the cache while exporting
+        return payload
+
+    def asDict(self):
+        """Return the full payload if kept, else the recorded fields.
+        """
+        payload = self.payload
+        if payload is not None:
+            return payload
+        info = dict(zip(RECORD_FIELDS[:-3], self))
+        info['repository'] = {'name': self.repository_name,
+                              'owner_name': self.owner_name,
+                             }
+        return info
+
+
+def as_record(item, keep_raw=False):
+    """Convert a stored payload dict to a :class:`BuildRecord`, and move
+    the inline raw payload of an older record to a :class:`RawPayload`.
+    """
+    if isinstance(item, dict):
+        return BuildRecord.fromPayload(item, keep_raw)
+    if isinstance(item, BuildRecord) and isinstance(item.raw, bytes):
+        return item._replace(raw=RawPayload(item.raw))
+    return item
+
+
+SUMMARY_FIELDS = (
+    'id',
+    'number',
+    'type',
+    'status',
+    'status_message',
+    'branch',
+    'commit',
+    'message',
+    'committer_name',
+    'build_url',
+    'finished_at',
+)
+
+
+class RepoIndex(Persistent):
+    """Compact secondary index over a repo's build history.
+
+    - Each entry is a tuple of the ``SUMMARY_FIELDS`` plus the status summary.
+
+    - Entries are keyed by their negated arrival time (in microseconds),
+      so that ascending iteration yields the newest entries first;  keys
+      double as pagination cursors.
+
+    - ``by_number``, ``by_branch`` and ``by_status`` map to entry keys, so
+      that filtered pages load only the BTree buckets they need.
+
+    - The trees are created by the first ``add``, so that unused shards of
+      a :class:`ShardedIndex` cost one small object each.
+    """
+    _entries = _by_number = _by_branch = _by_status = None
+
+    def __len__(self):
+        if self._entries is None:
+            return 0
+        return len(self._entries)
+
+    def add(self, payload, stamp=None, shard=0, shards=1):
+        """Index ``payload``;  return its key.
+
+        ``shard`` and ``shards`` are passed by :class:`ShardedIndex`:  keys
+        are then ``-(stamp * shards + shard)``, and so unique across shards.
+        """
+        if self._entries is None:
+            self._entries = LOBTree()
+            self._by_number = OLBTree()
+            self._by_branch = OOBTree()
+            self._by_status = OOBTree()
+        if stamp is None:
+            stamp = int(time.time() * 1000000)
+        key = -(stamp * shards + shard)
+        while key in self._entries:
+            key -= shards
+        status = status_summary(payload)
+        entry = tuple(payload.get(name) for name in SUMMARY_FIELDS)
+        self._entries[key] = entry + (status,)
+        number = payload.get('number')
+        if number is not None:
+            self._by_number[str(number)] = key
+        self._add_to(self._by_branch, payload.get('branch'), key)
+        self._add_to(self._by_status, status, key)
+        return key
+
+    def _add_to(self, tree, value, key):
+        keys = tree.get(value)
+        if keys is None:
+            keys = tree[value] = LLTreeSet()
+        keys.add(key)
+
+    def get(self, key):
+        if self._entries is None:
+            raise KeyError(key)
+        return _as_dict(self._entries[key])
+
+    def number_key(self, number):
+        """Return the key of the entry for build ``number``, or None.
+        """
+        if self._by_number is None:
+            return None
+        return self._by_number.get(str(number))
+
+    def by_number(self, number):
+        key = self.number_key(number)
+        if key is None:
+            return None
+        return self.get(key)
+
+    def keys(self, branch=None, status=None, cursor=None):
+        """Yield the keys of matching entries, newest first.
+        """
+        if self._entries is None:
+            return
+        filters = []
+        for tree, value in ((self._by_branch, branch),
+                            (self._by_status, status)):
+            if value is not None:
+                keys = tree.get(value)
+                if keys is None:
+                    return
+                filters.append(keys)
+
+        if filters:
+            primary, others = filters[0], filters[1:]
+        else:
+            primary, others = self._entries, ()
+
+        if cursor is None:
+            candidates = primary.keys()
+        else:
+            candidates = primary.keys(min=cursor, excludemin=True)
+
+        for key in candidates:
+            if not any(key not in other for other in others):
+                yield key
+
+    def query(self, branch=None, status=None, cursor=None, offset=0,
+              limit=20):
+        """Return ``(entries, next_cursor)``, newest first.
+
+        ``cursor`` is the ``next_cursor`` returned for the previous page;
+        ``next_cursor`` is None when there are no more entries.
+        """
+        return _page(self.keys(branch, status, cursor), self.get,
+                     offset, limit)
+
+    def prune(self, first):
+        """Remove the entries keyed ``first`` or greater (i.e., older);
+        return their number.
+        """
+        if self._entries is None:
+            return 0
+        keys = list(self._entries.keys(min=first))
+        number_at = SUMMARY_FIELDS.index('number')
+        branch_at = SUMMARY_FIELDS.index('branch')
+        for key in keys:
+            entry = self._entries.pop(key)
+            number = entry[number_at]
+            if (number is not None and
+                    self._by_number.get(str(number)) == key):
+                del self._by_number[str(number)]
+            self._remove_from(self._by_branch, entry[branch_at], key)
+            self._remove_from(self._by_status, entry[-1], key)
+        return len(keys)
+
+    def _remove_from(self, tree, value, key):
+        keys = tree.get(value)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del tree[value]
+
+
+def _page(keys, get, offset, limit):
+    found = []
+    for key in itertools.islice(keys, offset, None):
+        if len(found) == limit:
+            return [get(x) for x in found], found[-1]
+        found.append(key)
+    return [get(x) for x in found], None
+
+
+INDEX_SHARDS = 8
+
+_shard_counter = itertools.count(os.getpid())
+_shard_local = threading.local()
+
+
+def _local_shard(shards):
+    """Return this thread's shard number.
+
+    Threads are numbered round-robin (starting from the process ID, so that
+    processes sharing a database tend to use different shards).
+    """
+    number = getattr(_shard_local, 'number', None)
+    if number is None:
+        number = _shard_local.number = next(_shard_counter)
+    return number % shards
+
+
+class ShardedIndex(Persistent):
+    """A :class:`RepoIndex` split into shards, each written by one thread.
+
+    Appending to a single BTree from concurrent transactions conflicts
+    (every new key lands in the same bucket), and BTrees cannot resolve
+    conflicting inserts into a bucket which splits.  Each thread instead
+    adds to its own shard, so parallel webhooks for one repo write disjoint
+    objects;  queries merge the shards' key streams.
+
+    The shard which holds a key is ``-key % shards``.
+    """
+    def __init__(self, shards=INDEX_SHARDS):
+        self._shards = tuple(RepoIndex() for i in range(shards))
+
+    def __len__(self):
+        return sum(len(x) for x in self._shards)
+
+    def add(self, payload, stamp=None, shard=None):
+        """Index ``payload`` in ``shard`` (default: this thread's shard);
+        return its key.
+        """
+        shards = len(self._shards)
+        if shard is None:
+            shard = _local_shard(shards)
+        return self._shards[shard].add(payload, stamp, shard, shards)
+
+    def get(self, key):
+        return self._shards[-key % len(self._shards)].get(key)
+
+    def by_number(self, number):
+        keys = [x.number_key(number) for x in self._shards]
+        keys = [x for x in keys if x is not None]
+        if not keys:
+            return None
+        return self.get(min(keys))
+
+    def keys(self, branch=None, status=None, cursor=None):
+        return heapq.merge(*[x.keys(branch, status, cursor)
+                             for x in self._shards])
+
+    def query(self, branch=None, status=None, cursor=None, offset=0,
+              limit=20):
+        """See :meth:`RepoIndex.query`.
+        """
+        return _page(self.keys(branch, status, cursor), self.get,
+                     offset, limit)
+
+    def prune(self, keep):
+        """Remove all but the newest ``keep`` entries;  return the number
+        removed.
+        """
+        for first in itertools.islice(self.keys(), keep, keep + 1):
+            return sum(x.prune(first) for x in self._shards)
+        return 0
+
+
+DELIVERY_LOG_SIZE = 500
+DELIVERY_LOG_WINDOW = 86400  # seconds
+
+
+def _trim_deliveries(seen, max_entries, window, now):
+    if window:
+        for key, stamp in list(seen.items()):
+            if stamp + window <= now:
+                del seen[key]
+    if len(seen) > max_entries:
+        for key in heapq.nsmallest(len(seen) - max_entries, seen,
+                                   key=seen.get):
+            del seen[key]
+    return seen
+
+
+class DeliveryLog(Persistent):
+    """Bounded record of a repo's recently ingested deliveries.
+
+    Maps delivery keys (see ``dedupe.delivery_key``) to their arrival time,
+    keeping at most the newest ``max_entries``, none older than ``window``
+    seconds.  ``_p_resolveConflict`` merges concurrent additions.
+    """
+    def __init__(self, max_entries=DELIVERY_LOG_SIZE,
+                 window=DELIVERY_LOG_WINDOW):
+        self.max_entries = max_entries
+        self.window = window
+        self._seen = {}
+
+    def __len__(self):
+        return len(self._seen)
+
+    def __contains__(self, key):
+        stamp = self._seen.get(key)
+        if stamp is None:
+            return False
+        return not self.window or stamp + self.window > time.time()
+
+    def add(self, key, stamp=None):
+        if stamp is None:
+            stamp = time.time()
+        self._seen[key] = stamp
+        _trim_deliveries(self._seen, self.max_entries, self.window, stamp)
+        self._p_changed = True
+
+    def _p_resolveConflict(self, old, committed, new):
+        for name in ('max_entries', 'window'):
+            if not old[name] == committed[name] == new[name]:
+                raise ConflictError('Conflicting %s' % name)
+        old_seen = old['_seen']
+        seen = dict(committed['_seen'])
+        for key, stamp in new['_seen'].items():
+            if key not in old_seen:
+                seen[key] = max(stamp, seen.get(key, stamp))
+        if seen:
+            _trim_deliveries(seen, new['max_entries'], new['window'],
+                             max(seen.values()))
+        resolved = dict(committed)
+        resolved['_seen'] = seen
+        return resolved
+
+
+class RecentStack(AppendStack):
+    """``AppendStack`` holding a ``Repo``'s recent history.
+
+    ``AppendStack._p_resolveConflict`` merges concurrent pushes by pushing
+    the new items onto the committed state, cutting the result to
+    ``max_layers``:  a layer cut that way is never passed to the pruner, so
+    it would vanish rather than move to the archive.  Raise ConflictError
+    instead, so that the push is retried (only at a layer boundary).
+    """
+    def _p_resolveConflict(self, old, committed, new):
+        resolved = super(RecentStack, self)._p_resolveConflict(
+            old, committed, new)
+        c_layers, m_layers = committed[2], resolved[2]
+        if m_layers[-1][0] > c_layers[-1][0]:
+            raise ConflictError('Merged pushes overflow the recent stack')
+        return resolved
+
+
+LatestBuild = namedtuple('LatestBuild',
+                         ('status', 'branch', 'commit', 'number', 'stamp'))
+
+
+class StatusBoard(Persistent):
+    """Latest build of each of an owner's repos, by name.
+
+    Kept on each ``Owner`` (one board per owner, so that pushes to
+    different owners' repos share no object) and updated by
+    ``Repo.pushItem``, so that the owner's and home pages can show every
+    repo's status without loading the repos.  Entries are stored as plain
+    tuples;  concurrent updates are merged, keeping the newest entry (by
+    build time) for each name.  ``changes`` counts updates (merging
+    concurrent ones), and serves as part of the modification serials.
+    """
+    changes = 0
+
+    def __init__(self):
+        self._latest = {}
+
+    def __len__(self):
+        return len(self._latest)
+
+    def get(self, name):
+        entry = self._latest.get(name)
+        return entry is not None and LatestBuild(*entry) or None
+
+    def items(self):
+        """Return ``(name, LatestBuild)`` pairs, sorted by name.
+        """
+        return [(name, LatestBuild(*entry))
+                for name, entry in sorted(self._latest.items())]
+
+    def update(self, name, latest):
+        """Record ``latest`` for ``name``, unless an entry at least as new
+        is already recorded.  Return True if recorded.
+        """
+        current = self._latest.get(name)
+        if current is not None and current[-1] > latest.stamp:
+            return False
+        self._latest[name] = tuple(latest)
+        self.changes += 1
+        return True
+
+    def _p_resolveConflict(self, old, committed, new):
+        old_latest = old['_latest']
+        latest = dict(committed['_latest'])
+        for name, entry in new['_latest'].items():
+            if old_latest.get(name) == entry:
+                continue  # not changed by this transaction
+            current = latest.get(name)
+            if current is None or current[-1] <= entry[-1]:
+                latest[name] = entry
+        resolved = dict(committed)
+        resolved['_latest'] = latest
+        resolved['changes'] = (committed.get('changes', 0) +
+                               new.get('changes', 0) - old.get('changes', 0))
+        return resolved
+
+
+# Callables ``listener(resource, txn, below)``, told of each change to
+# ``resource`` (and, if ``below``, to the resources below it) made in
+# ``txn``, e.g. to invalidate cached pages once it commits:  see
+# ``.pagecache``.
+change_listeners = []
+
+
+def _transaction_of(resource):
+    # The transaction of the connection holding ``resource`` (or its nearest
+    # persistent parent), which is not the thread's default one for
+    # connections opened with a transaction manager of their own.
+    while resource is not None:
+        jar = getattr(resource, '_p_jar', None)
+        if jar is not None:
+            return jar.transaction_manager.get()
+        resource = getattr(resource, '__parent__', None)
+    return transaction.get()
+
+
+def notify_changed(resource, below=True):
+    """Tell the ``change_listeners`` that ``resource`` changed.
+    """
+    if not change_listeners:
+        return
+    txn = _transaction_of(resource)
+    for listener in change_listeners:
+        listener(resource, txn, below)
+
+
+class _Modified(object):
+    """Mixin:  track a modification serial for HTTP validators.
+
+    The serial is a ``BTrees.Length.Length``, whose conflict resolution
+    merges concurrent increments;  its ``_p_mtime`` is the time of the last
+    committed change.
+    """
+    _serial = None  # created on demand for objects predating it
+
+    def bump(self):
+        if self._serial is None:
+            self._serial = Length()
+        self._serial.change(1)
+        notify_changed(self)
+
+    @property
+    def serial(self):
+        if self._serial is None:
+            return 0
+        return self._serial()
+
+    @property
+    def modified(self):
+        if self._serial is None:
+            return None
+        return self._serial._p_mtime
+
+
+class _Boarded(object):
+    """Mixin:  count updates to the status boards below (see
+    :class:`StatusBoard`) towards the modification serial, rather than
+    bumping it, so that pushes to different repos conflict only on a board
+    (which resolves them).
+    """
+    def _boards(self):
+        raise NotImplementedError
+
+    @property
+    def serial(self):
+        serial = super(_Boarded, self).serial
+        return serial + sum(x.changes for x in self._boards())
+
+    @property
+    def modified(self):
+        modified = super(_Boarded, self).modified
+        for board in self._boards():
+            if board._p_mtime is not None:
+                modified = max(modified or 0, board._p_mtime)
+        return modified
+
+
+class Root(_Boarded, _Modified, Folder):
 
     __parent__ = __name__ = None
 
+    def _boards(self):
+        return [x._board for x in self.values()
+                if getattr(x, '_board', None) is not None]
+
+    def latest(self):
+        """Return ``('owner/repo', LatestBuild)`` pairs from the owners'
+        boards.
+        """
+        return [('%s/%s' % (owner_name, name), latest)
+                for owner_name, owner in sorted(self.items())
+                if isinstance(owner, Owner)
+                for name, latest in owner.latest()]
+
     def find_create(self, name):
         if name not in self:
             owner = self[name] = Owner()
             owner.__name__ = name
             owner.__parent__ = self
+            self.bump()
         return self[name]
 
 
-class Owner(Folder):
+class Owner(_Boarded, _Modified, Folder):
+
+    _board = None  # created on demand
+
+    def _boards(self):
+        return self._board is not None and [self._board] or []
+
+    @property
+    def board(self):
+        if self._board is None:
+            self._board = StatusBoard()
+        return self._board
+
+    def latest(self):
+        """Return the board's ``(name, LatestBuild)`` pairs (without
+        creating it).
+        """
+        if self._board is None:
+            return []
+        return self._board.items()
 
     def find_create(self, name):
         if name not in self:
             repo = self[name] = Repo()
             repo.__name__ = name
             repo.__parent__ = self
+            self.bump()
         return self[name]
 
 
-class Repo(Persistent):
+def _layer_time(layer):
+    # The latest ``finished_at`` of the builds in ``layer`` (None if none).
+    # Unlike ``_p_mtime``, it survives rewriting the layer (see ``.migrate``).
+    times = [build_time(x) for x in layer._stack
+             if isinstance(x, (dict, BuildRecord))]
+    times = [x for x in times if x is not None]
+    return max(times) if times else None
+
+
+def _as_dict(entry):
+    info = dict(zip(SUMMARY_FIELDS, entry))
+    info['summary'] = entry[-1]
+    return info
+
+
+class Repo(_Modified, Persistent):
+
+    __parent__ = __name__ = None
+    _index = None  # created on demand for repos predating the index
+    _deliveries = None  # ditto
+    _archived = None  # ditto:  generation -> archive layer, see index_layers
+    recent_layers = 10  # see configure_history
+    layer_size = 100
 
     def __init__(self):
-        self._recent = AppendStack()
+        self._recent = RecentStack(self.recent_layers, self.layer_size)
         self._archive = Archive()
+        self._index = ShardedIndex()
+        self._deliveries = DeliveryLog()
+        self._archived = LOBTree()
+        self._serial = Length()
+
+    def _archive_layer(self, generation, items):
+        self._archive.addLayer(generation, items)
+        if self._archived is not None:
+            self._archived[generation] = self._archive._head
 
-    def pushItem(self, object):
-        self._recent.push(object, self._archive.addLayer)
+    def index_layers(self):
+        """Rebuild the index of archive layers by generation, which lets
+        :meth:`page` start at the layer holding its cursor.
+        """
+        archived = self._archived = LOBTree()
+        layer = self._archive._head
+        while layer is not None:
+            archived[layer._generation] = layer
+            next_layer = layer._next
+            layer._p_deactivate()
+            layer = next_layer
+        return archived
+
+    def pushItem(self, object, delivery=None):
+        """Append ``object``;  record ``delivery`` (a delivery key), if
+        passed, for :meth:`seen`.
+        """
+        self._recent.push(object, self._archive_layer)
+        if isinstance(object, (dict, BuildRecord)):
+            self.index.add(object)
+            self.record_latest(object)
+        if delivery is not None:
+            if self._deliveries is None:
+                self._deliveries = DeliveryLog()
+            self._deliveries.add(delivery)
+        self.bump()
+
+    def record_latest(self, item=None, stamp=None):
+        """Record ``item`` (by default, the newest stored) as the latest
+        build on the owner's status board, unless a build which finished
+        later is already recorded.
+
+        ``stamp`` defaults to the build's ``finished_at`` (or, for builds
+        not finished, the current time).
+        """
+        if item is None:
+            items, cursor = self.page(limit=1)
+            if not items:
+                return
+            item = items[0]
+        if stamp is None:
+            stamp = build_time(item)
+            if stamp is None:
+                stamp = time.time()
+        latest = LatestBuild(status_summary(item), item.get('branch'),
+                             item.get('commit'), item.get('number'), stamp)
+        owner = self.__parent__
+        if not isinstance(owner, Owner):
+            return
+        if owner.board.update(self.__name__, latest):
+            notify_changed(owner, below=False)
+            root = owner.__parent__
+            if isinstance(root, Root):
+                notify_changed(root, below=False)
+
+    def seen(self, delivery):
+        """Has the delivery with key ``delivery`` been pushed recently?
+        """
+        return self._deliveries is not None and delivery in self._deliveries
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = ShardedIndex()
+        return self._index
+
+    def reindex(self):
+        """Rebuild the index from the stored history, preserving its order.
+        """
+        index = self._index = ShardedIndex()
+        items = [x for x in self if isinstance(x, (dict, BuildRecord))]
+        stamp = int(time.time() * 1000000) - len(items)
+        for offset, item in enumerate(reversed(items)):
+            index.add(item, stamp + offset, shard=0)
+        return index
+
+    def prune(self, keep=None, before=None):
+        """Drop archive layers beyond the newest ``keep`` items, or whose
+        builds all finished before ``before`` (a timestamp), and the matching
+        index entries.
+
+        Layers are dropped whole, so at least ``keep`` items remain;  the
+        index keeps as many entries as there are items left.  Layers with
+        no ``finished_at`` are kept, unless older than a dropped one.
+        Return the number of items dropped.
+        """
+        kept = sum(len(x._stack) for x in self._recent._layers)
+        previous, layer = None, self._archive._head
+        while layer is not None:
+            if keep is not None and kept >= keep:
+                break
+            finished = _layer_time(layer)
+            if (before is not None and finished is not None and
+                    finished < before):
+                break
+            kept += len(layer._stack)
+            previous, layer = layer, layer._next
+        dropped = 0
+        if layer is not None:
+            if self._archived is not None:
+                for generation in list(self._archived.keys(
+                        max=layer._generation)):
+                    del self._archived[generation]
+            if previous is None:
+                self._archive._head = None
+            else:
+                previous._next = None
+            while layer is not None:
+                dropped += len(layer._stack)
+                next_layer = layer._next
+                layer._p_deactivate()
+                layer = next_layer
+        if dropped:
+            if self._index is not None:
+                self._index.prune(kept)
+            self.bump()
+        return dropped
+
+    def history(self, **kw):
+        """See :meth:`ShardedIndex.query`.
+        """
+        return self.index.query(**kw)
 
     @property
     def recent(self):
@@ -51,10 +849,81 @@ class Repo(Persistent):
     def __iter__(self):
         return itertools.chain(self.recent, self.archive)
 
+    def _iter_older(self, cursor=None):
+        # Yield ``(generation, index, item)``, newest first, for the items
+        # older than ``cursor``, deactivating each archive layer once read.
+        # The archive is entered at the layer holding ``cursor``, found in
+        # ``_archived``, rather than by loading every newer layer.
+        for layer in self._recent._layers:
+            if cursor is not None and layer._generation > cursor[0]:
+                continue
+            for index, item in layer:
+                if cursor is None or (layer._generation, index) < cursor:
+                    yield layer._generation, index, item
+        layer = self._archive._head
+        if cursor is not None and self._archived is not None:
+            try:
+                layer = self._archived[self._archived.maxKey(cursor[0])]
+            except ValueError:  # older than any archived layer
+                layer = None
+        while layer is not None:
+            if cursor is None or layer._generation <= cursor[0]:
+                for index, item in layer:
+                    if cursor is None or (layer._generation, index) < cursor:
+                        yield layer._generation, index, item
+            next_layer = layer._next
+            layer._p_deactivate()
+            layer = next_layer
+
+    def page(self, cursor=None, limit=20):
+        """Return up to ``limit`` items, newest first, from the recent
+        history and then the archive, and the cursor for the next page
+        (None if there are no more).
+
+        Cursors are ``(generation, index)`` pairs, which stay valid as
+        layers move to the archive:  pass one to get the items older than
+        it.
+        """
+        items = []
+        last = None
+        for generation, index, item in self._iter_older(cursor):
+            if len(items) == limit:
+                return items, last
+            items.append(item)
+            last = (generation, index)
+        return items, None
+
+    def iterExport(self):
+        """Yield every stored item, newest first.
+
+        Unlike ``__iter__``, deactivate each archive layer once its items
+        have been yielded, so that memory stays flat for long histories.
+        """
+        for item in self.recent:
+            yield item
+        layer = self._archive._head
+        while layer is not None:
+            for index, item in layer:
+                yield item
+            next_layer = layer._next
+            layer._p_deactivate()
+            layer = next_layer
+
+
+def configure_history(settings):
+    """Size the recent history of repos created from now on:
+    ``travis_notify.recent_layers`` layers of ``travis_notify.layer_size``
+    items each;  older items are moved to the repo's archive.
+    """
+    Repo.recent_layers = int(settings.get('travis_notify.recent_layers',
+                                          Repo.recent_layers))
+    Repo.layer_size = int(settings.get('travis_notify.layer_size',
+                                       Repo.layer_size))
+
 
 def appmaker(zodb_root):
+    """Return the application root, adding it (uncommitted) if needed.
+    """
     if not 'app_root' in zodb_root:
-        app_root = Root()
-        zodb_root['app_root'] = app_root
-        transaction.commit()
+        zodb_root['app_root'] = Root()
     return zodb_root['app_root']
@@ -0,0 +1,192 @@
+""" In-process cache of rendered pages for the read views.
+
+The tween sits directly below the WSGI ingress, so a cache hit (or a 304
+for a client holding the entry's ETag / Last-Modified) is served without
+opening a ZODB connection or beginning a transaction.
+
+Entries are keyed by path and query string, and keep the validators set
+by the view (see ``views.check_not_modified``), falling back to a digest
+of the body and the time cached.  When the cache is enabled,
+:func:`invalidate_on_commit` is registered among the models'
+``change_listeners``, which ``Root.find_create``, ``Owner.find_create`` and
+``Repo.pushItem`` notify:  it drops the entries for the changed resource
+(and its views) once the transaction commits.  Other processes sharing the
+database do not see those invalidations, so entries also expire after
+``travis_notify.page_cache_ttl`` seconds.
+"""
+from collections import OrderedDict
+from hashlib import md5
+import threading
+import time
+
+from pyramid.response import Response
+from pyramid.settings import asbool
+from pyramid.tweens import INGRESS
+from pyramid.traversal import resource_path
+import transaction
+
+from .models import change_listeners
+
+CACHEABLE_TYPES = ('text/html', 'application/json')
+
+
+class CacheEntry(object):
+
+    def __init__(self, status, headerlist, body, cached_at,
+                 etag=None, last_modified=None):
+        self.status = status
+        self.headerlist = headerlist
+        self.body = body
+        self.cached_at = cached_at
+        if etag is None:
+            etag = md5(body).hexdigest()
+        self.etag = etag
+        if last_modified is None:
+            last_modified = int(cached_at)
+        self.last_modified = last_modified
+
+    def decorate(self, response):
+        response.etag = self.etag
+        response.last_modified = self.last_modified
+        response.conditional_response = True
+
+    def respond(self):
+        response = Response(status=self.status,
+                            headerlist=list(self.headerlist),
+                            body=self.body)
+        self.decorate(response)
+        return response
+
+
+def _path_of(key):
+    return key.split('?', 1)[0].rstrip('/') or '/'
+
+
+class PageCache(object):
+    """Bounded LRU of rendered responses, with generation-checked writes.
+    """
+    def __init__(self, max_entries=1000, ttl=300, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self.ttl and entry.cached_at + self.ttl <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, response, generation):
+        """Cache ``response`` under ``key``, unless an invalidation has
+        happened since ``generation`` was read (the response may then have
+        been rendered from stale state).  Return the entry, or None.
+        """
+        headerlist = [(name, value) for name, value in response.headerlist
+                      if name.lower() not in ('set-cookie', 'etag',
+                                              'last-modified')]
+        last_modified = response.last_modified
+        if last_modified is not None:
+            last_modified = int(last_modified.timestamp())
+        entry = CacheEntry(response.status, headerlist, response.body,
+                           self.clock(), response.etag, last_modified)
+        with self._lock:
+            if generation != self.generation:
+                return None
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, path, below=True):
+        """Drop entries for ``path`` and (if ``below``) any path below it.
+        """
+        path = path.rstrip('/') or '/'
+        prefix = path == '/' and '/' or path + '/'
+        with self._lock:
+            self.generation += 1
+            for key in list(self._entries):
+                key_path = _path_of(key)
+                if key_path == path or (below and
+                                        key_path.startswith(prefix)):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+_cache = PageCache()
+
+
+def get_page_cache():
+    return _cache
+
+
+def invalidate_on_commit(resource, txn=None, below=True):
+    """Invalidate ``resource``'s cached pages (and, if ``below``, those of
+    the resources below it) if the transaction commits.
+    """
+    path = resource_path(resource)
+
+    def _hook(succeeded):
+        if succeeded:
+            _cache.invalidate(path, below)
+
+    if txn is None:
+        txn = transaction.get()
+    txn.addAfterCommitHook(_hook)
+
+
+def _cacheable(response):
+    return (response.status_int == 200 and
+            response.content_type in CACHEABLE_TYPES and
+            response.content_disposition is None)
+
+
+def page_cache_tween_factory(handler, registry):
+    settings = registry.settings
+    if not asbool(settings.get('travis_notify.page_cache', False)):
+        return handler
+    _cache.max_entries = int(settings.get('travis_notify.page_cache_size',
+                                          _cache.max_entries))
+    _cache.ttl = float(settings.get('travis_notify.page_cache_ttl',
+                                    _cache.ttl))
+
+    def page_cache_tween(request):
+        if request.method not in ('GET', 'HEAD'):
+            return handler(request)
+        key = request.path_qs
+        entry = _cache.get(key)
+        if entry is not None:
+            return entry.respond()
+        generation = _cache.generation
+        response = handler(request)
+        if _cacheable(response):
+            entry = _cache.set(key, response, generation)
+            if entry is not None:
+                entry.decorate(response)
+        return response
+
+    return page_cache_tween
+
+
+def includeme(config):
+    config.add_tween('travis_notify.pagecache.page_cache_tween_factory',
+                     under=INGRESS)
+    settings = config.get_settings()
+    if (asbool(settings.get('travis_notify.page_cache', False)) and
+            invalidate_on_commit not in change_listeners):
+        change_listeners.append(invalidate_on_commit)
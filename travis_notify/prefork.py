@@ -0,0 +1,337 @@
+""" Pre-fork, multi-process deployment.
+
+A single waitress process serializes ingest and rendering on one GIL.
+``travis_notify_serve`` instead opens the listening socket once, then forks
+``--workers`` processes, each loading the application and serving that
+socket with its own waitress thread pool;  the kernel spreads connections
+across them.
+
+A FileStorage can only be opened by one process, so the workers must share
+the database through a server:  with ``--zeo-conf``, the supervisor also
+forks a ZEO server (see ``zeo.conf``), which becomes the single writer
+owning ``Data.fs``, and the workers connect to it as clients
+(``zodbconn.uri = zeo://...``).  Each worker's client cache serves reads
+locally;  commits are funnelled through the server, which resolves
+conflicts between workers.  A RelStorage ``zodbconn.uri`` works without
+``--zeo-conf``.
+
+The supervisor restarts any worker (or the ZEO server) that exits, after
+a delay doubling with each exit in a row that came soon after its start
+(so that a worker failing at import time cannot fork-bomb the host), and
+gives up on it after ``--max-restarts`` such exits;  it stops them all on
+SIGTERM / SIGINT.
+
+Some state is kept per process, and so is not shared by the workers:
+
+- the page cache (``travis_notify.page_cache``):  a commit invalidates the
+  entries of its own worker only;  the others serve their cached pages
+  (and answer conditional GETs for them) until
+  ``travis_notify.page_cache_ttl`` expires them.
+
+- the digest buffers (``travis_notify.digest_window``):  notifications for
+  the same commit handled by different workers go out as separate digests
+  (each worker journals its own, see ``.digest``).
+
+- the recently-committed deliveries (``travis_notify.dedupe_cache_size``):
+  only a fast path;  redeliveries handled by another worker are still
+  dropped, via the repo's own delivery log.
+
+``travis_notify_serve`` warns about the first two when forking several
+workers.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from urllib.parse import urlsplit
+
+from pyramid.settings import asbool
+
+logger = logging.getLogger('travis_notify.prefork')
+
+SHARED_SCHEMES = ('zeo', 'postgres', 'mysql', 'oracle', 'sqlite')
+
+
+def parse_address(value, default_host='0.0.0.0'):
+    """Parse ``host:port`` (or ``port``) into ``(host, port)``.
+    """
+    host, sep, port = value.rpartition(':')
+    return host or default_host, int(port)
+
+
+def zeo_address(uri):
+    """Return the server address of a ``zeo://`` URI, or None.
+
+    The address is ``(host, port)``, or the path of a UNIX socket.
+    """
+    parts = urlsplit(uri)
+    if parts.scheme != 'zeo':
+        return None
+    if parts.hostname is None:
+        return parts.path
+    return parts.hostname, parts.port or 9100
+
+
+def check_storage(uri, workers):
+    """Raise ValueError unless ``workers`` processes can share ``uri``.
+    """
+    scheme = urlsplit(uri).scheme
+    if workers > 1 and scheme not in SHARED_SCHEMES:
+        raise ValueError(
+            "%d workers cannot share a '%s' storage;  use a ZEO server "
+            "(zeo://, see --zeo-conf) or RelStorage" % (workers, scheme))
+
+
+def per_process_warnings(settings):
+    """Return warnings about the features enabled in ``settings`` which
+    keep state per process (see above).
+    """
+    warnings = []
+    if asbool(settings.get('travis_notify.page_cache', False)):
+        warnings.append(
+            'travis_notify.page_cache is per worker:  other workers serve '
+            'stale pages for up to travis_notify.page_cache_ttl (%s) '
+            'seconds after a change' %
+            settings.get('travis_notify.page_cache_ttl', 300))
+    if float(settings.get('travis_notify.digest_window', 0)):
+        warnings.append(
+            'travis_notify.digest_window is per worker:  notifications for '
+            'one commit handled by several workers mail several digests')
+    return warnings
+
+
+def listen(address, backlog=1024):
+    """Return a listening socket, bound to ``address``, which forked
+    workers inherit.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def wait_for(address, timeout=30.0, interval=0.1,
+             clock=time.monotonic, sleep=time.sleep):
+    """Block until ``address`` accepts connections;  raise RuntimeError
+    after ``timeout`` seconds.
+    """
+    family = socket.AF_INET
+    if isinstance(address, str):
+        family = socket.AF_UNIX
+    deadline = clock() + timeout
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+            return
+        except OSError:
+            if clock() >= deadline:
+                raise RuntimeError('%s not listening after %.0fs'
+                                   % (address, timeout))
+            sleep(interval)
+        finally:
+            sock.close()
+
+
+class Supervisor(object):
+    """Fork named child processes, and restart them when they exit.
+
+    A child exiting within ``stable_after`` seconds of its start is
+    restarted after ``backoff`` seconds, doubled for each such exit in a
+    row (up to ``max_backoff``);  after ``max_restarts`` of them, it is
+    given up on (see ``failed``).
+    """
+    def __init__(self, fork=os.fork, waitpid=os.waitpid, kill=os.kill,
+                 exit=os._exit, clock=time.monotonic, sleep=time.sleep,
+                 backoff=1.0, max_backoff=60.0, max_restarts=10,
+                 stable_after=60.0):
+        self._fork = fork
+        self._waitpid = waitpid
+        self._kill = kill
+        self._exit = exit
+        self._clock = clock
+        self._sleep = sleep
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_restarts = max_restarts
+        self.stable_after = stable_after
+        self._targets = {}
+        self._started = {}  # name -> when last started
+        self._failures = {}  # name -> early exits in a row
+        self.children = {}  # pid -> name
+        self.pending = {}  # name -> when due to restart
+        self.failed = set()  # names given up on
+        self.stopping = False
+
+    def spawn(self, name, target):
+        """Fork a child running ``target()``;  return its pid.
+        """
+        self._targets[name] = target
+        pid = self._fork()
+        if pid == 0:  # pragma: no cover  (child)
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                target()
+            except BaseException:
+                logger.exception('%s failed', name)
+                code = 1
+            finally:
+                self._exit(code)
+        self.children[pid] = name
+        self._started[name] = self._clock()
+        logger.info('Started %s (pid %d)', name, pid)
+        return pid
+
+    def reap(self, block=True):
+        """Wait for a child to exit (or, unless ``block``, check whether one
+        has), and schedule its restart unless stopping.
+
+        Return its pid, or None if none has exited (or none is left).
+        """
+        try:
+            pid, status = self._waitpid(-1, block and 0 or os.WNOHANG)
+        except ChildProcessError:
+            self.children.clear()
+            return None
+        if pid == 0:
+            return None
+        name = self.children.pop(pid, None)
+        if name is not None and not self.stopping:
+            self.schedule_restart(name, pid, status)
+        return pid
+
+    def schedule_restart(self, name, pid, status):
+        now = self._clock()
+        if now - self._started.get(name, now) >= self.stable_after:
+            self._failures[name] = 0
+        failures = self._failures[name] = self._failures.get(name, 0) + 1
+        if failures > self.max_restarts:
+            logger.error('%s (pid %d) exited with status %d, %d times in a '
+                         'row;  giving up', name, pid, status, failures)
+            self.failed.add(name)
+            return
+        delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+        logger.warning('%s (pid %d) exited with status %d;  restarting in '
+                       '%.1fs', name, pid, status, delay)
+        self.pending[name] = now + delay
+
+    def restart_due(self):
+        """Restart the children whose delay has elapsed;  return the seconds
+        until the next restart is due (None if none is pending).
+        """
+        now = self._clock()
+        for name, due in sorted(self.pending.items()):
+            if due <= now:
+                del self.pending[name]
+                self.spawn(name, self._targets[name])
+        if not self.pending:
+            return None
+        return max(0.0, min(self.pending.values()) - now)
+
+    def stop(self, signum=signal.SIGTERM):
+        """Signal every child to exit;  ``reap`` no longer restarts them.
+        """
+        self.stopping = True
+        self.pending.clear()
+        for pid in list(self.children):
+            try:
+                self._kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def run(self, poll_interval=0.5):
+        """Supervise the children until all have exited (and none is due
+        to restart).
+        """
+        while self.children or self.pending:
+            wait = self.restart_due()
+            if wait is None:
+                self.reap()
+            elif self.reap(block=False) is None:
+                self._sleep(min(wait, poll_interval))
+
+
+def run_writer(zeo_conf):  # pragma: no cover
+    """Child target:  run the ZEO server configured by ``zeo_conf``.
+    """
+    from ZEO.runzeo import main
+    main(['-C', zeo_conf])
+
+
+def run_worker(config_uri, sock, threads):  # pragma: no cover
+    """Child target:  load the application and serve ``sock``.
+    """
+    from pyramid.paster import get_app
+    import waitress
+    app = get_app(config_uri)
+    waitress.serve(app, sockets=[sock], threads=threads)
+
+
+def main(argv=sys.argv):  # pragma: no cover
+    """Console script:  serve the application from several processes.
+    """
+    import plaster
+    from pyramid.paster import get_appsettings
+    from pyramid.paster import setup_logging
+    parser = argparse.ArgumentParser(
+        description='Serve travis_notify from pre-forked worker processes.')
+    parser.add_argument('config_uri')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2,
+                        help='Worker processes (default: one per CPU).')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Threads per worker (default: the '
+                             "[server:main] section's, or 4).")
+    parser.add_argument('--listen', default=None,
+                        help='host:port (default: the [server:main] '
+                             "section's).")
+    parser.add_argument('--zeo-conf', default=None,
+                        help='Also run the ZEO server configured by this '
+                             'file, as the single writer.')
+    parser.add_argument('--max-restarts', type=int, default=10,
+                        help='Give up on a process after this many exits '
+                             'in a row soon after starting (default: 10).')
+    args = parser.parse_args(argv[1:])
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    uri = settings.get('zodbconn.uri', '')
+    check_storage(uri, args.workers)
+    if args.workers > 1:
+        for warning in per_process_warnings(settings):
+            logger.warning(warning)
+    server = plaster.get_settings(args.config_uri, 'server:main')
+    if args.listen is not None:
+        address = parse_address(args.listen)
+    else:
+        address = (server.get('host', '0.0.0.0'),
+                   int(server.get('port', 6543)))
+    threads = args.threads or int(server.get('threads', 4))
+    sock = listen(address)
+
+    supervisor = Supervisor(max_restarts=args.max_restarts)
+
+    def _stop(signum, frame):
+        supervisor.stop()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    if args.zeo_conf is not None:
+        writer = zeo_address(uri)
+        if writer is None:
+            parser.error('--zeo-conf requires a zeo:// zodbconn.uri')
+        supervisor.spawn('writer', lambda: run_writer(args.zeo_conf))
+        wait_for(writer)
+    for number in range(args.workers):
+        supervisor.spawn('worker-%d' % number,
+                         lambda: run_worker(args.config_uri, sock, threads))
+    logger.info('Serving on http://%s:%d with %d workers x %d threads',
+                address[0], address[1], args.workers, threads)
+    supervisor.run()
+    if supervisor.failed:
+        return 1
@@ -0,0 +1,224 @@
+""" Opt-in profiling of live requests, as a paste filter.
+
+:class:`ProfilerMiddleware` profiles a random sample of requests
+(``sample_rate``, from 0 to 1) with :mod:`cProfile`, writing a
+:mod:`pstats` dump (``*.prof``) for each;  and, given ``threshold_ms``,
+samples the stacks of requests running longer than that from a background
+thread (every ``interval_ms``), writing the stacks of those which end up
+slower than the threshold in the "collapsed" format read by
+``flamegraph.pl`` and speedscope (``*.stacks``).
+
+Dumps are written to ``dump_dir``, once the response has been sent, named
+by time, process, method, path and duration;  only the newest
+``max_dumps`` are kept.  When neither kind of profiling is in progress, a
+request costs a random number and (given a threshold) two dictionary
+updates.
+"""
+from collections import Counter
+import cProfile
+import itertools
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+_UNSAFE = re.compile(r'[^A-Za-z0-9_.-]+')
+SUFFIXES = ('.prof', '.stacks')
+
+
+def collapse(frame):
+    """Return the stack of ``frame``, outermost first, in collapsed form.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s)' % (code.co_name, code.co_filename))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler(object):
+    """Sample the stacks of threads whose request has run for at least
+    ``threshold`` seconds, every ``interval`` seconds, from a thread of its
+    own (which waits while no request is running).
+    """
+    def __init__(self, threshold, interval=0.005, clock=time.perf_counter):
+        self.threshold = threshold
+        self.interval = interval
+        self.clock = clock
+        self._active = {}  # thread id -> (start, Counter of stacks)
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def begin(self):
+        """Start tracking the current thread's request;  return its entry.
+        """
+        ident = threading.get_ident()
+        entry = (self.clock(), Counter())
+        with self._cond:
+            self._active[ident] = entry
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self.run, name='travis_notify-stack-sampler')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return ident, entry
+
+    def end(self, ident):
+        """Stop tracking the request of thread ``ident``.
+        """
+        with self._cond:
+            self._active.pop(ident, None)
+
+    def sample(self):
+        """Record the stacks of the requests running for too long.
+        """
+        now = self.clock()
+        frames = None
+        for ident, (start, stacks) in list(self._active.items()):
+            if now - start < self.threshold:
+                continue
+            if frames is None:
+                frames = sys._current_frames()
+            frame = frames.get(ident)
+            if frame is not None:
+                stacks[collapse(frame)] += 1
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._cond.wait()
+            time.sleep(self.interval)
+            self.sample()
+
+
+class _ClosingIterable(object):
+    """Wrap ``app_iter``, calling ``done()`` once it is closed.
+    """
+    def __init__(self, app_iter, done):
+        self.app_iter = app_iter
+        self.done = done
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            close = getattr(self.app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.done()
+
+
+class ProfilerMiddleware(object):
+    """Profile sampled or slow requests (see module doc).
+    """
+    def __init__(self, application, dump_dir, sample_rate=0.0,
+                 threshold=None, interval=0.005, max_dumps=100,
+                 random=random.random, clock=time.perf_counter):
+        if not os.path.isdir(dump_dir):
+            os.makedirs(dump_dir)
+        self.application = application
+        self.dump_dir = dump_dir
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.max_dumps = max_dumps
+        self.random = random
+        self.clock = clock
+        self.sampler = None
+        if threshold is not None:
+            self.sampler = StackSampler(threshold, interval, clock)
+        # Only one cProfile profiler may be active at a time.
+        self._profiling = threading.Lock()
+        self._sequence = itertools.count()
+        self._dump_lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        profile = None
+        if (self.sample_rate and self.random() < self.sample_rate and
+                self._profiling.acquire(False)):
+            profile = cProfile.Profile()
+            profile.enable()
+        tracked = None
+        if self.sampler is not None:
+            tracked = self.sampler.begin()
+        start = self.clock()
+
+        def done():
+            elapsed = self.clock() - start
+            if profile is not None:
+                profile.disable()
+                self._profiling.release()
+                self.dump(environ, elapsed, '.prof', profile.dump_stats)
+            if tracked is not None:
+                ident, (started, stacks) = tracked
+                self.sampler.end(ident)
+                if elapsed >= self.threshold and stacks:
+                    self.dump(environ, elapsed, '.stacks',
+                              lambda path: self.write_stacks(path, stacks))
+
+        try:
+            app_iter = self.application(environ, start_response)
+        except Exception:
+            done()
+            raise
+        return _ClosingIterable(app_iter, done)
+
+    def dump_name(self, environ, elapsed, suffix):
+        path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        path = _UNSAFE.sub('_', path).strip('_')[:60] or 'root'
+        return '%s-%d-%06d-%s-%s-%dms%s' % (
+            time.strftime('%Y%m%dT%H%M%S'), os.getpid(),
+            next(self._sequence), environ.get('REQUEST_METHOD', '-'),
+            path, elapsed * 1000, suffix)
+
+    def dump(self, environ, elapsed, suffix, write):
+        """Write a dump via ``write(path)``, then rotate the directory.
+        """
+        path = os.path.join(self.dump_dir,
+                            self.dump_name(environ, elapsed, suffix))
+        write(path)
+        with self._dump_lock:
+            self.rotate()
+
+    @staticmethod
+    def write_stacks(path, stacks):
+        with open(path, 'w') as f:
+            for stack, count in sorted(stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+
+    def rotate(self):
+        """Remove all but the newest ``max_dumps`` dumps.
+        """
+        dumps = sorted(x for x in os.listdir(self.dump_dir)
+                       if x.endswith(SUFFIXES))
+        for name in dumps[:-self.max_dumps or None]:
+            try:
+                os.remove(os.path.join(self.dump_dir, name))
+            except FileNotFoundError:  # removed by another process
+                pass
+
+
+def make_filter(
+    app, global_conf,
+    dump_dir,
+    sample_rate=0.0,
+    threshold_ms=None,
+    interval_ms=5,
+    max_dumps=100):
+    """Paste filter factory for :class:`ProfilerMiddleware`.
+    """
+    threshold = None
+    if threshold_ms not in (None, ''):
+        threshold = float(threshold_ms) / 1000
+    return ProfilerMiddleware(
+        app, dump_dir,
+        sample_rate=float(sample_rate),
+        threshold=threshold,
+        interval=float(interval_ms) / 1000,
+        max_dumps=int(max_dumps))
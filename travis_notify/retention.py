@@ -0,0 +1,142 @@
+""" Retention policy and compaction for repo histories.
+
+``Repo`` keeps its newest items in an ``AppendStack`` (sized by
+``travis_notify.recent_layers`` and ``travis_notify.layer_size``, see
+``models.configure_history``) and moves older layers into its archive.  A
+:class:`RetentionPolicy` drops archive layers beyond the newest
+``travis_notify.keep_builds`` items or whose builds finished more than
+``travis_notify.keep_days`` ago;  packing the storage afterwards reclaims
+their space.
+
+Run ``travis_notify_compact`` (e.g., nightly from cron, or with ``--every``)
+to apply the policy to every repo and pack the database.  It opens the
+database configured for the application, so it can only run alongside the
+server if that is a ZEO or RelStorage one:  a ``file://`` FileStorage is
+locked by the server process, and the script exits with an error.
+"""
+import argparse
+import logging
+import sys
+import time
+
+import transaction
+from zc.lockfile import LockError
+
+from .models import Repo
+
+logger = logging.getLogger('travis_notify.retention')
+
+
+class RetentionPolicy(object):
+    """Keep the newest ``keep_builds`` items and / or ``keep_days`` days of
+    each repo's history.  ``None`` disables either limit.
+    """
+    def __init__(self, keep_builds=None, keep_days=None, clock=time.time):
+        self.keep_builds = keep_builds
+        self.keep_days = keep_days
+        self.clock = clock
+
+    @property
+    def enabled(self):
+        return self.keep_builds is not None or self.keep_days is not None
+
+    def prune(self, repo):
+        """Apply the policy to ``repo``;  return the number of items dropped.
+        """
+        before = None
+        if self.keep_days is not None:
+            before = self.clock() - self.keep_days * 86400
+        return repo.prune(self.keep_builds, before)
+
+
+def policy_from_settings(settings):
+    keep_builds = settings.get('travis_notify.keep_builds')
+    keep_days = settings.get('travis_notify.keep_days')
+    return RetentionPolicy(
+        keep_builds and int(keep_builds) or None,
+        keep_days and float(keep_days) or None)
+
+
+def iter_repos(root):
+    for owner_name in list(root.keys()):
+        owner = root[owner_name]
+        for repo_name in list(owner.keys()):
+            repo = owner[repo_name]
+            if isinstance(repo, Repo):
+                yield repo
+
+
+def prune_all(root, policy, transaction_manager=None, attempts=3):
+    """Apply ``policy`` to every repo under ``root``.
+
+    If ``transaction_manager`` is passed, commit after each repo, retrying
+    conflicts (e.g., with a concurrent webhook) up to ``attempts`` times.
+    Return the number of items dropped.
+    """
+    dropped = 0
+    for repo in iter_repos(root):
+        if transaction_manager is None:
+            count = policy.prune(repo)
+        else:
+            for attempt in transaction_manager.attempts(attempts):
+                with attempt:
+                    count = policy.prune(repo)
+        if count:
+            logger.info('%s/%s: dropped %d items',
+                        repo.__parent__.__name__, repo.__name__, count)
+        dropped += count
+    return dropped
+
+
+def compact(root, policy, transaction_manager=None, pack_days=0):
+    """Prune every repo per ``policy``, then pack the database.
+
+    Return the number of items dropped.
+    """
+    dropped = 0
+    if policy.enabled:
+        dropped = prune_all(root, policy, transaction_manager)
+    db = root._p_jar.db()
+    start = time.time()
+    db.pack(days=pack_days)
+    logger.info('Packed in %.1fs', time.time() - start)
+    return dropped
+
+
+def main(argv=sys.argv):  # pragma: no cover
+    """Console script:  apply the retention policy and pack the database.
+    """
+    from pyramid.paster import bootstrap
+    from pyramid.paster import setup_logging
+    parser = argparse.ArgumentParser(
+        description='Prune repo histories and pack the database.')
+    parser.add_argument('config_uri')
+    parser.add_argument('--pack-days', type=float, default=None,
+                        help='Keep this many days of old revisions '
+                             '(default: travis_notify.pack_days, or 0).')
+    parser.add_argument('--every', type=float, default=None,
+                        help='Repeat every this many seconds.')
+    args = parser.parse_args(argv[1:])
+    setup_logging(args.config_uri)
+    try:
+        env = bootstrap(args.config_uri)
+    except LockError as e:
+        logger.error('Cannot open the database (%s):  is the server running?  '
+                     'Compacting alongside it needs a ZEO or RelStorage '
+                     'zodbconn.uri.', e)
+        return 1
+    try:
+        settings = env['registry'].settings
+        policy = policy_from_settings(settings)
+        pack_days = args.pack_days
+        if pack_days is None:
+            pack_days = float(settings.get('travis_notify.pack_days', 0))
+        while True:
+            dropped = compact(env['root'], policy, transaction.manager,
+                              pack_days)
+            logger.info('Dropped %d items', dropped)
+            if args.every is None:
+                break
+            time.sleep(args.every)
+    finally:
+        env['closer']()
@@ -0,0 +1,202 @@
+""" Verify the ``Signature`` header of Travis webhook notifications.
+
+Travis signs the ``payload`` form value with its private key (RSA,
+PKCS#1 v1.5 over SHA-1) and sends the base64-encoded signature in the
+``Signature`` header;  the matching public key is published in its API's
+``/config`` document.
+
+:class:`PublicKeyCache` keeps the key in memory and (optionally) in a file
+on disk, and refreshes it from a pluggable loader in a background thread
+once it is older than its TTL, so that verifying a request never waits on
+fetching the key.
+
+Requires the optional ``cryptography`` package (``travis_notify[signature]``).
+"""
+from base64 import b64decode
+import binascii
+from json import loads
+import logging
+import os
+import threading
+import time
+from urllib.request import urlopen
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+    from cryptography.hazmat.primitives.hashes import SHA1
+    from cryptography.hazmat.primitives.serialization import (
+        load_pem_public_key)
+except ImportError:  # pragma: no cover
+    load_pem_public_key = None
+
+from pyramid.settings import asbool
+
+logger = logging.getLogger('travis_notify.signature')
+
+TRAVIS_CONFIG_URL = 'https://api.travis-ci.com/config'
+
+
+def url_loader(url=TRAVIS_CONFIG_URL, timeout=10):
+    """Return a loader fetching the PEM public key from Travis's API.
+    """
+    def load():
+        with urlopen(url, timeout=timeout) as f:
+            config = loads(f.read().decode('utf-8'))
+        return config['config']['notifications']['webhook']['public_key']
+
+    return load
+
+
+def file_loader(path):
+    """Return a loader reading the PEM public key from ``path``.
+    """
+    def load():
+        with open(path) as f:
+            return f.read()
+
+    return load
+
+
+def load_public_key(pem):
+    if load_pem_public_key is None:  # pragma: no cover
+        raise ImportError('Signature verification requires "cryptography"')
+    if isinstance(pem, str):
+        pem = pem.encode('ascii')
+    return load_pem_public_key(pem)
+
+
+def verify_signature(public_key, payload, signature):
+    """Is ``signature`` (base64) a valid signature of ``payload``?
+    """
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    try:
+        public_key.verify(b64decode(signature, validate=True), payload,
+                          PKCS1v15(), SHA1())
+    except (InvalidSignature, binascii.Error, ValueError):
+        return False
+    return True
+
+
+class PublicKeyCache(object):
+    """Keep the public key returned by ``loader``, refreshing it in the
+    background every ``ttl`` seconds.
+
+    If ``cache_path`` is passed, each loaded key is also written there, and
+    a key found there at startup is used (aged by the file's mtime) until
+    the first refresh.
+
+    After a failed load, the next is attempted no sooner than ``retry``
+    seconds later;  only the first failure of a run is logged as a warning.
+    """
+    def __init__(self, loader, cache_path=None, ttl=3600.0, retry=60.0,
+                 clock=time.time):
+        self.loader = loader
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.retry = retry
+        self.clock = clock
+        self.key = None
+        self.loaded_at = None
+        self.failed_at = None
+        self._lock = threading.Lock()
+        self._thread = None
+        if cache_path is not None and os.path.exists(cache_path):
+            try:
+                with open(cache_path) as f:
+                    self.key = load_public_key(f.read())
+                self.loaded_at = os.path.getmtime(cache_path)
+            except (IOError, OSError, ValueError):
+                logger.warning('Ignoring unreadable key cache %s',
+                               cache_path, exc_info=True)
+
+    @property
+    def stale(self):
+        return (self.loaded_at is None or
+                self.loaded_at + self.ttl <= self.clock())
+
+    def get(self):
+        """Return the current key (None if not yet loaded), without waiting;
+        start a background refresh if it is stale.
+        """
+        key = self.key  # before the refresh can replace it
+        if self.stale and (self.failed_at is None or
+                           self.failed_at + self.retry <= self.clock()):
+            self.refresh_async()
+        return key
+
+    def refresh(self):
+        """Load the key now;  return True if it was loaded.
+        """
+        try:
+            pem = self.loader()
+            key = load_public_key(pem)
+        except Exception:
+            log = self.failed_at is None and logger.warning or logger.debug
+            log('Cannot load the Travis public key', exc_info=True)
+            self.failed_at = self.clock()
+            return False
+        self.key, self.loaded_at = key, self.clock()
+        self.failed_at = None
+        if self.cache_path is not None:
+            tmp = '%s.%d.tmp' % (self.cache_path, os.getpid())
+            try:
+                with open(tmp, 'w') as f:
+                    f.write(pem)
+                os.replace(tmp, self.cache_path)
+            except (IOError, OSError):
+                logger.warning('Cannot write key cache %s', self.cache_path,
+                               exc_info=True)
+        return True
+
+    def refresh_async(self):
+        """Start a background refresh, unless one is already running.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='travis_notify-signature')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def join(self):
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._thread = None
+
+
+def key_cache_from_settings(settings):
+    """Return a :class:`PublicKeyCache` configured by ``settings``, or None
+    if ``travis_notify.signature`` is not enabled.
+
+    - ``travis_notify.signature_key_file``:  read the key from a local file
+      instead of ``travis_notify.signature_key_url`` (default: Travis's
+      ``/config`` document).
+
+    - ``travis_notify.signature_key_cache``:  file in which to keep the key.
+
+    - ``travis_notify.signature_key_ttl``:  seconds (default 3600).
+    """
+    if not asbool(settings.get('travis_notify.signature', False)):
+        return None
+    key_file = settings.get('travis_notify.signature_key_file')
+    if key_file:
+        loader = file_loader(key_file)
+    else:
+        loader = url_loader(settings.get('travis_notify.signature_key_url',
+                                         TRAVIS_CONFIG_URL))
+    cache = PublicKeyCache(
+        loader,
+        settings.get('travis_notify.signature_key_cache') or None,
+        float(settings.get('travis_notify.signature_key_ttl', 3600)))
+    cache.get()  # start loading at startup
+    return cache
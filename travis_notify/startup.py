@@ -0,0 +1,105 @@
+""" Start-up work, done once by ``main`` rather than on the request path.
+
+:func:`startup` creates the application root, if needed, then pre-warms the
+connection pools:  it opens ``travis_notify.warm_connections`` connections
+(default:  the pool size) at once, loads the root, the owners, their repos
+and each repo's recent stack into each one's cache, and returns them to the
+pool, so that the first requests after a deploy find those objects in
+memory.  The read-only database (``travis_notify.read_only_db``), if any,
+is warmed too.
+"""
+import logging
+import time
+
+import transaction
+
+from .models import Repo
+from .models import appmaker
+
+logger = logging.getLogger('travis_notify.startup')
+
+
+def create_root(db):
+    """Create the application root in ``db``, if needed.
+
+    Return True if it was created.
+    """
+    with db.transaction() as conn:
+        created = 'app_root' not in conn.root()
+        appmaker(conn.root())
+    return created
+
+
+def _activate_board(resource):
+    board = getattr(resource, '_board', None)
+    if board is not None:
+        board._p_activate()
+
+
+def warm_connection(conn):
+    """Load the root, owners, repos, recent stacks and status boards into
+    ``conn``'s cache.
+
+    Return ``(owners, repos)``.
+    """
+    owners = repos = 0
+    root = conn.root().get('app_root')
+    if root is None:
+        return owners, repos
+    for owner in root.values():
+        owners += 1
+        _activate_board(owner)
+        for repo in owner.values():
+            if isinstance(repo, Repo):
+                repo._recent._p_activate()
+                repos += 1
+    return owners, repos
+
+
+def warm_database(db, count):
+    """Warm ``count`` of ``db``'s pooled connections (at most its pool size).
+
+    Return ``(connections, owners, repos)``.
+    """
+    count = min(count, db.getPoolSize())
+    conns = []
+    owners = repos = 0
+    try:
+        for i in range(count):
+            conns.append(
+                db.open(transaction_manager=transaction.TransactionManager()))
+        for conn in conns:
+            owners, repos = warm_connection(conn)
+    finally:
+        for conn in conns:
+            conn.transaction_manager.abort()
+            conn.close()
+    return count, owners, repos
+
+
+def startup(registry):
+    """Create the root and warm the connection pools of ``registry``'s
+    databases;  log what was done, and how long it took.
+    """
+    databases = getattr(registry, '_zodb_databases', None)
+    if not databases or '' not in databases:
+        return
+    start = time.perf_counter()
+    settings = registry.settings
+    created = create_root(databases[''])
+    count = settings.get('travis_notify.warm_connections')
+    names = ['']
+    read_only_db = settings.get('travis_notify.read_only_db')
+    if read_only_db:
+        names.append(read_only_db)
+    warmed = owners = repos = 0
+    for name in names:
+        db = databases[name]
+        if count is None:
+            connections, owners, repos = warm_database(db, db.getPoolSize())
+        else:
+            connections, owners, repos = warm_database(db, int(count))
+        warmed += connections
+    logger.info('%s root;  warmed %d connections with %d owners and %d '
+                'repos in %.2fs', created and 'Created' or 'Found', warmed,
+                owners, repos, time.perf_counter() - start)
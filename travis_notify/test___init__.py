@@ -2,6 +2,57 @@ import unittest
 
 from pyramid import testing
 
+try:
+    import cryptography
+except ImportError:  # pragma: no cover
+    cryptography = None
+
+
+class DummyConnection(object):
+
+    def __init__(self, root, transaction_manager=None):
+        self._root = root
+        self.transaction_manager = transaction_manager
+        self._closed = False
+
+    def root(self):
+        return {'app_root': self._root}
+
+    def close(self):
+        self._closed = True
+
+
+class DummyDB(object):
+
+    def __init__(self, root):
+        self._root = root
+        self._opened = []
+
+    def open(self, transaction_manager=None):
+        conn = DummyConnection(self._root, transaction_manager)
+        self._opened.append(conn)
+        return conn
+
+
+class Test_tm_activate_hook(unittest.TestCase):
+
+    def _callFUT(self, request):
+        from travis_notify import tm_activate_hook
+        return tm_activate_hook(request)
+
+    def test_read(self):
+        from travis_notify import READ_ONLY
+        for method in ('GET', 'HEAD'):
+            request = testing.DummyRequest(method=method)
+            self.assertFalse(self._callFUT(request))
+            self.assertTrue(request.environ[READ_ONLY])
+
+    def test_write(self):
+        from travis_notify import READ_ONLY
+        request = testing.DummyRequest(method='POST')
+        self.assertTrue(self._callFUT(request))
+        self.assertFalse(READ_ONLY in request.environ)
+
 
 class Test_root_factory(unittest.TestCase):
 
@@ -10,18 +61,41 @@ class Test_root_factory(unittest.TestCase):
         return root_factory(request)
 
     def test_it(self):
-
-        class DummyConnection(object):
-            def __init__(self, root):
-                self._root = root
-            def root(self):
-                return {'app_root': self._root}
-
         request = testing.DummyRequest()
         root = object()
         request._primary_zodb_conn = conn = DummyConnection(root)
         self.assertTrue(self._callFUT(request) is root)
 
+    def test_read_only(self):
+        import transaction
+        from travis_notify import READ_ONLY
+        root = object()
+        request = testing.DummyRequest(environ={READ_ONLY: True})
+        request.registry = testing.DummyResource(
+            settings={}, _zodb_databases={'': DummyDB(root)})
+        self.assertTrue(self._callFUT(request) is root)
+        self.assertTrue(self._callFUT(request) is root)
+        conn, = request.registry._zodb_databases['']._opened
+        self.assertTrue(request._read_zodb_conn is conn)
+        self.assertFalse(hasattr(request, '_primary_zodb_conn'))
+        tm = conn.transaction_manager
+        self.assertTrue(isinstance(tm, transaction.TransactionManager))
+        self.assertFalse(tm is transaction.manager)
+        callback, = request.finished_callbacks
+        callback(request)
+        self.assertTrue(conn._closed)
+
+    def test_read_only_db(self):
+        from travis_notify import READ_ONLY
+        root, other = object(), object()
+        request = testing.DummyRequest(environ={READ_ONLY: True})
+        request.registry = testing.DummyResource(
+            settings={'travis_notify.read_only_db': 'readonly'},
+            _zodb_databases={'': DummyDB(other),
+                             'readonly': DummyDB(root)})
+        self.assertTrue(self._callFUT(request) is root)
+        self.assertEqual(request.registry._zodb_databases['']._opened, [])
+
 
 class Test_main(unittest.TestCase):
 
@@ -36,6 +110,7 @@ class Test_main(unittest.TestCase):
                 self._static_views = {}
                 self._scanned = False
                 self._app = app
+                self.registry = testing.DummyResource(settings={})
             def include(self, other):
                 self._included.append(other)
             def add_static_view(self, name, pfx, **kw):
@@ -49,8 +124,154 @@ class Test_main(unittest.TestCase):
         configurator = DummyConfigurator(app)
         self.assertTrue(self._callFUT(object(), configurator) is app)
         self.assertEqual(configurator._included,
-                        ['pyramid_chameleon', '.views'])
+                        ['pyramid_chameleon', '.pagecache', '.metrics',
+                         '.views'])
         self.assertEqual(configurator._static_views['static'],
                             ('static', {'cache_max_age': 3600}))
         self.assertTrue(configurator._scanned)
 
+
+    def test_configures_history(self):
+        from pyramid.config import Configurator
+        from travis_notify.models import Repo
+        config = Configurator(settings={'travis_notify.recent_layers': '3',
+                                        'travis_notify.layer_size': '50',
+                                        'travis_notify.token': 'TOKEN',
+                                       },
+                              package='travis_notify')
+        saved = Repo.recent_layers, Repo.layer_size
+        try:
+            self._callFUT({}, config)
+            repo = Repo()
+        finally:
+            Repo.recent_layers, Repo.layer_size = saved
+        self.assertEqual(repo._recent._max_layers, 3)
+        self.assertEqual(repo._recent._max_length, 50)
+        self.assertEqual(Repo().recent_layers, 10)
+
+    def test_read_requests_skip_transactions(self):
+        import transaction
+        from pyramid.request import Request
+        from travis_notify.benchmark import make_app
+        from travis_notify.benchmark import make_payload
+        from travis_notify.benchmark import make_request
+        app = make_app()
+        db = app.registry._zodb_databases['']
+        _begun = []
+
+        class Synch(object):
+            def newTransaction(self, txn):
+                _begun.append(txn)
+            beforeCompletion = afterCompletion = lambda self, txn: None
+
+        synch = Synch()
+        transaction.manager.registerSynch(synch)
+        try:
+            response = Request.blank('/').get_response(app)
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(_begun, [])
+            response = make_request('owner/repo', make_payload(1)).get_response(app)
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(len(_begun), 1)
+            response = Request.blank('/owner/repo').get_response(app)
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(len(_begun), 1)
+        finally:
+            transaction.manager.unregisterSynch(synch)
+            db.close()
+
+
+class WebhookAuthorizationTests(unittest.TestCase):
+    # Through the whole app, so that a predicate Pyramid drops is noticed.
+
+    def setUp(self):
+        from travis_notify.benchmark import make_app
+        self._app = make_app()
+
+    def tearDown(self):
+        for db in self._app.registry._zodb_databases.values():
+            db.close()
+
+    def _post(self, request):
+        return request.get_response(self._app)
+
+    def _makeRequest(self, **kw):
+        from travis_notify.benchmark import make_payload
+        from travis_notify.benchmark import make_request
+        return make_request('owner/repo', make_payload(1), **kw)
+
+    def _recorded(self, owner='owner'):
+        conn = self._app.registry._zodb_databases[''].open()
+        try:
+            return owner in conn.root().get('app_root', {})
+        finally:
+            conn.close()
+
+    def test_valid_token(self):
+        self.assertEqual(self._post(self._makeRequest()).status_int, 200)
+        self.assertTrue(self._recorded())
+
+    def test_wo_token(self):
+        request = self._makeRequest()
+        del request.headers['Authorization']
+        self.assertEqual(self._post(request).status_int, 403)
+        self.assertFalse(self._recorded())
+
+    def test_forged_token(self):
+        request = self._makeRequest(token='FORGED')
+        self.assertEqual(self._post(request).status_int, 403)
+        self.assertFalse(self._recorded())
+
+    def test_wo_headers(self):
+        request = self._makeRequest()
+        del request.headers['Authorization']
+        del request.headers['Travis-Repo-Slug']
+        self.assertNotEqual(self._post(request).status_int, 200)
+        self.assertFalse(self._recorded())
+
+
+@unittest.skipIf(cryptography is None, 'cryptography not installed')
+class WebhookSignatureTests(WebhookAuthorizationTests):
+
+    def setUp(self):
+        import tempfile
+        from travis_notify.benchmark import make_app
+        from travis_notify.benchmark import make_key_pair
+        self._tmpdir = tempfile.mkdtemp()
+        self._private_key, key_file = make_key_pair(self._tmpdir)
+        # The key cache file is read at start-up:  no waiting for the load.
+        self._app = make_app(**{'travis_notify.signature': 'true',
+                                'travis_notify.signature_key_file': key_file,
+                                'travis_notify.signature_key_cache': key_file,
+                               })
+
+    def tearDown(self):
+        import shutil
+        super(WebhookSignatureTests, self).tearDown()
+        shutil.rmtree(self._tmpdir)
+
+    def _makeSignedRequest(self, slug='owner/repo', private_key=None):
+        from travis_notify.benchmark import make_payload
+        from travis_notify.benchmark import make_request
+        return make_request(slug, make_payload(1),
+                            private_key=private_key or self._private_key)
+
+    def test_valid_signature(self):
+        self.assertEqual(
+            self._post(self._makeSignedRequest()).status_int, 200)
+        self.assertTrue(self._recorded())
+
+    def test_forged_signature(self):
+        import os
+        from travis_notify.benchmark import make_key_pair
+        forged = os.path.join(self._tmpdir, 'forged')
+        os.mkdir(forged)
+        forger, _ = make_key_pair(forged)
+        request = self._makeSignedRequest(private_key=forger)
+        self.assertEqual(self._post(request).status_int, 403)
+        self.assertFalse(self._recorded())
+
+    def test_signed_payload_under_other_slug(self):
+        request = self._makeSignedRequest(slug='victim/repo')
+        self.assertEqual(self._post(request).status_int, 403)
+        self.assertFalse(self._recorded('victim'))
@@ -0,0 +1,176 @@
+import unittest
+
+try:
+    import cryptography
+except ImportError:  # pragma: no cover
+    cryptography = None
+
+try:
+    import ZEO
+except ImportError:  # pragma: no cover
+    ZEO = None
+
+try:
+    import relstorage
+except ImportError:  # pragma: no cover
+    relstorage = None
+
+
+class Test_percentile(unittest.TestCase):
+
+    def _callFUT(self, values, pct):
+        from .benchmark import percentile
+        return percentile(values, pct)
+
+    def test_empty(self):
+        self.assertEqual(self._callFUT([], 50), None)
+
+    def test_it(self):
+        values = list(range(100, 0, -1))
+        self.assertEqual(self._callFUT(values, 50), 50)
+        self.assertEqual(self._callFUT(values, 99), 99)
+        self.assertEqual(self._callFUT(values, 0), 1)
+        self.assertEqual(self._callFUT([7], 99), 7)
+
+
+class Test_make_payload(unittest.TestCase):
+
+    def test_it(self):
+        from .benchmark import make_payload
+        payload = make_payload(5, jobs=3, repo='other')
+        self.assertEqual(payload['number'], '5')
+        self.assertEqual(payload['status'], 1)
+        self.assertEqual(payload['status_message'], 'Failed')
+        self.assertEqual(len(payload['matrix']), 3)
+        self.assertEqual(payload['repository']['name'], 'other')
+
+    def test_passing(self):
+        from .benchmark import make_payload
+        from .models import status_summary
+        payload = make_payload(6)
+        self.assertEqual(payload['status'], 0)
+        self.assertEqual(payload['status_message'], 'Passed')
+        self.assertEqual(status_summary(payload), 'OK')
+
+
+class Test_make_request(unittest.TestCase):
+
+    def test_signed_for_predicate(self):
+        from pyramid import testing
+        from .benchmark import TOKEN
+        from .benchmark import make_payload
+        from .benchmark import make_request
+        from .views import TravisAuthorizationCheck
+        request = make_request('owner/repo', make_payload(1))
+        config = testing.DummyResource(
+            settings={'travis_notify.token': TOKEN})
+        check = TravisAuthorizationCheck(None, config)
+        self.assertTrue(check(None, request))
+        self.assertEqual(request.content_type,
+                         'application/x-www-form-urlencoded')
+
+
+class Test_bench(unittest.TestCase):
+
+    def test_memory_storage(self):
+        from .benchmark import bench
+        from .benchmark import make_app
+        app = make_app()
+        try:
+            result = bench(app, 6, jobs=2, repos=2, concurrency=1)
+        finally:
+            app.registry._zodb_databases[''].close()
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['requests'], 6)
+        self.assertTrue(result['throughput'] > 0)
+        self.assertTrue(result['p50'] <= result['p99'])
+
+
+class Test_make_storage(unittest.TestCase):
+
+    def _callFUT(self, kind, concurrency=1):
+        from .benchmark import make_storage
+        return make_storage(kind, concurrency)
+
+    def _bench(self, kind, concurrency=1):
+        from .benchmark import bench
+        from .benchmark import make_app
+        uri, cleanup = self._callFUT(kind, concurrency)
+        try:
+            app = make_app(uri)
+            try:
+                return bench(app, 4, jobs=1, repos=1,
+                             concurrency=concurrency)
+            finally:
+                app.registry._zodb_databases[''].close()
+        finally:
+            cleanup()
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, self._callFUT, 'nonesuch')
+
+    def test_memory(self):
+        uri, cleanup = self._callFUT('memory', 20)
+        cleanup()
+        self.assertEqual(uri, 'memory://?connection_pool_size=21')
+
+    def test_file(self):
+        import os
+        uri, cleanup = self._callFUT('file')
+        self.assertTrue(uri.startswith('file://'))
+        self.assertTrue(uri.endswith('Data.fs?connection_pool_size=7'))
+        tmpdir = os.path.dirname(uri[len('file://'):].split('?')[0])
+        self.assertTrue(os.path.isdir(tmpdir))
+        cleanup()
+        self.assertFalse(os.path.exists(tmpdir))
+
+    @unittest.skipIf(ZEO is None, 'ZEO not installed')
+    def test_zeo(self):
+        result = self._bench('zeo', 2)
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['requests'], 4)
+
+    @unittest.skipIf(relstorage is None, 'RelStorage not installed')
+    def test_sqlite(self):
+        result = self._bench('sqlite', 2)
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['requests'], 4)
+
+
+class Test_main(unittest.TestCase):
+
+    def test_it(self):
+        from io import StringIO
+        from .benchmark import main
+        out = StringIO()
+        main(['bench', '--storage', 'file', '--requests', '2', '--jobs', '1',
+              '--repos', '1', '--concurrency', '1,2'], out=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0].split()[:3], ['jobs', 'repos', 'conc'])
+        self.assertEqual(lines[1].split()[:5], ['1', '1', '1', '2', '0'])
+
+    def test_memory_storage_refuses_concurrency(self):
+        from io import StringIO
+        import sys
+        from .benchmark import main
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertRaises(SystemExit, main,
+                              ['bench', '--storage', 'memory',
+                               '--concurrency', '1,4'], out=StringIO())
+        finally:
+            sys.stderr = stderr
+
+    @unittest.skipIf(cryptography is None, 'cryptography not installed')
+    def test_w_signature(self):
+        from io import StringIO
+        from .benchmark import main
+        out = StringIO()
+        main(['bench', '--requests', '2', '--jobs', '1', '--repos', '1',
+              '--concurrency', '1', '--signature'], out=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('signature verify (1 jobs):'))
+        self.assertEqual(lines[2].split()[:5], ['1', '1', '1', '2', '0'])
@@ -0,0 +1,114 @@
+import unittest
+
+
+def _makePayload(number, owner='owner', repo='repo'):
+    return {'id': number,
+            'number': str(number),
+            'status': 0,
+            'status_message': 'Passed',
+            'repository': {'owner_name': owner, 'name': repo},
+           }
+
+
+class Test_iter_records(unittest.TestCase):
+
+    def _callFUT(self, lines):
+        from .bulkload import iter_records
+        return list(iter_records(lines))
+
+    def test_repo_lines(self):
+        lines = ['{"owner": "zopefoundation", "repo": "zope.interface"}\n',
+                 '\n',
+                 b'{"owner": "o", "repo": "r", "payload": {"id": 1}}\n',
+                ]
+        self.assertEqual(self._callFUT(lines),
+                         [('zopefoundation', 'zope.interface', None),
+                          ('o', 'r', {'id': 1}),
+                         ])
+
+    def test_payload_lines(self):
+        from json import dumps
+        payload = _makePayload(1)
+        self.assertEqual(self._callFUT([dumps(payload)]),
+                         [('owner', 'repo', payload)])
+
+    def test_bad_json(self):
+        self.assertRaises(ValueError, self._callFUT, ['{}', '{'])
+
+    def test_wo_owner(self):
+        self.assertRaises(ValueError, self._callFUT, ['{"repo": "r"}'])
+
+
+class Test_bulk_load(unittest.TestCase):
+
+    def _callFUT(self, root, records, **kw):
+        from .bulkload import bulk_load
+        return bulk_load(root, records, **kw)
+
+    def test_creates_repos_like_find_create(self):
+        from .models import Repo
+        from .models import Root
+        root = Root()
+        result = self._callFUT(root, [('owner', 'a', None),
+                                      ('owner', 'b', None),
+                                      ('owner', 'a', None),
+                                     ])
+        self.assertEqual(result, (2, 0))
+        repo = root['owner']['a']
+        self.assertTrue(isinstance(repo, Repo))
+        self.assertEqual(repo.__name__, 'a')
+        self.assertTrue(repo.__parent__ is root['owner'])
+        self.assertTrue(root['owner'].__parent__ is root)
+
+    def test_pushes_payloads_in_order(self):
+        from .dedupe import delivery_key
+        from .models import BuildRecord
+        from .models import Root
+        root = Root()
+        payloads = [_makePayload(x) for x in range(3)]
+        records = [('owner', 'repo', x) for x in payloads]
+        self.assertEqual(self._callFUT(root, records, keep_raw=True), (1, 3))
+        repo = root['owner']['repo']
+        items = list(repo)
+        self.assertTrue(all(isinstance(x, BuildRecord) for x in items))
+        self.assertEqual([x.number for x in items], ['2', '1', '0'])
+        self.assertEqual(items[0].payload, payloads[2])
+        self.assertEqual(repo.index.by_number(1)['id'], 1)
+        self.assertTrue(repo.seen(delivery_key(payloads[0])))
+
+    def test_chunks_and_savepoints(self):
+        from .models import Root
+        root = Root()
+        _called = []
+        records = [('owner', 'repo', _makePayload(x)) for x in range(7)]
+        self._callFUT(root, records, chunk_size=3, savepoint_size=2,
+                      commit=lambda: _called.append('commit'),
+                      savepoint=lambda: _called.append('savepoint'),
+                      report=lambda repos, items: _called.append(items))
+        self.assertEqual(_called, ['savepoint', 'commit', 3,
+                                   'savepoint', 'commit', 6,
+                                   'commit', 7])
+
+    def test_w_database(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        from .models import Root
+        db = DB(MappingStorage())
+        try:
+            tm = transaction.TransactionManager()
+            conn = db.open(transaction_manager=tm)
+            root = conn.root()['app_root'] = Root()
+            records = [('owner', 'repo%d' % (x % 3), _makePayload(x))
+                       for x in range(25)]
+            self._callFUT(root, records, chunk_size=10, savepoint_size=4,
+                          commit=tm.commit,
+                          savepoint=lambda: tm.savepoint(True))
+            conn.close()
+            with db.transaction() as conn:
+                owner = conn.root()['app_root']['owner']
+                self.assertEqual(sorted(owner.keys()),
+                                 ['repo0', 'repo1', 'repo2'])
+                self.assertEqual(len(list(owner['repo0'])), 9)
+        finally:
+            db.close()
@@ -0,0 +1,96 @@
+import unittest
+
+from pyramid import testing
+
+
+class Test_delivery_key(unittest.TestCase):
+
+    def _callFUT(self, payload):
+        from .dedupe import delivery_key
+        return delivery_key(payload)
+
+    def _makePayload(self, **kw):
+        payload = {'id': 123,
+                   'status': 0,
+                   'status_message': 'Passed',
+                   'matrix': [{'id': 1231}, {'id': 1232}],
+                  }
+        payload.update(kw)
+        return payload
+
+    def test_same_delivery(self):
+        self.assertEqual(self._callFUT(self._makePayload()),
+                         self._callFUT(self._makePayload()))
+
+    def test_build_id_first(self):
+        self.assertTrue(self._callFUT(self._makePayload()).startswith('123:'))
+
+    def test_differs_by_build_jobs_and_status(self):
+        key = self._callFUT(self._makePayload())
+        for kw in ({'id': 124},
+                   {'matrix': [{'id': 1231}]},
+                   {'status': None, 'status_message': 'Pending'},
+                   {'status': 1, 'status_message': 'Broken'},
+                  ):
+            self.assertNotEqual(self._callFUT(self._makePayload(**kw)), key)
+
+    def test_empty_payload(self):
+        self.assertEqual(self._callFUT({}).split(':')[0], 'None')
+
+
+class RecentDeliveriesTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .dedupe import RecentDeliveries
+        return RecentDeliveries
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def test_add_and_contains(self):
+        recent = self._makeOne()
+        self.assertFalse('a' in recent)
+        recent.add('a')
+        self.assertTrue('a' in recent)
+        self.assertEqual(len(recent), 1)
+
+    def test_evicts_least_recently_used(self):
+        recent = self._makeOne(2)
+        recent.add('a')
+        recent.add('b')
+        self.assertTrue('a' in recent)
+        recent.add('c')
+        self.assertTrue('a' in recent)
+        self.assertFalse('b' in recent)
+        self.assertTrue('c' in recent)
+
+    def test_add_on_commit(self):
+        import transaction
+        recent = self._makeOne()
+        txn = transaction.begin()
+        recent.add_on_commit('a', txn)
+        self.assertFalse('a' in recent)
+        txn.commit()
+        self.assertTrue('a' in recent)
+
+    def test_add_on_commit_aborted(self):
+        import transaction
+        recent = self._makeOne()
+        transaction.begin()
+        recent.add_on_commit('a')
+        transaction.abort()
+        self.assertFalse('a' in recent)
+
+
+class Test_get_recent_deliveries(unittest.TestCase):
+
+    def _callFUT(self, registry):
+        from .dedupe import get_recent_deliveries
+        return get_recent_deliveries(registry)
+
+    def test_creates_once(self):
+        registry = testing.DummyResource(
+            settings={'travis_notify.dedupe_cache_size': '5'})
+        recent = self._callFUT(registry)
+        self.assertEqual(recent.max_entries, 5)
+        self.assertTrue(self._callFUT(registry) is recent)
@@ -0,0 +1,368 @@
+import unittest
+
+from pyramid import testing
+
+
+def _makePayload(status=0, status_message='Passed', number='1',
+                 branch='master', commit='abc123'):
+    return {
+        "type": "push",
+        "status": status,
+        "status_message": status_message,
+        "number": number,
+        "build_url": "https://travis-ci.org/owner/repo/builds/%s" % number,
+        "branch": branch,
+        "commit": commit,
+        "repository": {
+            "name": "repo",
+            "owner_name": "owner",
+        }
+    }
+
+
+def _moveToDeadPid(journal, records):
+    # Journal ``records`` as if by a process which has since exited.
+    import os
+    import subprocess
+    import sys
+    child = subprocess.Popen([sys.executable, '-c', 'pass'])
+    child.wait()
+    for payload, status in records:
+        journal.write(status, payload)
+    own_dir = os.path.join(journal.path, str(os.getpid()))
+    dead_dir = os.path.join(journal.path, str(child.pid))
+    os.rename(own_dir, dead_dir)
+    return dead_dir
+
+
+class Test_digest_key(unittest.TestCase):
+
+    def _callFUT(self, payload):
+        from .digest import digest_key
+        return digest_key(payload)
+
+    def test_it(self):
+        self.assertEqual(self._callFUT(_makePayload()),
+                         ('owner', 'repo', 'master', 'abc123'))
+
+    def test_empty(self):
+        self.assertEqual(self._callFUT({}), (None, None, None, None))
+
+
+class Test_overall_status(unittest.TestCase):
+
+    def _callFUT(self, statuses):
+        from .digest import overall_status
+        return overall_status(statuses)
+
+    def test_empty(self):
+        self.assertEqual(self._callFUT([]), 'UNKNOWN')
+
+    def test_all_ok(self):
+        self.assertEqual(self._callFUT(['OK', 'OK']), 'OK')
+
+    def test_w_unknown(self):
+        self.assertEqual(self._callFUT(['OK', 'UNKNOWN']), 'UNKNOWN')
+
+    def test_w_failed(self):
+        self.assertEqual(self._callFUT(['UNKNOWN', 'FAILED', 'OK']),
+                         'FAILED')
+
+
+class Test_build_digest_message(unittest.TestCase):
+
+    def _callFUT(self, key, entries, sender='from@example.com',
+                 to='to@example.com'):
+        from .digest import build_digest_message
+        return build_digest_message(key, entries, sender, to)
+
+    def test_it(self):
+        key = ('owner', 'repo', 'master', 'abc123')
+        entries = [('OK', _makePayload(number='1.1')),
+                   ('OK', _makePayload(number='1.2')),
+                   ('FAILED', _makePayload(1, 'Failed', number='1.3')),
+                  ]
+        message = self._callFUT(key, entries)
+        self.assertEqual(message['Subject'],
+                         'FAILED: repo [Travis-CI] (3 builds)')
+        self.assertEqual(message['To'], 'to@example.com')
+        body = message.get_payload()
+        self.assertTrue('Repository: owner/repo' in body)
+        self.assertTrue('OK       2' in body)
+        self.assertTrue('FAILED   1' in body)
+        self.assertTrue('UNKNOWN  0' in body)
+        self.assertTrue('#1.3 Failed' in body)
+
+
+class DigestBufferTests(unittest.TestCase):
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+
+    def _getTargetClass(self):
+        from .digest import DigestBuffer
+        return DigestBuffer
+
+    def _makeOne(self, window=60, now=None):
+        if now is None:
+            now = [1000.0]
+        self._now = now
+        self._emitted = []
+        def _emit(key, entries):
+            self._emitted.append((key, entries))
+        return self._getTargetClass()(window, _emit, clock=lambda: now[0])
+
+    def test_coalesces_per_key_within_window(self):
+        buf = self._makeOne()
+        buf.add(_makePayload(number='1.1'), 'OK')
+        buf.add(_makePayload(number='1.2'), 'OK')
+        buf.add(_makePayload(commit='def456'), 'OK')
+        self.assertEqual(buf.flush(), 0)
+        self._now[0] += 60
+        self.assertEqual(buf.flush(), 2)
+        keys = [key for key, entries in self._emitted]
+        self.assertEqual(keys, [('owner', 'repo', 'master', 'abc123'),
+                                ('owner', 'repo', 'master', 'def456')])
+        self.assertEqual(len(self._emitted[0][1]), 2)
+        self.assertEqual(buf.flush(), 0)
+
+    def test_due_respects_window_order(self):
+        buf = self._makeOne()
+        buf.add(_makePayload(commit='first'), 'OK')
+        self._now[0] += 30
+        buf.add(_makePayload(commit='second'), 'OK')
+        due = buf.due(1060.0)
+        self.assertEqual([key[3] for key, entries in due], ['first'])
+        self.assertEqual([key[3] for key, entries in buf.due(1090.0)],
+                         ['second'])
+
+    def test_flush_logs_emit_errors(self):
+        def _emit(key, entries):
+            raise ValueError('testing')
+        buf = self._getTargetClass()(0, _emit)
+        buf.add(_makePayload(), 'OK')
+        self.assertEqual(buf.flush_all(), 1)
+        self.assertEqual(buf.flush_all(), 0)
+
+    def test_add_on_commit_abort(self):
+        import transaction
+        buf = self._makeOne()
+        buf.start = lambda: None
+        buf.add_on_commit(_makePayload(), 'OK')
+        transaction.abort()
+        self.assertEqual(buf.flush_all(), 0)
+
+    def test_add_on_commit_commit(self):
+        import transaction
+        buf = self._makeOne()
+        _started = []
+        buf.start = lambda: _started.append(True)
+        buf.add_on_commit(_makePayload(), 'OK')
+        transaction.commit()
+        self.assertEqual(_started, [True])
+        self.assertEqual(buf.flush_all(), 1)
+
+    def test_start_stop(self):
+        buf = self._makeOne(window=0)
+        buf.add(_makePayload(), 'OK')
+        buf.start()
+        thread = buf._thread
+        buf.start()
+        self.assertTrue(buf._thread is thread)
+        buf.stop()
+        self.assertTrue(buf._thread is None)
+        self.assertEqual(len(self._emitted), 1)
+
+
+    def test_start_concurrent(self):
+        import threading
+        buf = self._makeOne(window=0)
+        started = []
+        _Thread = threading.Thread
+
+        class Thread(_Thread):
+            def start(self):
+                started.append(self)
+
+        barrier = threading.Barrier(8)
+
+        def _start():
+            barrier.wait()
+            buf.start()
+
+        threading.Thread = Thread
+        try:
+            threads = [_Thread(target=_start) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            threading.Thread = _Thread
+        self.assertEqual(len(started), 1)
+        buf._thread = None  # never started
+
+    def test_journaled(self):
+        import os
+        import shutil
+        import tempfile
+        from .digest import DigestJournal
+        tmpdir = tempfile.mkdtemp()
+        try:
+            buf = self._makeOne()
+            buf.journal = DigestJournal(tmpdir)
+            buf.add(_makePayload(number='1.1'), 'OK')
+            buf.add(_makePayload(number='1.2'), 'FAILED')
+            own = os.path.join(tmpdir, str(os.getpid()))
+            self.assertEqual(len(os.listdir(own)), 2)
+            self.assertEqual(buf.flush_all(), 1)
+            self.assertEqual(os.listdir(own), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_journal_kept_if_emit_fails(self):
+        import os
+        import shutil
+        import tempfile
+        from .digest import DigestJournal
+
+        def _emit(key, entries):
+            raise ValueError('testing')
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            buf = self._getTargetClass()(0, _emit,
+                                         journal=DigestJournal(tmpdir))
+            buf.add(_makePayload(), 'OK')
+            self.assertEqual(buf.flush_all(), 1)
+            own = os.path.join(tmpdir, str(os.getpid()))
+            self.assertEqual(len(os.listdir(own)), 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_recover(self):
+        import shutil
+        import tempfile
+        from .digest import DigestJournal
+        tmpdir = tempfile.mkdtemp()
+        try:
+            dead = DigestJournal(tmpdir)
+            _moveToDeadPid(dead, [(_makePayload(number='1.1'), 'OK'),
+                                  (_makePayload(number='1.2'), 'FAILED')])
+            buf = self._makeOne()
+            buf.journal = DigestJournal(tmpdir)
+            buf.start = lambda: None
+            self.assertEqual(buf.recover(), 2)
+            self.assertEqual(buf.recover(), 0)
+            self.assertEqual(buf.flush_all(), 1)
+            key, entries = self._emitted[0]
+            self.assertEqual([(x, y['number']) for x, y in entries],
+                             [('OK', '1.1'), ('FAILED', '1.2')])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_recover_wo_journal(self):
+        self.assertEqual(self._makeOne().recover(), 0)
+
+
+class DigestJournalTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOne(self, path=None):
+        from .digest import DigestJournal
+        return DigestJournal(path or self.tmpdir)
+
+    def test_write_remove(self):
+        import json
+        import os
+        journal = self._makeOne()
+        first = journal.write('OK', _makePayload())
+        second = journal.write('FAILED', _makePayload(1, 'Failed'))
+        self.assertTrue(first < second)
+        self.assertEqual(os.path.dirname(first),
+                         os.path.join(self.tmpdir, str(os.getpid())))
+        with open(second) as f:
+            self.assertEqual(json.load(f)['status'], 'FAILED')
+        journal.remove([first, second])
+        self.assertEqual(os.listdir(os.path.dirname(first)), [])
+
+    def test_recover_skips_live_processes(self):
+        import os
+        journal = self._makeOne()
+        journal.write('OK', _makePayload())
+        os.makedirs(os.path.join(self.tmpdir, str(os.getppid())))
+        self.assertEqual(journal.recover(), [])
+
+    def test_recover_dead_process(self):
+        import os
+        journal = self._makeOne()
+        dead_dir = _moveToDeadPid(journal, [(_makePayload(), 'OK')])
+        with open(os.path.join(dead_dir, 'partial.json.tmp'), 'w'):
+            pass
+        recovered = journal.recover()
+        self.assertEqual([(x[1], x[2]['number']) for x in recovered],
+                         [('OK', '1')])
+        self.assertEqual(os.path.dirname(recovered[0][0]),
+                         os.path.join(self.tmpdir, str(os.getpid())))
+        self.assertFalse(os.path.exists(dead_dir))
+
+    def test_recover_wo_directory(self):
+        import os
+        journal = self._makeOne(os.path.join(self.tmpdir, 'nonesuch'))
+        self.assertEqual(journal.recover(), [])
+
+
+class Test_journal_path_from_settings(unittest.TestCase):
+
+    def _callFUT(self, settings):
+        from .digest import journal_path_from_settings
+        return journal_path_from_settings(settings)
+
+    def test_it(self):
+        self.assertEqual(self._callFUT({}), None)
+        self.assertEqual(
+            self._callFUT({'travis_notify.mail_queue_path': '/var/q'}),
+            '/var/q/digests')
+        self.assertEqual(
+            self._callFUT({'travis_notify.mail_queue_path': '/var/q',
+                           'travis_notify.digest_journal_path': '/var/j'}),
+            '/var/j')
+
+
+class Test_get_digest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _callFUT(self, registry):
+        from .digest import get_digest
+        return get_digest(registry)
+
+    def test_it_emits_through_mailer(self):
+        from pyramid_mailer.interfaces import IMailer
+        from pyramid_mailer.mailer import DummyMailer
+        registry = self.config.registry
+        mailer = DummyMailer()
+        registry.registerUtility(mailer, IMailer)
+        registry.settings['travis_notify.recipients'] = 'foo@example.com'
+        registry.settings['travis_notify.digest_window'] = '30'
+        digest = self._callFUT(registry)
+        self.assertTrue(self._callFUT(registry) is digest)
+        self.assertEqual(digest.window, 30.0)
+        digest.add(_makePayload(), 'OK')
+        digest.add(_makePayload(1, 'Failed'), 'FAILED')
+        digest.flush_all()
+        self.assertEqual(len(mailer.outbox), 1)
+        self.assertEqual(mailer.outbox[0]['Subject'],
+                         'FAILED: repo [Travis-CI] (2 builds)')
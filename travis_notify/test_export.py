@@ -0,0 +1,94 @@
+import unittest
+
+
+def _makeRepo(count=7):
+    from appendonly import AppendStack
+    from .models import Repo
+    repo = Repo()
+    repo._recent = AppendStack(2, 2)
+    for number in range(count):
+        repo.pushItem({'number': str(number)})
+    return repo
+
+
+class Test_iter_ndjson(unittest.TestCase):
+
+    def _callFUT(self, repo):
+        from .export import iter_ndjson
+        return iter_ndjson(repo)
+
+    def test_it(self):
+        from json import loads
+        repo = _makeRepo()
+        lines = list(self._callFUT(repo))
+        self.assertTrue(all(x.endswith(b'\n') for x in lines))
+        numbers = [loads(x.decode('utf-8'))['number'] for x in lines]
+        self.assertEqual(numbers, ['6', '5', '4', '3', '2', '1', '0'])
+
+
+class Test_export_to_file(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _callFUT(self, repo, path):
+        from .export import export_to_file
+        return export_to_file(repo, path)
+
+    def test_it(self):
+        import os
+        path = os.path.join(self.tmpdir, 'out.ndjson')
+        self._callFUT(_makeRepo(3), path)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read().count(b'\n'), 3)
+        self.assertEqual(os.listdir(self.tmpdir), ['out.ndjson'])
+
+    def test_failure_leaves_no_partial_file(self):
+        import os
+        path = os.path.join(self.tmpdir, 'out.ndjson')
+        with open(path, 'wb') as f:
+            f.write(b'previous\n')
+        repo = _makeRepo(3)
+
+        def _iterExport():
+            yield {'number': '2'}
+            raise IOError('lost connection')
+
+        repo.iterExport = _iterExport
+        self.assertRaises(IOError, self._callFUT, repo, path)
+        self.assertEqual(os.listdir(self.tmpdir), ['out.ndjson'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'previous\n')
+
+
+class Test_export_app_iter(unittest.TestCase):
+
+    def _callFUT(self, repo):
+        from .export import export_app_iter
+        return export_app_iter(repo)
+
+    def test_wo_jar(self):
+        repo = _makeRepo(2)
+        self.assertEqual(list(self._callFUT(repo)),
+                         [b'{"number": "1"}\n', b'{"number": "0"}\n'])
+
+    def test_w_jar_uses_private_connection(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        db = DB(MappingStorage())
+        try:
+            tm = transaction.TransactionManager()
+            conn = db.open(transaction_manager=tm)
+            conn.root()['repo'] = repo = _makeRepo()
+            tm.commit()
+            app_iter = self._callFUT(repo)
+            conn.close()  # as at the end of the request
+            self.assertEqual(len(list(app_iter)), 7)
+        finally:
+            db.close()
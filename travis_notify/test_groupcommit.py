@@ -0,0 +1,242 @@
+import unittest
+
+from pyramid import testing
+
+
+class GroupCommitterTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .groupcommit import GroupCommitter
+        return GroupCommitter
+
+    def _makeOne(self, apply_batch=None, **kw):
+        self._batches = []
+
+        def _apply_batch(items):
+            self._batches.append(items)
+            return [None] * len(items)
+
+        if apply_batch is None:
+            apply_batch = _apply_batch
+        return self._getTargetClass()(apply_batch, **kw)
+
+    def test_take_max_items(self):
+        from concurrent.futures import Future
+        committer = self._makeOne(max_items=2, max_delay=60)
+        for item in range(3):
+            committer._pending.append((item, Future()))
+        self.assertEqual([x[0] for x in committer.take()], [0, 1])
+        self.assertEqual(len(committer._pending), 1)
+
+    def test_take_max_delay(self):
+        from concurrent.futures import Future
+        now = [0.0]
+        committer = self._makeOne(max_items=10, max_delay=0.01,
+                                  clock=lambda: now[0])
+        committer._pending.append((1, Future()))
+
+        class DummyCondition(object):
+            def __enter__(self):
+                pass
+            def __exit__(self, *exc_info):
+                pass
+            def wait(self, timeout=None):
+                now[0] += timeout
+
+        committer._cond = DummyCondition()
+        self.assertEqual([x[0] for x in committer.take()], [1])
+        self.assertEqual(now[0], 0.01)
+
+    def test_take_stopped(self):
+        committer = self._makeOne()
+        committer._stopped = True
+        self.assertEqual(committer.take(), [])
+
+    def test_take_skips_cancelled(self):
+        from concurrent.futures import Future
+        committer = self._makeOne(max_items=2, max_delay=0)
+        futures = [Future() for x in range(3)]
+        futures[0].cancel()
+        futures[1].cancel()
+        committer._pending.extend(zip('abc', futures))
+        self.assertEqual([x[0] for x in committer.take()], ['c'])
+        self.assertFalse(futures[2].cancel())  # running
+
+    def test_store(self):
+        committer = self._makeOne(max_delay=0)
+        self.assertTrue(committer.store('a'))
+        committer.stop(timeout=10)
+        self.assertEqual(self._batches, [['a']])
+
+    def test_store_raises_item_error(self):
+        error = ValueError()
+        committer = self._makeOne(lambda items: [error], max_delay=0)
+        self.assertRaises(ValueError, committer.store, 'a')
+        committer.stop(timeout=10)
+
+    def test_store_timeout(self):
+        import threading
+        started = threading.Event()
+        release = threading.Event()
+        applied = []
+
+        def _apply_batch(items):
+            started.set()
+            release.wait(10)
+            applied.extend(items)
+            return [None] * len(items)
+
+        committer = self._makeOne(_apply_batch, max_items=1, max_delay=0,
+                                  timeout=0.05)
+        committer.submit('a')
+        started.wait(10)
+        self.assertFalse(committer.store('b'))  # still queued:  dropped
+        release.set()
+        committer.stop(timeout=10)
+        self.assertEqual(applied, ['a'])
+
+    def test_commit_resolves_futures(self):
+        from concurrent.futures import Future
+        error = ValueError()
+        committer = self._makeOne(lambda items: [None, error])
+        batch = [('a', Future()), ('b', Future())]
+        committer.commit(batch)
+        self.assertEqual(batch[0][1].result(), None)
+        self.assertTrue(batch[1][1].exception() is error)
+
+    def test_commit_batch_fails(self):
+        from concurrent.futures import Future
+        from ZODB.POSException import ConflictError
+
+        def _apply_batch(items):
+            raise ConflictError()
+
+        committer = self._makeOne(_apply_batch)
+        batch = [('a', Future()), ('b', Future())]
+        committer.commit(batch)
+        for item, future in batch:
+            self.assertTrue(isinstance(future.exception(), ConflictError))
+
+    def test_concurrent_submits_share_batches(self):
+        import threading
+        committer = self._makeOne(max_items=5, max_delay=0.5)
+        futures = []
+        start = threading.Event()
+
+        def _submit(item):
+            start.wait()
+            futures.append(committer.submit(item))
+
+        threads = [threading.Thread(target=_submit, args=(x,))
+                   for x in range(10)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        for future in futures:
+            self.assertEqual(future.result(timeout=10), None)
+        committer.stop(timeout=10)
+        self.assertFalse(committer._thread.is_alive())
+        self.assertEqual(sorted(sum(self._batches, [])), list(range(10)))
+        self.assertTrue(len(self._batches) < 10)
+        self.assertTrue(all(len(x) <= 5 for x in self._batches))
+
+    def test_stop_commits_pending(self):
+        committer = self._makeOne(max_items=100, max_delay=60)
+        future = committer.submit('a')
+        committer.stop(timeout=10)
+        self.assertEqual(future.result(timeout=0), None)
+        self.assertEqual(self._batches, [['a']])
+        self.assertRaises(RuntimeError, committer.submit, 'b')
+
+
+class Test_get_group_committer(unittest.TestCase):
+
+    def _callFUT(self, registry):
+        from .groupcommit import get_group_committer
+        return get_group_committer(registry)
+
+    def test_disabled(self):
+        registry = testing.DummyResource(settings={})
+        self.assertEqual(self._callFUT(registry), None)
+
+    def test_enabled(self):
+        from .groupcommit import GroupCommitter
+        registry = testing.DummyResource(
+            settings={'travis_notify.group_commit': 'true',
+                      'travis_notify.group_commit_size': '20',
+                      'travis_notify.group_commit_delay': '5',
+                      'travis_notify.group_commit_timeout': '2.5',
+                     })
+        committer = self._callFUT(registry)
+        self.assertTrue(isinstance(committer, GroupCommitter))
+        self.assertEqual(committer.max_items, 20)
+        self.assertEqual(committer.max_delay, 0.005)
+        self.assertEqual(committer.timeout, 2.5)
+        self.assertTrue(self._callFUT(registry) is committer)
+
+
+class GroupCommitWebhookTests(unittest.TestCase):
+
+    def setUp(self):
+        from .benchmark import make_app
+        self.app = make_app(**{'travis_notify.group_commit': 'true',
+                               'travis_notify.group_commit_delay': '50'})
+        self.db = self.app.registry._zodb_databases['']
+
+    def tearDown(self):
+        from .benchmark import close_app
+        close_app(self.app)
+
+    def test_concurrent_webhooks(self):
+        from .benchmark import make_payload
+        from .benchmark import make_request
+        from concurrent.futures import ThreadPoolExecutor
+        from pyramid_mailer import get_mailer
+
+        def _post(number):
+            payload = make_payload(number, owner='owner', repo='repo')
+            request = make_request('owner/repo', payload)
+            return request.get_response(self.app).status_int
+
+        with ThreadPoolExecutor(8) as executor:
+            statuses = list(executor.map(_post, list(range(16)) + [3]))
+        self.assertEqual(set(statuses), set([200]))
+        with self.db.transaction() as conn:
+            repo = conn.root()['app_root']['owner']['repo']
+            numbers = sorted(int(x.number) for x in repo)
+        self.assertEqual(numbers, list(range(16)))
+        self.assertEqual(len(get_mailer(self.app.registry).outbox), 16)
+        committer = self.app.registry._travis_notify_committer
+        self.assertTrue(committer._thread.is_alive())
+
+    def test_timeout_returns_503(self):
+        from .benchmark import make_payload
+        from .benchmark import make_request
+        from .groupcommit import get_group_committer
+        import threading
+        release = threading.Event()
+        committer = get_group_committer(self.app.registry)
+        apply_batch = committer.apply_batch
+
+        def _apply_batch(items):
+            release.wait(10)
+            return apply_batch(items)
+
+        committer.apply_batch = _apply_batch
+        committer.timeout = 0.05
+        request = make_request('owner/repo',
+                               make_payload(1, owner='owner', repo='repo'))
+        try:
+            response = request.get_response(self.app)
+        finally:
+            release.set()
+        self.assertEqual(response.status_int, 503)
+
+    def test_unprocessable_payload(self):
+        from .benchmark import make_request
+        request = make_request('owner/repo', {'type': 'push'})
+        self.assertRaises(KeyError, request.get_response, self.app)
+        with self.db.transaction() as conn:
+            self.assertFalse('owner' in conn.root()['app_root'])
@@ -0,0 +1,428 @@
+import unittest
+
+from pyramid import testing
+
+
+def _run(coroutine):
+    import asyncio
+    return asyncio.run(coroutine)
+
+
+class _TempDirMixin(object):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+
+class WriteAheadLogTests(_TempDirMixin, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .ingest import WriteAheadLog
+        return WriteAheadLog
+
+    def _makeOne(self, **kw):
+        import os
+        self._fsynced = []
+
+        def _fsync(fileno):
+            self._fsynced.append(fileno)
+            os.fsync(fileno)
+
+        return self._getTargetClass()(self.tmpdir, fsync=_fsync, **kw)
+
+    def test_empty(self):
+        wal = self._makeOne()
+        self.assertEqual(wal.segments(), [1])
+        self.assertEqual(wal.load_checkpoint(), (1, 0))
+        self.assertEqual(wal.read((1, 0)), ([], (1, 0)))
+        wal.close()
+
+    def test_append_and_read(self):
+        wal = self._makeOne()
+        wal.append([{'n': 1}, {'n': 2}])
+        wal.append([{'n': 3}])
+        self.assertEqual(len(self._fsynced), 2)
+        records, position = wal.read((1, 0))
+        self.assertEqual([x['n'] for x in records], [1, 2, 3])
+        self.assertEqual(wal.read(position), ([], position))
+        records, middle = wal.read((1, 0), limit=2)
+        self.assertEqual([x['n'] for x in records], [1, 2])
+        self.assertEqual(wal.read(middle), ([{'n': 3}], position))
+        wal.close()
+
+    def test_segments(self):
+        wal = self._makeOne(segment_size=10)
+        for n in range(5):
+            wal.append([{'n': n}])
+        self.assertEqual(wal.segments(), [1, 2, 3])
+        records, position = wal.read((1, 0))
+        self.assertEqual([x['n'] for x in records], list(range(5)))
+        self.assertEqual(position[0], 3)
+        wal.close()
+
+    def test_read_races_append_and_rotate(self):
+        # A record appended (and its segment rotated) after the reader hit
+        # the end of the segment must be returned by the next read.
+        from . import ingest
+        wal = self._makeOne(segment_size=15)
+        wal.append([{'n': 0}])  # 9 bytes
+
+        class _File(object):
+            def __init__(self, f):
+                self._f = f
+            def __enter__(self):
+                return self
+            def __exit__(self, *exc_info):
+                self._f.close()
+            def seek(self, offset):
+                self._f.seek(offset)
+            def __iter__(self):
+                for line in self._f:
+                    yield line
+                if not appended:
+                    appended.append(True)
+                    wal.append([{'n': 1}])  # fills, and rotates, segment 1
+
+        appended = []
+        def _open(path, mode):
+            f = open(path, mode)
+            return mode == 'rb' and _File(f) or f
+
+        ingest.open = _open
+        try:
+            records, position = wal.read((1, 0))
+        finally:
+            del ingest.open
+        self.assertEqual(wal.segment, 2)
+        self.assertEqual([x['n'] for x in records], [0])
+        self.assertEqual(position[0], 1)
+        records, position = wal.read(position)
+        self.assertEqual([x['n'] for x in records], [1])
+        self.assertEqual(position, (2, 0))
+        wal.close()
+
+    def test_reopen_skips_torn_record(self):
+        import os
+        wal = self._makeOne()
+        wal.append([{'n': 1}])
+        wal.close()
+        with open(os.path.join(self.tmpdir, '0000000001.wal'), 'ab') as f:
+            f.write(b'{"n": 2')  # crashed mid-write
+        wal = self._makeOne()
+        self.assertEqual(wal.segments(), [1, 2])
+        wal.append([{'n': 3}])
+        records, position = wal.read(wal.load_checkpoint())
+        self.assertEqual([x['n'] for x in records], [1, 3])
+        self.assertEqual(position[0], 2)
+        wal.close()
+
+    def test_checkpoint(self):
+        wal = self._makeOne(segment_size=10)
+        for n in range(5):
+            wal.append([{'n': n}])
+        records, position = wal.read((1, 0), limit=3)
+        wal.checkpoint(position)
+        self.assertEqual(wal.segments(), [2, 3])
+        wal.close()
+        wal = self._makeOne()
+        self.assertEqual(wal.load_checkpoint(), position)
+        records, position = wal.read(position)
+        self.assertEqual([x['n'] for x in records], [3, 4])
+        wal.close()
+
+
+class AsyncAppenderTests(_TempDirMixin, unittest.TestCase):
+
+    def _makeOne(self, wal, on_append=None):
+        from .ingest import AsyncAppender
+        return AsyncAppender(wal, on_append)
+
+    def test_batches_concurrent_appends(self):
+        import asyncio
+
+        class DummyWAL(object):
+            def __init__(self):
+                self._appended = []
+            def append(self, records):
+                self._appended.append(list(records))
+
+        wal = DummyWAL()
+        _notified = []
+        appender = self._makeOne(wal, lambda: _notified.append(True))
+
+        async def _main():
+            await asyncio.gather(*[appender.append({'n': n})
+                                   for n in range(10)])
+            await appender.append({'n': 10})
+
+        _run(_main())
+        self.assertEqual(wal._appended, [[{'n': n} for n in range(10)],
+                                         [{'n': 10}]])
+        self.assertEqual(len(_notified), 2)
+
+    def test_append_fails(self):
+
+        class BrokenWAL(object):
+            def append(self, records):
+                raise OSError('disk full')
+
+        appender = self._makeOne(BrokenWAL())
+        self.assertRaises(OSError, _run, appender.append({'n': 1}))
+        self.assertFalse(appender._writing)
+
+
+class ApplierTests(_TempDirMixin, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .ingest import Applier
+        return Applier
+
+    def _makeOne(self, wal, apply_batch, **kw):
+        return self._getTargetClass()(wal, apply_batch, **kw)
+
+    def _makeWAL(self):
+        from .ingest import WriteAheadLog
+        return WriteAheadLog(self.tmpdir, segment_size=20)
+
+    def test_run_once(self):
+        _applied = []
+        wal = self._makeWAL()
+        for n in range(3):
+            wal.append([{'n': n}])
+        applier = self._makeOne(wal, _applied.append, batch_size=2)
+        self.assertEqual(applier.run_once(), 2)
+        self.assertEqual(applier.run_once(), 1)
+        self.assertEqual(applier.run_once(), 0)
+        self.assertEqual(_applied, [[{'n': 0}, {'n': 1}], [{'n': 2}]])
+        self.assertEqual(wal.load_checkpoint(), applier.position)
+        wal.close()
+
+    def test_failed_batch_is_not_checkpointed(self):
+        wal = self._makeWAL()
+        wal.append([{'n': 0}])
+
+        def _fail(records):
+            raise ValueError()
+
+        applier = self._makeOne(wal, _fail)
+        self.assertRaises(ValueError, applier.run_once)
+        self.assertEqual(applier.position, (1, 0))
+        self.assertEqual(wal.load_checkpoint(), (1, 0))
+        wal.close()
+
+    def test_thread_applies_until_stopped(self):
+        _applied = []
+        wal = self._makeWAL()
+        applier = self._makeOne(wal, _applied.extend, interval=60)
+        applier.start()
+        wal.append([{'n': 0}])
+        wal.append([{'n': 1}])
+        applier.notify()
+        applier.stop(timeout=10)
+        self.assertFalse(applier._thread.is_alive())
+        self.assertEqual(_applied, [{'n': 0}, {'n': 1}])
+        wal.close()
+
+
+def _makePayload(number):
+    from .benchmark import make_payload
+    return make_payload(number, owner='owner', repo='repo')
+
+
+class Test_make_batch_applier(unittest.TestCase):
+
+    def setUp(self):
+        from .benchmark import make_app
+        self.app = make_app()
+        self.registry = self.app.registry
+        self.db = self.registry._zodb_databases['']
+
+    def tearDown(self):
+        self.db.close()
+
+    def _callFUT(self):
+        from .ingest import make_batch_applier
+        return make_batch_applier(self.registry)
+
+    def _record(self, payload):
+        from json import dumps
+        return {'slug': 'owner/repo', 'payload': dumps(payload)}
+
+    def test_it(self):
+        from pyramid_mailer import get_mailer
+        apply_batch = self._callFUT()
+        self.assertEqual(
+            apply_batch([self._record(_makePayload(n)) for n in range(3)]),
+            [None, None, None])
+        apply_batch([self._record(_makePayload(1))])  # redelivery
+        with self.db.transaction() as conn:
+            repo = conn.root()['app_root']['owner']['repo']
+            self.assertEqual([x.number for x in repo], ['2', '1', '0'])
+        self.assertEqual(len(get_mailer(self.registry).outbox), 3)
+
+    def test_skips_unprocessable_records(self):
+        apply_batch = self._callFUT()
+        errors = apply_batch([self._record(_makePayload(1)),
+                              {'slug': 'owner/repo', 'payload': '{}'},
+                              self._record(_makePayload(2)),
+                             ])
+        self.assertEqual(errors[0], None)
+        self.assertTrue(isinstance(errors[1], KeyError))
+        self.assertEqual(errors[2], None)
+        with self.db.transaction() as conn:
+            repo = conn.root()['app_root']['owner']['repo']
+            self.assertEqual([x.number for x in repo], ['2', '1'])
+
+
+class IngestAppTests(_TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(IngestAppTests, self).setUp()
+        self.config = testing.setUp(
+            settings={'travis_notify.token': 'TOKEN'})
+
+    def tearDown(self):
+        testing.tearDown()
+        super(IngestAppTests, self).tearDown()
+
+    def _getTargetClass(self):
+        from .ingest import IngestApp
+        return IngestApp
+
+    def _makeOne(self, applier=None, **kw):
+        from .ingest import WriteAheadLog
+        self.wal = WriteAheadLog(self.tmpdir)
+        return self._getTargetClass()(self.config.registry, self.wal,
+                                      applier, **kw)
+
+    def _call(self, app, method='POST', slug='owner/repo', auth=None,
+              payload=None, chunks=None):
+        from hashlib import sha256
+        from urllib.parse import urlencode
+        headers = [(b'content-type', b'application/x-www-form-urlencoded')]
+        if slug is not None:
+            headers.append((b'travis-repo-slug', slug.encode('ascii')))
+            if auth is None:
+                auth = sha256((slug + 'TOKEN').encode('ascii')).hexdigest()
+        if auth:
+            headers.append((b'authorization', auth.encode('ascii')))
+        if chunks is None:
+            body = b''
+            if payload is not None:
+                body = urlencode({'payload': payload}).encode('ascii')
+            chunks = [body]
+        messages = [{'type': 'http.request', 'body': chunk,
+                     'more_body': True} for chunk in chunks]
+        messages[-1]['more_body'] = False
+        scope = {'type': 'http', 'method': method, 'path': '/',
+                 'headers': headers}
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        _run(app(scope, receive, send))
+        start, body = sent
+        return start['status'], body['body']
+
+    def _logged(self):
+        return self.wal.read(self.wal.load_checkpoint())[0]
+
+    def test_accepts_and_logs(self):
+        from json import dumps
+        _notified = []
+
+        class DummyApplier(object):
+            def notify(self):
+                _notified.append(True)
+
+        app = self._makeOne(DummyApplier())
+        payload = dumps(_makePayload(1))
+        self.assertEqual(self._call(app, payload=payload), (200, b'null'))
+        self.assertEqual(self._logged(),
+                         [{'slug': 'owner/repo', 'payload': payload}])
+        self.assertEqual(_notified, [True])
+
+    def test_chunked_body(self):
+        from json import dumps
+        from urllib.parse import urlencode
+        app = self._makeOne()
+        body = urlencode({'payload': dumps(_makePayload(1))}).encode('ascii')
+        status, _ = self._call(app, chunks=[body[:10], body[10:]])
+        self.assertEqual(status, 200)
+        self.assertEqual(len(self._logged()), 1)
+
+    def test_forbidden(self):
+        app = self._makeOne()
+        self.assertEqual(self._call(app, auth='bogus', payload='{}')[0], 403)
+        self.assertEqual(self._call(app, slug=None, payload='{}')[0], 403)
+        self.assertEqual(self._logged(), [])
+
+    def test_bad_payload(self):
+        app = self._makeOne()
+        self.assertEqual(self._call(app)[0], 400)
+        self.assertEqual(self._call(app, payload='{')[0], 400)
+        self.assertEqual(self._call(app, slug='owner', payload='{}')[0], 400)
+        self.assertEqual(self._logged(), [])
+
+    def test_method_not_allowed(self):
+        app = self._makeOne()
+        self.assertEqual(self._call(app, method='GET')[0], 405)
+
+    def test_too_large(self):
+        app = self._makeOne(max_body=10)
+        self.assertEqual(self._call(app, payload='{}' * 10)[0], 413)
+
+    def test_lifespan(self):
+        _called = []
+
+        class DummyApplier(object):
+            def notify(self):
+                pass
+            def start(self):
+                _called.append('start')
+            def stop(self):
+                _called.append('stop')
+
+        app = self._makeOne(DummyApplier())
+        messages = [{'type': 'lifespan.startup'},
+                    {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        _run(app({'type': 'lifespan'}, receive, send))
+        self.assertEqual(_called, ['start', 'stop'])
+        self.assertEqual(sent, ['lifespan.startup.complete',
+                                'lifespan.shutdown.complete'])
+
+
+class Test_make_ingest_app(_TempDirMixin, unittest.TestCase):
+
+    def test_it(self):
+        import os
+        from .benchmark import make_app
+        from .ingest import IngestApp
+        path = os.path.join(self.tmpdir, 'wal')
+        app = make_app(**{'travis_notify.ingest_wal_path': path,
+                          'travis_notify.ingest_batch_size': '7'})
+        try:
+            from .ingest import make_ingest_app
+            ingest = make_ingest_app(app.registry)
+            self.assertTrue(isinstance(ingest, IngestApp))
+            self.assertEqual(ingest.applier.batch_size, 7)
+            self.assertTrue(os.path.isdir(path))
+        finally:
+            app.registry._zodb_databases[''].close()
@@ -0,0 +1,423 @@
+import unittest
+
+
+class _QueueDirMixin(object):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        import transaction
+        transaction.abort()
+        shutil.rmtree(self.tmpdir)
+
+    def _queuePath(self):
+        import os
+        return os.path.join(self.tmpdir, 'queue')
+
+    def _enqueue(self, count=1, subject='Subject'):
+        from email.message import Message
+        import transaction
+        from .mailqueue import MailQueue
+        queue = MailQueue(self._queuePath())
+        for i in range(count):
+            message = Message()
+            message['Subject'] = '%s %d' % (subject, i)
+            message.set_payload('body')
+            queue.put('from@example.com', 'a@example.com, b@example.com',
+                      message)
+        transaction.commit()
+
+
+class Test_split_addresses(unittest.TestCase):
+
+    def _callFUT(self, addresses):
+        from .mailqueue import split_addresses
+        return split_addresses(addresses)
+
+    def test_string(self):
+        self.assertEqual(self._callFUT('a@example.com, b@example.com\nc@x'),
+                         ['a@example.com', 'b@example.com', 'c@x'])
+
+    def test_sequence(self):
+        self.assertEqual(self._callFUT(('a@example.com',)), ['a@example.com'])
+
+
+class Test_get_queue(_QueueDirMixin, unittest.TestCase):
+
+    def test_shared(self):
+        from .mailqueue import get_queue
+        queue = get_queue(self._queuePath())
+        self.assertTrue(get_queue(self._queuePath()) is queue)
+        self.assertEqual(queue.path, self._queuePath())
+
+
+class MailQueueTests(_QueueDirMixin, unittest.TestCase):
+
+    def test_put_commit(self):
+        import os
+        self._enqueue(2)
+        new = os.listdir(os.path.join(self._queuePath(), 'new'))
+        self.assertEqual(len(new), 2)
+
+    def test_put_abort(self):
+        import os
+        from email.message import Message
+        import transaction
+        from .mailqueue import MailQueue
+        queue = MailQueue(self._queuePath())
+        queue.put('from@example.com', ['a@example.com'], Message())
+        transaction.abort()
+        self.assertEqual(os.listdir(os.path.join(self._queuePath(), 'new')),
+                         [])
+
+
+class Test_parse_queued(_QueueDirMixin, unittest.TestCase):
+
+    def test_it(self):
+        import os
+        from .mailqueue import parse_queued
+        self._enqueue()
+        new = os.path.join(self._queuePath(), 'new')
+        with open(os.path.join(new, os.listdir(new)[0])) as f:
+            fromaddr, toaddrs, message = parse_queued(f)
+        self.assertEqual(fromaddr, 'from@example.com')
+        self.assertEqual(toaddrs, ['a@example.com', 'b@example.com'])
+        self.assertEqual(message['Subject'], 'Subject 0')
+        self.assertEqual(message['X-Actually-To'], None)
+
+
+class Test_smtp_factory_from_settings(unittest.TestCase):
+
+    def _callFUT(self, settings):
+        from .mailqueue import smtp_factory_from_settings
+        return smtp_factory_from_settings(settings)
+
+    def test_it(self):
+        import smtplib
+        _opened = []
+
+        class _SMTP(DummySMTP):
+            def __init__(self, host, port):
+                DummySMTP.__init__(self)
+                _opened.append((host, port))
+
+        settings = {'mail.host': 'smtp.example.com', 'mail.port': '2525',
+                    'mail.tls': 'true', 'mail.username': 'user',
+                    'mail.password': 'secret'}
+        factory = self._callFUT(settings)
+        original, smtplib.SMTP = smtplib.SMTP, _SMTP
+        try:
+            smtp = factory()
+        finally:
+            smtplib.SMTP = original
+        self.assertEqual(_opened, [('smtp.example.com', 2525)])
+        self.assertTrue(smtp.tls)
+        self.assertEqual(smtp.login_info, ('user', 'secret'))
+
+
+class DeliveryWorkerPoolTests(_QueueDirMixin, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .mailqueue import DeliveryWorkerPool
+        return DeliveryWorkerPool
+
+    def _makeOne(self, smtp_factory, **kw):
+        return self._getTargetClass()(self._queuePath(), smtp_factory, **kw)
+
+    def _failed(self):
+        import os
+        return os.listdir(os.path.join(self._queuePath(), 'failed'))
+
+    def test_run_once_empty(self):
+        server = DummySMTPServer()
+        pool = self._makeOne(server.connect)
+        self.assertEqual(pool.run_once(), 0)
+        self.assertEqual(server.sessions, [])
+
+    def test_run_once_batches_sessions(self):
+        server = DummySMTPServer()
+        self._enqueue(5)
+        pool = self._makeOne(server.connect, batch_size=2, workers=2)
+        self.assertEqual(pool.run_once(), 5)
+        self.assertEqual(sorted(len(x.sent) for x in server.sessions),
+                         [1, 2, 2])
+        self.assertTrue(all(x.closed for x in server.sessions))
+        fromaddr, toaddrs, body = server.sessions[0].sent[0]
+        self.assertEqual(fromaddr, 'from@example.com')
+        self.assertEqual(toaddrs, ['a@example.com', 'b@example.com'])
+        self.assertEqual(pool.pending(), [])
+
+    def test_connect_failure_retries_with_backoff(self):
+        now = [1000.0]
+        server = DummySMTPServer(connect_error=OSError('refused'))
+        self._enqueue(1)
+        pool = self._makeOne(server.connect, backoff=10, clock=lambda: now[0])
+        self.assertEqual(pool.run_once(), 0)
+        self.assertEqual(pool.pending(), [])
+        now[0] += 10
+        self.assertEqual(pool.run_once(), 0)  # second attempt
+        now[0] += 10
+        self.assertEqual(pool.pending(), [])  # backoff doubled
+        server.connect_error = None
+        now[0] += 10
+        self.assertEqual(pool.run_once(), 1)
+
+    def test_transient_reply_exhausts_attempts(self):
+        import smtplib
+        server = DummySMTPServer(
+            send_error=smtplib.SMTPDataError(451, 'try later'))
+        self._enqueue(1)
+        pool = self._makeOne(server.connect, max_attempts=2, backoff=0)
+        pool.run_once()
+        self.assertEqual(self._failed(), [])
+        pool.run_once()
+        self.assertEqual(len(self._failed()), 1)
+        self.assertEqual(pool.pending(), [])
+
+    def test_permanent_reply_fails_immediately(self):
+        import smtplib
+        server = DummySMTPServer(
+            send_error=smtplib.SMTPDataError(550, 'no such user'))
+        self._enqueue(1)
+        pool = self._makeOne(server.connect)
+        self.assertEqual(pool.run_once(), 0)
+        self.assertEqual(len(self._failed()), 1)
+
+    def test_recipients_refused_fails_immediately(self):
+        import smtplib
+        server = DummySMTPServer(
+            send_error=smtplib.SMTPRecipientsRefused({}))
+        self._enqueue(1)
+        pool = self._makeOne(server.connect)
+        pool.run_once()
+        self.assertEqual(len(self._failed()), 1)
+
+    def test_disconnect_retries_rest_of_batch(self):
+        import smtplib
+        server = DummySMTPServer(
+            send_error=smtplib.SMTPServerDisconnected('gone'))
+        self._enqueue(3)
+        pool = self._makeOne(server.connect, backoff=60)
+        self.assertEqual(pool.run_once(), 0)
+        self.assertEqual(len(server.sessions), 1)
+        self.assertEqual(server.sessions[0].attempts, 1)
+        self.assertEqual(pool.pending(), [])
+        self.assertEqual(self._failed(), [])
+
+    def test_run_forever_stops(self):
+        import threading
+        server = DummySMTPServer()
+        self._enqueue(1)
+        pool = self._makeOne(server.connect)
+        stop = threading.Event()
+        original = pool.run_once
+        def _run_once():
+            stop.set()
+            return original()
+        pool.run_once = _run_once
+        pool.run_forever(interval=0, stop=stop)
+        self.assertEqual(len(server.sessions), 1)
+
+
+class SMTPDeliveryTests(_QueueDirMixin, unittest.TestCase):
+    """Deliver through ``smtplib`` to an SMTP listener on localhost.
+    """
+    def setUp(self):
+        _QueueDirMixin.setUp(self)
+        self.server = LocalSMTPServer()
+
+    def tearDown(self):
+        self.server.close()
+        _QueueDirMixin.tearDown(self)
+
+    def _makePool(self, **kw):
+        from .mailqueue import DeliveryWorkerPool
+        from .mailqueue import smtp_factory_from_settings
+        host, port = self.server.address
+        factory = smtp_factory_from_settings({'mail.host': host,
+                                              'mail.port': str(port)})
+        return DeliveryWorkerPool(self._queuePath(), factory, **kw)
+
+    def _failed(self):
+        import os
+        return os.listdir(os.path.join(self._queuePath(), 'failed'))
+
+    def test_delivers(self):
+        from email.parser import Parser
+        self._enqueue(3)
+        pool = self._makePool(batch_size=2)
+        self.assertEqual(pool.run_once(), 3)
+        self.assertEqual(list(pool.maildir), [])
+        self.assertEqual(len(self.server.messages), 3)
+        mailfrom, rcpttos, data = self.server.messages[0]
+        self.assertEqual(mailfrom, 'from@example.com')
+        self.assertEqual(rcpttos, ['a@example.com', 'b@example.com'])
+        message = Parser().parsestr(data)
+        self.assertTrue(message['Subject'].startswith('Subject '))
+        self.assertEqual(message['X-Actually-From'], None)
+        self.assertEqual(message.get_payload(), 'body')
+
+    def test_transient_reply_retried(self):
+        self.server.replies['DATA'] = '451 try again later'
+        self._enqueue(1)
+        pool = self._makePool(backoff=60)
+        self.assertEqual(pool.run_once(), 0)
+        self.assertEqual(len(list(pool.maildir)), 1)
+        self.assertEqual(pool.pending(), [])  # backing off
+        self.assertEqual(self._failed(), [])
+
+    def test_permanent_reply_fails(self):
+        self.server.replies['DATA'] = '554 rejected'
+        self._enqueue(1)
+        pool = self._makePool()
+        self.assertEqual(pool.run_once(), 0)
+        self.assertEqual(list(pool.maildir), [])
+        self.assertEqual(len(self._failed()), 1)
+
+    def test_recipients_refused_fail(self):
+        self.server.replies['RCPT'] = '550 no such user'
+        self._enqueue(1)
+        pool = self._makePool()
+        self.assertEqual(pool.run_once(), 0)
+        self.assertEqual(len(self._failed()), 1)
+        self.assertEqual(self.server.messages, [])
+
+    def test_server_down_retried(self):
+        self._enqueue(1)
+        self.server.close()
+        pool = self._makePool(backoff=60)
+        self.assertEqual(pool.run_once(), 0)
+        self.assertEqual(len(list(pool.maildir)), 1)
+        self.assertEqual(self._failed(), [])
+
+
+class LocalSMTPServer(object):
+    """Minimal SMTP listener on localhost, served from a thread.
+
+    Records ``(mailfrom, rcpttos, data)`` for each accepted message;
+    ``replies`` maps a command ('MAIL', 'RCPT' or 'DATA', for the reply to
+    the message data) to the reply to send instead of accepting it.
+    """
+    def __init__(self):
+        import socketserver
+        import threading
+        smtp = self
+        self.messages = []
+        self.replies = {}
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode('ascii') + b'\r\n')
+
+            def handle(self):
+                self.reply('220 localhost ESMTP')
+                mailfrom, rcpttos = None, []
+                for line in self.rfile:
+                    line = line.decode('utf-8').rstrip('\r\n')
+                    verb, _, arg = line.partition(' ')
+                    verb = verb.upper()
+                    if verb in ('EHLO', 'HELO'):
+                        self.reply('250 localhost')
+                    elif verb == 'MAIL':
+                        mailfrom = _address(arg)
+                        self.reply(smtp.replies.get('MAIL', '250 OK'))
+                    elif verb == 'RCPT':
+                        reply = smtp.replies.get('RCPT', '250 OK')
+                        if reply.startswith('250'):
+                            rcpttos.append(_address(arg))
+                        self.reply(reply)
+                    elif verb == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        data = []
+                        for line in self.rfile:
+                            line = line.decode('utf-8').rstrip('\r\n')
+                            if line == '.':
+                                break
+                            data.append(line[1:] if line[:1] == '.'
+                                        else line)
+                        reply = smtp.replies.get('DATA', '250 OK')
+                        if reply.startswith('250'):
+                            smtp.messages.append((mailfrom, rcpttos,
+                                                  '\n'.join(data)))
+                        self.reply(reply)
+                        mailfrom, rcpttos = None, []
+                    elif verb in ('RSET', 'NOOP'):
+                        if verb == 'RSET':
+                            mailfrom, rcpttos = None, []
+                        self.reply('250 OK')
+                    elif verb == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('502 Command not implemented')
+
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                                       Handler)
+        self._server.daemon_threads = True
+        self.address = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs={'poll_interval': 0.01})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._thread = None
+
+
+def _address(arg):
+    # 'FROM:<a@example.com> SIZE=42' -> 'a@example.com'
+    return arg.partition(':')[2].split()[0].strip('<>')
+
+
+class DummySMTP(object):
+    """Local stand-in for an SMTP session.
+    """
+    tls = False
+    login_info = None
+
+    def __init__(self, send_error=None):
+        self.sent = []
+        self.attempts = 0
+        self.closed = False
+        self.send_error = send_error
+
+    def starttls(self):
+        self.tls = True
+
+    def login(self, username, password):
+        self.login_info = (username, password)
+
+    def sendmail(self, fromaddr, toaddrs, body):
+        self.attempts += 1
+        if self.send_error is not None:
+            raise self.send_error
+        self.sent.append((fromaddr, toaddrs, body))
+
+    def quit(self):
+        self.closed = True
+
+
+class DummySMTPServer(object):
+    """Local stand-in for an SMTP server, recording each session.
+    """
+    def __init__(self, connect_error=None, send_error=None):
+        import threading
+        self.connect_error = connect_error
+        self.send_error = send_error
+        self.sessions = []
+        self._lock = threading.Lock()
+
+    def connect(self):
+        if self.connect_error is not None:
+            raise self.connect_error
+        session = DummySMTP(self.send_error)
+        with self._lock:
+            self.sessions.append(session)
+        return session
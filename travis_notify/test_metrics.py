@@ -0,0 +1,245 @@
+import unittest
+
+from pyramid import testing
+
+
+class CounterTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .metrics import Counter
+        return Counter
+
+    def _makeOne(self, name='test_total', help='Help.'):
+        return self._getTargetClass()(name, help)
+
+    def test_inc(self):
+        counter = self._makeOne()
+        counter.inc()
+        counter.inc(2)
+        self.assertEqual(list(counter.samples()), [('test_total', '', 3)])
+
+
+class HistogramTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .metrics import Histogram
+        return Histogram
+
+    def _makeOne(self, name='test_seconds', help='Help.', **kw):
+        return self._getTargetClass()(name, help, **kw)
+
+    def test_samples_empty(self):
+        self.assertEqual(list(self._makeOne().samples()), [])
+
+    def test_observe(self):
+        histogram = self._makeOne(buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(2.0)
+        self.assertEqual(list(histogram.samples()), [
+            ('test_seconds_bucket', '{le="0.1"}', 2),
+            ('test_seconds_bucket', '{le="1.0"}', 3),
+            ('test_seconds_bucket', '{le="+Inf"}', 4),
+            ('test_seconds_sum', '', 2.65),
+            ('test_seconds_count', '', 4),
+        ])
+
+    def test_observe_labelled(self):
+        histogram = self._makeOne(label='stage', buckets=(1.0,))
+        histogram.observe(2.0, 'mail')
+        histogram.observe(0.5, 'auth')
+        self.assertEqual(list(histogram.samples()), [
+            ('test_seconds_bucket', '{stage="auth",le="1.0"}', 1),
+            ('test_seconds_bucket', '{stage="auth",le="+Inf"}', 1),
+            ('test_seconds_sum', '{stage="auth"}', 0.5),
+            ('test_seconds_count', '{stage="auth"}', 1),
+            ('test_seconds_bucket', '{stage="mail",le="1.0"}', 0),
+            ('test_seconds_bucket', '{stage="mail",le="+Inf"}', 1),
+            ('test_seconds_sum', '{stage="mail"}', 2.0),
+            ('test_seconds_count', '{stage="mail"}', 1),
+        ])
+
+    def test_time(self):
+        times = [1.0, 1.25]
+        histogram = self._makeOne(buckets=(1.0,))
+        try:
+            with histogram.time(clock=lambda: times.pop(0)):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(list(histogram.samples())[-2:], [
+            ('test_seconds_sum', '', 0.25),
+            ('test_seconds_count', '', 1),
+        ])
+
+
+class MetricsTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .metrics import Metrics
+        return Metrics
+
+    def test_render(self):
+        from .metrics import Counter
+        from .metrics import Histogram
+        metrics = self._getTargetClass()()
+        metrics.add(Counter('test_total', 'Things.')).inc()
+        metrics.add(Histogram('test_seconds', 'Time.',
+                              buckets=(1.0,))).observe(0.5)
+        self.assertEqual(metrics.render(), '\n'.join([
+            '# HELP test_total Things.',
+            '# TYPE test_total counter',
+            'test_total 1',
+            '# HELP test_seconds Time.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="1.0"} 1',
+            'test_seconds_bucket{le="+Inf"} 1',
+            'test_seconds_sum 0.5',
+            'test_seconds_count 1',
+        ]) + '\n')
+
+
+class Test_time_commit(unittest.TestCase):
+
+    def _callFUT(self, txn, clock):
+        from .metrics import time_commit
+        return time_commit(txn, clock)
+
+    def _commits(self):
+        from .metrics import STAGE_SECONDS
+        series = STAGE_SECONDS._series.get('commit')
+        return series and sum(series[0]) or 0
+
+    def test_commit(self):
+        import transaction
+        times = [1.0, 1.5]
+        manager = transaction.TransactionManager()
+        txn = manager.begin()
+        before = self._commits()
+        self._callFUT(txn, lambda: times.pop(0))
+        self._callFUT(txn, lambda: times.pop(0))  # once per transaction
+        txn.commit()
+        self.assertEqual(self._commits(), before + 1)
+        self.assertEqual(times, [])
+
+    def test_abort(self):
+        import transaction
+        manager = transaction.TransactionManager()
+        txn = manager.begin()
+        before = self._commits()
+        self._callFUT(txn, lambda: 1.0)
+        txn.abort()
+        self.assertEqual(self._commits(), before)
+
+
+class Test_metrics_tween_factory(unittest.TestCase):
+
+    def _callFUT(self, handler, registry):
+        from .metrics import metrics_tween_factory
+        return metrics_tween_factory(handler, registry)
+
+    def _handler(self, request):
+        self._handled.append(request)
+        return request.response
+
+    def setUp(self):
+        self._handled = []
+
+    def test_metrics(self):
+        from .metrics import CONTENT_TYPE
+        registry = testing.DummyResource(
+            settings={'travis_notify.metrics_path': '/metrics'})
+        tween = self._callFUT(self._handler, registry)
+        request = testing.DummyRequest(path='/metrics')
+        response = tween(request)
+        self.assertEqual(self._handled, [])
+        self.assertEqual(response.content_type, CONTENT_TYPE.split(';')[0])
+        self.assertTrue('# TYPE travis_notify_webhooks_received_total '
+                        'counter' in response.text)
+
+    def test_other_path(self):
+        from .metrics import REQUEST_SECONDS
+        series = REQUEST_SECONDS._series.get('GET')
+        before = series and sum(series[0]) or 0
+        registry = testing.DummyResource(settings={})
+        tween = self._callFUT(self._handler, registry)
+        request = testing.DummyRequest(path='/owner')
+        tween(request)
+        self.assertEqual(self._handled, [request])
+        self.assertEqual(sum(REQUEST_SECONDS._series['GET'][0]), before + 1)
+
+    def test_unknown_methods_share_a_series(self):
+        from .metrics import REQUEST_SECONDS
+        registry = testing.DummyResource(settings={})
+        tween = self._callFUT(self._handler, registry)
+        series = REQUEST_SECONDS._series.get('other')
+        before = series and sum(series[0]) or 0
+        for method in ('BREW', 'WHEN', 'get'):
+            tween(testing.DummyRequest(path='/', method=method))
+        self.assertEqual(sum(REQUEST_SECONDS._series['other'][0]),
+                         before + 3)
+        self.assertFalse('BREW' in REQUEST_SECONDS._series)
+
+    def test_disabled_by_default(self):
+        registry = testing.DummyResource(settings={})
+        tween = self._callFUT(self._handler, registry)
+        request = testing.DummyRequest(path='/metrics')
+        tween(request)
+        self.assertEqual(self._handled, [request])
+
+    def test_disabled(self):
+        registry = testing.DummyResource(
+            settings={'travis_notify.metrics_path': ''})
+        tween = self._callFUT(self._handler, registry)
+        request = testing.DummyRequest(path='/metrics')
+        tween(request)
+        self.assertEqual(self._handled, [request])
+
+
+class MetricsWebhookTests(unittest.TestCase):
+
+    def setUp(self):
+        from .benchmark import make_app
+        self.app = make_app(**{'travis_notify.metrics_path': '/metrics'})
+
+    def tearDown(self):
+        from .benchmark import close_app
+        close_app(self.app)
+
+    def _values(self):
+        from .metrics import CONFLICT_RETRIES
+        from .metrics import MAILS
+        from .metrics import WEBHOOKS_DUPLICATED
+        from .metrics import WEBHOOKS_RECEIVED
+        from .metrics import WEBHOOKS_REJECTED
+        return [x.value for x in (WEBHOOKS_RECEIVED, WEBHOOKS_REJECTED,
+                                  WEBHOOKS_DUPLICATED, MAILS,
+                                  CONFLICT_RETRIES)]
+
+    def test_webhooks(self):
+        from .benchmark import make_payload
+        from .benchmark import make_request
+        before = self._values()
+        payload = make_payload(1, owner='owner', repo='repo')
+        for x in range(2):
+            request = make_request('owner/repo', payload)
+            self.assertEqual(request.get_response(self.app).status_int, 200)
+        request = make_request('owner/repo', payload)
+        request.headers['Authorization'] = 'bogus'
+        self.assertEqual(request.get_response(self.app).status_int, 403)
+        after = self._values()
+        self.assertEqual([y - x for x, y in zip(before, after)],
+                         [3, 1, 1, 1, 0])
+
+    def test_metrics_opens_no_connection(self):
+        from webob import Request
+        db = self.app.registry._zodb_databases['']
+        opened = []
+        db_open = db.open
+        db.open = lambda *arg, **kw: opened.append(1) or db_open(*arg, **kw)
+        response = Request.blank('/metrics').get_response(self.app)
+        self.assertEqual(response.status_int, 200)
+        self.assertTrue('travis_notify_webhooks_received_total '
+                        in response.text)
+        self.assertEqual(opened, [])
@@ -0,0 +1,123 @@
+import unittest
+
+
+def _makeRepo(count):
+    from appendonly import AppendStack
+    from .models import Repo
+    repo = Repo()
+    repo._recent = AppendStack(2, 2)
+    for number in range(count):
+        repo.pushItem({'number': str(number), 'matrix': [{'id': number}]})
+    return repo
+
+
+class Test_migrate_repo(unittest.TestCase):
+
+    def _callFUT(self, repo, keep_raw=False, commit=None):
+        from .migrate import migrate_repo
+        return migrate_repo(repo, keep_raw, commit)
+
+    def test_it(self):
+        from .models import BuildRecord
+        repo = _makeRepo(9)
+        _commits = []
+        count = self._callFUT(repo, commit=lambda: _commits.append(True))
+        self.assertEqual(count, 9)
+        self.assertEqual(len(_commits), 3)  # one per archive layer
+        items = list(repo)
+        self.assertTrue(all(isinstance(x, BuildRecord) for x in items))
+        self.assertEqual([x.number for x in items],
+                         [str(x) for x in range(8, -1, -1)])
+        self.assertEqual(items[0].raw, None)
+
+    def test_keep_raw_and_idempotent(self):
+        repo = _makeRepo(3)
+        self.assertEqual(self._callFUT(repo, keep_raw=True), 3)
+        self.assertEqual(list(repo)[0].payload,
+                         {'number': '2', 'matrix': [{'id': 2}]})
+        self.assertEqual(self._callFUT(repo), 0)
+
+    def test_moves_inline_raw_aside(self):
+        import zlib
+        from .models import RawPayload
+        repo = _makeRepo(3)
+        self._callFUT(repo)
+        layer = repo._recent._layers[0]  # newest first
+        layer._stack[-1] = layer._stack[-1]._replace(
+            raw=zlib.compress(b'{"number": "2"}'))
+        # Counts the items of the rewritten layer.
+        self.assertEqual(self._callFUT(repo), len(layer._stack))
+        record = list(repo)[0]
+        self.assertTrue(isinstance(record.raw, RawPayload))
+        self.assertEqual(record.payload, {'number': '2'})
+
+    def test_replaces_plain_append_stack(self):
+        from .models import RecentStack
+        repo = _makeRepo(3)  # an AppendStack(2, 2)
+        layers = [(x._generation, list(x._stack))
+                  for x in repo._recent._layers]
+        self._callFUT(repo)
+        self.assertTrue(isinstance(repo._recent, RecentStack))
+        self.assertEqual((repo._recent._max_layers, repo._recent._max_length),
+                         (2, 2))
+        self.assertEqual([x._generation for x in repo._recent._layers],
+                         [x[0] for x in layers])
+        self.assertEqual([x.number for x in repo], ['2', '1', '0'])
+
+
+class Test_migrate(unittest.TestCase):
+
+    def _callFUT(self, root, keep_raw=False, commit=None):
+        from .migrate import migrate
+        return migrate(root, keep_raw, commit)
+
+    def test_it(self):
+        from pyramid import testing
+        from .models import Root
+        root = Root()
+        owner = root.find_create('owner')
+        owner['repo1'] = _makeRepo(3)
+        owner['repo2'] = _makeRepo(2)
+        owner['other'] = testing.DummyResource()
+        _commits = []
+        count = self._callFUT(root, commit=lambda: _commits.append(True))
+        self.assertEqual(count, 5)
+        self.assertEqual(len(_commits), 2)  # one per repo
+        self.assertEqual([(x, y.number) for x, y in owner.latest()],
+                         [('repo1', '2'), ('repo2', '1')])
+        self.assertEqual([x for x, y in root.latest()],
+                         ['owner/repo1', 'owner/repo2'])
+
+    def test_indexes_history(self):
+        from .models import Root
+        root = Root()
+        owner = root.find_create('owner')
+        owner['repo'] = _makeRepo(5)
+        owner['repo']._index = None  # predates the index
+        self._callFUT(root)
+        items, cursor = owner['repo'].history()
+        self.assertEqual([x['number'] for x in items],
+                         ['4', '3', '2', '1', '0'])
+
+    def test_indexes_history_pushed_to_before_migrating(self):
+        from .models import Root
+        root = Root()
+        owner = root.find_create('owner')
+        repo = owner['repo'] = _makeRepo(3)
+        repo._index = None
+        repo.pushItem({'number': '3'})  # creates a partial index
+        self._callFUT(root)
+        self.assertEqual(len(repo.index), 4)
+        self.assertEqual(repo.index.by_number(0)['number'], '0')
+
+    def test_indexes_archive_layers(self):
+        from appendonly import AppendStack
+        from .models import Root
+        root = Root()
+        repo = root.find_create('owner').find_create('repo')
+        repo._recent = AppendStack(1, 2)
+        for number in range(5):
+            repo.pushItem({'number': str(number)})
+        repo._archived = None  # predates the index
+        self._callFUT(root)
+        self.assertEqual(list(repo._archived.keys()), [0, 1])
@@ -3,6 +3,523 @@ import unittest
 from pyramid import testing
 
 
+class Test_status_summary(unittest.TestCase):
+
+    def _callFUT(self, payload):
+        from .models import status_summary
+        return status_summary(payload)
+
+    def test_ok(self):
+        payload = {'status': 0, 'status_message': 'Fixed'}
+        self.assertEqual(self._callFUT(payload), 'OK')
+
+    def test_failed(self):
+        for msg in ('Broken', 'Failed', 'Still Failing'):
+            payload = {'status': 1, 'status_message': msg}
+            self.assertEqual(self._callFUT(payload), 'FAILED')
+
+    def test_unknown(self):
+        payload = {'status': 1, 'status_message': 'Pending'}
+        self.assertEqual(self._callFUT(payload), 'UNKNOWN')
+
+
+class Test_build_time(unittest.TestCase):
+
+    def _callFUT(self, item):
+        from .models import build_time
+        return build_time(item)
+
+    def test_it(self):
+        self.assertEqual(self._callFUT({'finished_at': '1970-01-02T00:00:01Z'}),
+                         86401)
+
+    def test_missing_or_bad(self):
+        self.assertEqual(self._callFUT({}), None)
+        self.assertEqual(self._callFUT({'finished_at': None}), None)
+        self.assertEqual(self._callFUT({'finished_at': 'yesterday'}), None)
+
+
+_EPOCH = 1500000000  # 2017-07-14T02:40:00Z
+
+
+def _makePayload(number, branch='master', status=0, status_message='Passed'):
+    return {
+        'id': int(number) + 1000,
+        'number': str(number),
+        'type': 'push',
+        'status': status,
+        'status_message': status_message,
+        'branch': branch,
+        'commit': 'c%s' % number,
+    }
+
+
+class BuildRecordTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .models import BuildRecord
+        return BuildRecord
+
+    def _makePayload(self):
+        payload = _makePayload(7)
+        payload['repository'] = {'name': 'repo', 'owner_name': 'owner'}
+        payload['matrix'] = [{'id': 1, 'config': {}}]
+        return payload
+
+    def test_fromPayload_wo_raw(self):
+        klass = self._getTargetClass()
+        record = klass.fromPayload(self._makePayload())
+        self.assertEqual(record.number, '7')
+        self.assertEqual(record['commit'], 'c7')
+        self.assertEqual(record.get('repository_name'), 'repo')
+        self.assertEqual(record.get('nonesuch', 'default'), 'default')
+        self.assertEqual(record[0], 1007)
+        self.assertEqual(record.raw, None)
+        self.assertEqual(record.payload, None)
+        self.assertRaises(KeyError, record.__getitem__, 'matrix')
+
+    def test_fromPayload_w_raw(self):
+        from .models import RawPayload
+        klass = self._getTargetClass()
+        payload = self._makePayload()
+        record = klass.fromPayload(payload, keep_raw=True)
+        self.assertTrue(isinstance(record.raw, RawPayload))
+        self.assertEqual(record.payload, payload)
+        self.assertEqual(record.asDict(), payload)
+
+    def test_fromPayload_w_raw_stored_aside(self):
+        from persistent.mapping import PersistentMapping
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        klass = self._getTargetClass()
+        payload = self._makePayload()
+        payload['config'] = {'language': 'python', 'script': ['tox'] * 200}
+        db = DB(MappingStorage())
+        try:
+            with db.transaction() as conn:
+                layer = conn.root()['layer'] = PersistentMapping()
+                layer['record'] = klass.fromPayload(payload, keep_raw=True)
+            with db.transaction() as conn:
+                conn.cacheMinimize()
+                layer = conn.root()['layer']
+                record = layer['record']
+                self.assertEqual(record.raw._p_status, 'ghost')
+                self.assertEqual(record.payload, payload)
+                self.assertEqual(record.raw._p_status, 'ghost')
+                state, tid = db.storage.load(layer._p_oid)
+                self.assertFalse(record.raw.data in state)
+        finally:
+            db.close()
+
+    def test_payload_w_inline_raw(self):
+        import zlib
+        klass = self._getTargetClass()
+        record = klass.fromPayload(self._makePayload())
+        record = record._replace(raw=zlib.compress(b'{"number": "7"}'))
+        self.assertEqual(record.payload, {'number': '7'})
+
+    def test_asDict_wo_raw(self):
+        klass = self._getTargetClass()
+        info = klass.fromPayload(self._makePayload()).asDict()
+        self.assertEqual(info['number'], '7')
+        self.assertEqual(info['repository'],
+                         {'name': 'repo', 'owner_name': 'owner'})
+        self.assertFalse('matrix' in info)
+        self.assertFalse('raw' in info)
+
+    def test_pickle_roundtrip_smaller_than_payload(self):
+        import pickle
+        klass = self._getTargetClass()
+        payload = self._makePayload()
+        payload['config'] = {'language': 'python', 'script': ['tox'] * 20}
+        record = klass.fromPayload(payload)
+        self.assertEqual(pickle.loads(pickle.dumps(record)), record)
+        self.assertTrue(len(pickle.dumps(record)) < len(pickle.dumps(payload)))
+
+
+class Test_as_record(unittest.TestCase):
+
+    def _callFUT(self, item, keep_raw=False):
+        from .models import as_record
+        return as_record(item, keep_raw)
+
+    def test_dict(self):
+        from .models import BuildRecord
+        record = self._callFUT({'number': '1'}, keep_raw=True)
+        self.assertTrue(isinstance(record, BuildRecord))
+        self.assertEqual(record.payload, {'number': '1'})
+
+    def test_other(self):
+        item = object()
+        self.assertTrue(self._callFUT(item) is item)
+
+    def test_record_w_inline_raw(self):
+        import zlib
+        from .models import BuildRecord
+        from .models import RawPayload
+        inline = BuildRecord.fromPayload({'number': '1'})._replace(
+            raw=zlib.compress(b'{"number": "1"}'))
+        record = self._callFUT(inline)
+        self.assertTrue(isinstance(record.raw, RawPayload))
+        self.assertEqual(record.payload, {'number': '1'})
+        self.assertTrue(self._callFUT(record) is record)
+
+
+class RepoIndexTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .models import RepoIndex
+        return RepoIndex
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def _populate(self, index):
+        # 1..10, even numbers on 'master', every third build failed.
+        for number in range(1, 11):
+            branch = number % 2 and 'feature' or 'master'
+            if number % 3:
+                index.add(_makePayload(number, branch), stamp=number)
+            else:
+                index.add(_makePayload(number, branch, 1, 'Failed'),
+                          stamp=number)
+
+    def test_empty(self):
+        index = self._makeOne()
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.query(), ([], None))
+        self.assertEqual(index.by_number(1), None)
+        self.assertRaises(KeyError, index.get, -1)
+        self.assertEqual(index._entries, None)  # trees created on demand
+
+    def test_add_returns_unique_keys(self):
+        index = self._makeOne()
+        key1 = index.add(_makePayload(1), stamp=5)
+        key2 = index.add(_makePayload(2), stamp=5)
+        self.assertEqual(key1, -5)
+        self.assertEqual(key2, -6)
+        self.assertEqual(len(index), 2)
+
+    def test_add_wo_stamp(self):
+        index = self._makeOne()
+        key = index.add({})
+        self.assertTrue(key < 0)
+        self.assertEqual(index.get(key)['summary'], 'UNKNOWN')
+
+    def test_by_number(self):
+        index = self._makeOne()
+        self._populate(index)
+        entry = index.by_number(3)
+        self.assertEqual(entry['number'], '3')
+        self.assertEqual(entry['id'], 1003)
+        self.assertEqual(entry['summary'], 'FAILED')
+
+    def test_query_pages_newest_first(self):
+        index = self._makeOne()
+        self._populate(index)
+        items, cursor = index.query(limit=4)
+        self.assertEqual([x['number'] for x in items], ['10', '9', '8', '7'])
+        items, cursor = index.query(cursor=cursor, limit=4)
+        self.assertEqual([x['number'] for x in items], ['6', '5', '4', '3'])
+        items, cursor = index.query(cursor=cursor, limit=4)
+        self.assertEqual([x['number'] for x in items], ['2', '1'])
+        self.assertEqual(cursor, None)
+
+    def test_query_exact_last_page(self):
+        index = self._makeOne()
+        self._populate(index)
+        items, cursor = index.query(limit=10)
+        self.assertEqual(len(items), 10)
+        self.assertEqual(cursor, None)
+
+    def test_query_offset(self):
+        index = self._makeOne()
+        self._populate(index)
+        items, cursor = index.query(offset=8, limit=4)
+        self.assertEqual([x['number'] for x in items], ['2', '1'])
+
+    def test_query_filters(self):
+        index = self._makeOne()
+        self._populate(index)
+        items, cursor = index.query(branch='master', status='FAILED')
+        self.assertEqual([x['number'] for x in items], ['6'])
+        items, cursor = index.query(status='FAILED', limit=2)
+        self.assertEqual([x['number'] for x in items], ['9', '6'])
+        items, cursor = index.query(status='FAILED', cursor=cursor)
+        self.assertEqual([x['number'] for x in items], ['3'])
+
+    def test_query_filter_miss(self):
+        index = self._makeOne()
+        self._populate(index)
+        self.assertEqual(index.query(branch='nonesuch'), ([], None))
+
+    def test_add_w_shard(self):
+        index = self._makeOne()
+        key1 = index.add(_makePayload(1), stamp=5, shard=3, shards=8)
+        key2 = index.add(_makePayload(2), stamp=5, shard=3, shards=8)
+        self.assertEqual(key1, -43)
+        self.assertEqual(key2, -51)
+
+    def test_prune(self):
+        index = self._makeOne()
+        self._populate(index)
+        self.assertEqual(index.prune(-3), 3)  # builds 3, 2, 1
+        self.assertEqual(len(index), 7)
+        self.assertEqual(index.by_number(3), None)
+        self.assertEqual(index.by_number(4)['number'], '4')
+        items, cursor = index.query(status='FAILED')
+        self.assertEqual([x['number'] for x in items], ['9', '6'])
+        self.assertEqual(index.query(branch='feature', cursor=-5)[0], [])
+
+    def test_prune_empty(self):
+        index = self._makeOne()
+        self.assertEqual(index.prune(0), 0)
+
+
+class ShardedIndexTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .models import ShardedIndex
+        return ShardedIndex
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def _populate(self, index):
+        # As for RepoIndexTests, spread round-robin across the shards.
+        for number in range(1, 11):
+            branch = number % 2 and 'feature' or 'master'
+            shard = number % len(index._shards)
+            if number % 3:
+                index.add(_makePayload(number, branch), number, shard)
+            else:
+                index.add(_makePayload(number, branch, 1, 'Failed'),
+                          number, shard)
+
+    def test_empty(self):
+        index = self._makeOne()
+        self.assertEqual(len(index._shards), 8)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.query(), ([], None))
+        self.assertEqual(index.by_number(1), None)
+
+    def test_add_uses_shard(self):
+        index = self._makeOne(4)
+        key = index.add(_makePayload(1), stamp=5, shard=2)
+        self.assertEqual(key, -22)
+        self.assertEqual(len(index._shards[2]), 1)
+        self.assertEqual(index.get(key)['number'], '1')
+
+    def test_add_wo_shard_uses_thread_shard(self):
+        import itertools
+        import threading
+        from . import models
+        index = self._makeOne(4)
+        # Number this thread, and the next, independently of other tests.
+        saved = models._shard_counter, getattr(models._shard_local,
+                                               'number', None)
+        models._shard_counter = itertools.count(1)
+        models._shard_local.number = 0
+        try:
+            index.add(_makePayload(1))
+            index.add(_makePayload(2))
+            thread = threading.Thread(target=index.add,
+                                      args=(_makePayload(3),))
+            thread.start()
+            thread.join()
+        finally:
+            models._shard_counter, models._shard_local.number = saved
+        self.assertEqual(len(index), 3)
+        self.assertEqual(sorted(len(x) for x in index._shards),
+                         [0, 0, 1, 2])
+
+    def test_same_stamp_in_different_shards(self):
+        index = self._makeOne(4)
+        key1 = index.add(_makePayload(1), stamp=5, shard=0)
+        key2 = index.add(_makePayload(2), stamp=5, shard=1)
+        self.assertNotEqual(key1, key2)
+        self.assertEqual(index.get(key1)['number'], '1')
+        self.assertEqual(index.get(key2)['number'], '2')
+
+    def test_by_number_prefers_newest(self):
+        index = self._makeOne(4)
+        index.add(_makePayload(1, 'old'), stamp=5, shard=0)
+        index.add(_makePayload(1, 'new'), stamp=6, shard=1)
+        self.assertEqual(index.by_number(1)['branch'], 'new')
+
+    def test_query_merges_shards(self):
+        index = self._makeOne(3)
+        self._populate(index)
+        self.assertEqual(len(index), 10)
+        items, cursor = index.query(limit=4)
+        self.assertEqual([x['number'] for x in items], ['10', '9', '8', '7'])
+        items, cursor = index.query(cursor=cursor, limit=4)
+        self.assertEqual([x['number'] for x in items], ['6', '5', '4', '3'])
+        items, cursor = index.query(cursor=cursor, limit=4)
+        self.assertEqual([x['number'] for x in items], ['2', '1'])
+        self.assertEqual(cursor, None)
+
+    def test_query_offset_and_filters(self):
+        index = self._makeOne(3)
+        self._populate(index)
+        items, cursor = index.query(offset=8, limit=4)
+        self.assertEqual([x['number'] for x in items], ['2', '1'])
+        items, cursor = index.query(status='FAILED', limit=2)
+        self.assertEqual([x['number'] for x in items], ['9', '6'])
+        items, cursor = index.query(status='FAILED', cursor=cursor)
+        self.assertEqual([x['number'] for x in items], ['3'])
+        self.assertEqual(index.query(branch='nonesuch'), ([], None))
+
+    def test_prune(self):
+        index = self._makeOne(3)
+        self._populate(index)
+        self.assertEqual(index.prune(4), 6)
+        items, cursor = index.query()
+        self.assertEqual([x['number'] for x in items], ['10', '9', '8', '7'])
+
+    def test_prune_noop(self):
+        index = self._makeOne(3)
+        self._populate(index)
+        self.assertEqual(index.prune(20), 0)
+        self.assertEqual(len(index), 10)
+
+
+class DeliveryLogTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .models import DeliveryLog
+        return DeliveryLog
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def test_add_and_contains(self):
+        log = self._makeOne()
+        self.assertFalse('a' in log)
+        log.add('a')
+        self.assertTrue('a' in log)
+        self.assertEqual(len(log), 1)
+
+    def test_contains_expired(self):
+        log = self._makeOne(window=10)
+        log.add('a', stamp=1000.0)
+        self.assertFalse('a' in log)
+
+    def test_add_evicts_oldest(self):
+        log = self._makeOne(max_entries=2, window=0)
+        log.add('a', stamp=1.0)
+        log.add('b', stamp=2.0)
+        log.add('c', stamp=3.0)
+        self.assertEqual(sorted(log._seen), ['b', 'c'])
+
+    def test_add_evicts_expired(self):
+        log = self._makeOne(window=10)
+        log.add('a', stamp=1.0)
+        log.add('b', stamp=20.0)
+        self.assertEqual(sorted(log._seen), ['b'])
+
+    def test__p_resolveConflict_merges_additions(self):
+        log = self._makeOne(max_entries=3, window=0)
+        old = {'max_entries': 3, 'window': 0, '_seen': {'a': 1.0}}
+        committed = {'max_entries': 3, 'window': 0,
+                     '_seen': {'a': 1.0, 'b': 2.0}}
+        new = {'max_entries': 3, 'window': 0,
+               '_seen': {'a': 1.0, 'c': 3.0}}
+        resolved = log._p_resolveConflict(old, committed, new)
+        self.assertEqual(resolved['_seen'], {'a': 1.0, 'b': 2.0, 'c': 3.0})
+
+    def test__p_resolveConflict_trims(self):
+        log = self._makeOne(max_entries=2, window=0)
+        old = {'max_entries': 2, 'window': 0, '_seen': {'a': 1.0}}
+        committed = {'max_entries': 2, 'window': 0,
+                     '_seen': {'a': 1.0, 'b': 2.0}}
+        new = {'max_entries': 2, 'window': 0,
+               '_seen': {'a': 1.0, 'c': 3.0}}
+        resolved = log._p_resolveConflict(old, committed, new)
+        self.assertEqual(resolved['_seen'], {'b': 2.0, 'c': 3.0})
+
+    def test__p_resolveConflict_w_changed_size(self):
+        from ZODB.POSException import ConflictError
+        log = self._makeOne()
+        old = {'max_entries': 2, 'window': 0, '_seen': {}}
+        committed = {'max_entries': 3, 'window': 0, '_seen': {}}
+        self.assertRaises(ConflictError,
+                          log._p_resolveConflict, old, committed, old)
+
+    def test_concurrent_adds_commit_wo_conflict(self):
+        import os
+        import shutil
+        import tempfile
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.FileStorage import FileStorage
+        tmpdir = tempfile.mkdtemp()
+        db = DB(FileStorage(os.path.join(tmpdir, 'Data.fs')))
+        try:
+            with db.transaction() as conn:
+                conn.root()['log'] = self._makeOne()
+            tms = [transaction.TransactionManager() for i in range(2)]
+            conns = [db.open(transaction_manager=tm) for tm in tms]
+            for key, conn in zip('ab', conns):
+                conn.root()['log'].add(key)
+            for tm in tms:
+                tm.commit()
+            with db.transaction() as conn:
+                self.assertEqual(sorted(conn.root()['log']._seen), ['a', 'b'])
+        finally:
+            db.close()
+            shutil.rmtree(tmpdir)
+
+
+class StatusBoardTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .models import StatusBoard
+        return StatusBoard
+
+    def _makeOne(self):
+        return self._getTargetClass()()
+
+    def _makeLatest(self, stamp, status='OK', number='1'):
+        from .models import LatestBuild
+        return LatestBuild(status, 'master', 'abc', number, stamp)
+
+    def test_update(self):
+        board = self._makeOne()
+        self.assertEqual(board.get('repo'), None)
+        self.assertTrue(board.update('repo', self._makeLatest(2.0)))
+        self.assertFalse(board.update('repo', self._makeLatest(1.0, 'FAILED')))
+        self.assertEqual(board.get('repo').status, 'OK')
+        self.assertTrue(board.update('repo', self._makeLatest(3.0, 'FAILED')))
+        self.assertEqual(board.get('repo').status, 'FAILED')
+        self.assertTrue(board.update('other', self._makeLatest(1.0)))
+        self.assertEqual(len(board), 2)
+        self.assertEqual([x for x, y in board.items()], ['other', 'repo'])
+        self.assertEqual(board.changes, 3)
+        self.assertTrue(isinstance(board._latest['repo'], tuple))
+
+    def test__p_resolveConflict(self):
+        old = {'_latest': {'a': ('OK', 'm', 'c', '1', 1.0),
+                           'b': ('OK', 'm', 'c', '1', 1.0)},
+               'changes': 2}
+        committed = {'_latest': {'a': ('FAILED', 'm', 'c', '2', 3.0),
+                                 'b': ('OK', 'm', 'c', '1', 1.0),
+                                 'c': ('OK', 'm', 'c', '1', 2.0)},
+                     'changes': 4}
+        new = {'_latest': {'a': ('OK', 'm', 'c', '3', 2.0),  # older
+                           'b': ('FAILED', 'm', 'c', '2', 2.0),
+                           'd': ('OK', 'm', 'c', '1', 2.0)},
+               'changes': 5}
+        resolved = self._makeOne()._p_resolveConflict(old, committed, new)
+        self.assertEqual(resolved['_latest'], {
+            'a': ('FAILED', 'm', 'c', '2', 3.0),
+            'b': ('FAILED', 'm', 'c', '2', 2.0),
+            'c': ('OK', 'm', 'c', '1', 2.0),
+            'd': ('OK', 'm', 'c', '1', 2.0),
+        })
+        self.assertEqual(resolved['changes'], 7)
+
+
 class RootTests(unittest.TestCase):
 
     def _getTargetClass(self):
@@ -28,6 +545,15 @@ class RootTests(unittest.TestCase):
         root['extant'] = extant = testing.DummyResource()
         self.assertTrue(root.find_create('extant') is extant)
 
+    def test_find_create_bumps_serial(self):
+        root = self._makeOne()
+        self.assertEqual(root.serial, 0)
+        self.assertEqual(root.modified, None)
+        root.find_create('one')
+        root.find_create('one')
+        root.find_create('two')
+        self.assertEqual(root.serial, 2)
+
 
 class OwnerTests(unittest.TestCase):
 
@@ -54,6 +580,11 @@ class OwnerTests(unittest.TestCase):
         owner['extant'] = extant = testing.DummyResource()
         self.assertTrue(owner.find_create('extant') is extant)
 
+    def test_find_create_bumps_serial(self):
+        owner = self._makeOne()
+        owner.find_create('one')
+        self.assertEqual(owner.serial, 1)
+
 
 class RepoTests(unittest.TestCase):
 
@@ -82,6 +613,529 @@ class RepoTests(unittest.TestCase):
         self.assertEqual(list(repo.recent), rev[:1])
         self.assertEqual(list(repo.archive), rev[1:])
 
+    def test_iterExport_wo_jar(self):
+        from appendonly import AppendStack
+        repo = self._makeOne()
+        repo._recent = AppendStack(1, 2)
+        pushed = ['a', 'b', 'c', 'd', 'e']
+        for push in pushed:
+            repo.pushItem(push)
+        self.assertEqual(list(repo.iterExport()), list(reversed(pushed)))
+
+    def test_iterExport_ghosts_archive_layers(self):
+        from appendonly import AppendStack
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        db = DB(MappingStorage())
+        try:
+            tm = transaction.TransactionManager()
+            conn = db.open(transaction_manager=tm)
+            repo = conn.root()['repo'] = self._makeOne()
+            repo._recent = AppendStack(1, 2)
+            for push in range(9):
+                repo.pushItem(push)
+            tm.commit()
+            layers = []
+            layer = repo._archive._head
+            while layer is not None:
+                layers.append(layer)
+                layer = layer._next
+            self.assertEqual(len(layers), 4)
+            self.assertEqual(list(repo.iterExport()), list(range(8, -1, -1)))
+            self.assertEqual([x._p_status for x in layers], ['ghost'] * 4)
+        finally:
+            db.close()
+
+    def test_page(self):
+        from appendonly import AppendStack
+        repo = self._makeOne()
+        repo._recent = AppendStack(2, 2)
+        for push in range(9):
+            repo.pushItem(push)
+        pages = []
+        cursor = None
+        while True:
+            items, cursor = repo.page(cursor, limit=4)
+            pages.append(items)
+            if cursor is None:
+                break
+        self.assertEqual(pages, [[8, 7, 6, 5], [4, 3, 2, 1], [0]])
+
+    def test_page_exact_fit(self):
+        repo = self._makeOne()
+        for push in range(4):
+            repo.pushItem(push)
+        self.assertEqual(repo.page(limit=4), ([3, 2, 1, 0], None))
+        self.assertEqual(repo.page(limit=2), ([3, 2], (0, 2)))
+        self.assertEqual(repo.page((0, 0)), ([], None))
+
+    def test_page_cursor_survives_archiving(self):
+        from appendonly import AppendStack
+        repo = self._makeOne()
+        repo._recent = AppendStack(2, 2)
+        for push in range(4):
+            repo.pushItem(push)
+        items, cursor = repo.page(limit=1)
+        self.assertEqual(items, [3])
+        for push in range(4, 8):  # moves 3 .. 0 to the archive
+            repo.pushItem(push)
+        self.assertEqual(repo.page(cursor, limit=10), ([2, 1, 0], None))
+
+    def test_page_ghosts_archive_layers(self):
+        from appendonly import AppendStack
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        db = DB(MappingStorage())
+        try:
+            tm = transaction.TransactionManager()
+            conn = db.open(transaction_manager=tm)
+            repo = conn.root()['repo'] = self._makeOne()
+            repo._recent = AppendStack(1, 2)
+            for push in range(9):
+                repo.pushItem(push)
+            tm.commit()
+            layers = []
+            layer = repo._archive._head
+            while layer is not None:
+                layers.append(layer)
+                layer = layer._next
+            conn.cacheMinimize()
+            loaded = []
+            load = conn._storage.load
+
+            def _load(oid):
+                loaded.append(oid)
+                return load(oid)
+
+            conn._storage.load = _load
+            items, cursor = repo.page((2, 0), limit=2)
+            self.assertEqual(items, [3, 2])
+            self.assertEqual(cursor, (1, 0))
+            self.assertEqual([x._p_status for x in layers[:3]],
+                             ['ghost'] * 3)
+            self.assertFalse(layers[0]._p_oid in loaded)  # newer:  skipped
+            self.assertTrue(layers[2]._p_oid in loaded)
+        finally:
+            db.close()
+
+    def test_page_wo_layer_index(self):
+        from appendonly import AppendStack
+        repo = self._makeOne()
+        repo._recent = AppendStack(1, 2)
+        for push in range(9):
+            repo.pushItem(push)
+        repo._archived = None  # predates the index
+        self.assertEqual(repo.page((2, 0), limit=2), ([3, 2], (1, 0)))
+
+    def test_page_cursor_older_than_archive(self):
+        from appendonly import AppendStack
+        repo = self._makeOne()
+        repo._recent = AppendStack(1, 2)
+        for push in range(9):
+            repo.pushItem(push)
+        repo.prune(keep=5)
+        self.assertEqual(repo.page((1, 0)), ([], None))
+
+    def test_index_layers(self):
+        from appendonly import AppendStack
+        repo = self._makeOne()
+        repo._recent = AppendStack(1, 2)
+        for push in range(9):
+            repo.pushItem(push)
+        expected = list(repo._archived.items())
+        repo._archived = None
+        archived = repo.index_layers()
+        self.assertTrue(repo._archived is archived)
+        self.assertEqual(list(archived.items()), expected)
+        self.assertEqual(list(archived.keys()), [0, 1, 2, 3])
+
+    def test_pushItem_indexes_payloads(self):
+        repo = self._makeOne()
+        repo.pushItem(_makePayload(1))
+        repo.pushItem(_makePayload(2, status=1, status_message='Broken'))
+        items, cursor = repo.history(status='FAILED')
+        self.assertEqual([x['number'] for x in items], ['2'])
+        self.assertEqual(len(repo.index), 2)
+
+    def test_pushItem_notifies_change_listeners(self):
+        import transaction
+        from . import models
+        _changes = []
+
+        def _listener(resource, txn, below):
+            _changes.append((resource, txn, below))
+
+        models.change_listeners.append(_listener)
+        try:
+            repo = self._makeOne()
+            repo.pushItem('a')
+        finally:
+            models.change_listeners.remove(_listener)
+        self.assertEqual(_changes, [(repo, transaction.get(), True)])
+
+    def test_pushItem_notifies_in_connections_transaction(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        from . import models
+        _txns = []
+
+        def _listener(resource, txn, below):
+            _txns.append(txn)
+
+        db = DB(MappingStorage())
+        models.change_listeners.append(_listener)
+        try:
+            tm = transaction.TransactionManager()
+            conn = db.open(transaction_manager=tm)
+            owner = conn.root()['owner'] = models.Owner()
+            tm.commit()
+            repo = owner.find_create('repo')  # not yet in a connection
+            repo.pushItem(_makePayload(1))
+            self.assertTrue(_txns)
+            self.assertTrue(all(x is tm.get() for x in _txns))
+            self.assertFalse(_txns[0] is transaction.get())
+            tm.abort()
+        finally:
+            models.change_listeners.remove(_listener)
+            db.close()
+
+    def test_pushItem_bumps_serial(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        db = DB(MappingStorage())
+        try:
+            tm = transaction.TransactionManager()
+            conn = db.open(transaction_manager=tm)
+            repo = conn.root()['repo'] = self._makeOne()
+            self.assertEqual(repo.serial, 0)
+            repo.pushItem('a')
+            repo.pushItem('b')
+            tm.commit()
+            self.assertEqual(repo.serial, 2)
+            self.assertTrue(repo.modified > 0)
+        finally:
+            transaction.abort()
+            db.close()
+
+    def test_pushItem_records_latest(self):
+        from .models import Root
+        root = Root()
+        repo = root.find_create('owner').find_create('repo')
+        owner_serial, root_serial = repo.__parent__.serial, root.serial
+        repo.pushItem(_makePayload(1, branch='fix', status=1,
+                                   status_message='Broken'))
+        [(name, latest)] = repo.__parent__.latest()
+        self.assertEqual(name, 'repo')
+        self.assertEqual(latest.status, 'FAILED')
+        self.assertEqual(latest.branch, 'fix')
+        self.assertEqual(latest.number, '1')
+        [(name, latest)] = root.latest()
+        self.assertEqual(name, 'owner/repo')
+        self.assertEqual(repo.__parent__.serial, owner_serial + 1)
+        self.assertEqual(root.serial, root_serial + 1)
+
+    def test_pushItem_wo_parents(self):
+        repo = self._makeOne()
+        repo.pushItem(_makePayload(1))  # no boards to update
+        self.assertEqual(len(list(repo)), 1)
+
+    def test_record_latest_default(self):
+        from .models import Root
+        root = Root()
+        repo = root.find_create('owner').find_create('repo')
+        repo.record_latest()  # empty:  nothing to record
+        self.assertEqual(root.latest(), [])
+        self.assertEqual(root['owner']._board, None)
+        repo._recent.push(_makePayload(7))
+        repo.record_latest(stamp=5.0)
+        [(name, latest)] = root.latest()
+        self.assertEqual((latest.number, latest.stamp), ('7', 5.0))
+
+    def test_record_latest_by_finished_at(self):
+        from .models import Root
+        root = Root()
+        repo = root.find_create('owner').find_create('repo')
+        newer = _makePayload(2, status=1, status_message='Broken')
+        newer['finished_at'] = '2014-06-25T21:40:36Z'
+        older = _makePayload(1)
+        older['finished_at'] = '2014-06-25T21:00:00Z'
+        repo.pushItem(newer)
+        repo.pushItem(older)  # delivered late
+        [(name, latest)] = root.latest()
+        self.assertEqual((latest.number, latest.status), ('2', 'FAILED'))
+        self.assertEqual(latest.stamp, 1403732436)
+
+    def test_concurrent_pushItem_different_owners_share_nothing(self):
+        # MappingStorage resolves no conflicts at all.
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        from .models import Root
+        db = DB(MappingStorage())
+        try:
+            with db.transaction() as conn:
+                root = conn.root()['app_root'] = Root()
+                for name in ('owner1', 'owner2'):
+                    root.find_create(name).find_create('repo').pushItem(
+                        _makePayload(0))
+            tms = [transaction.TransactionManager() for i in range(2)]
+            conns = [db.open(transaction_manager=tm) for tm in tms]
+            for name, conn in zip(('owner1', 'owner2'), conns):
+                repo = conn.root()['app_root'][name]['repo']
+                repo.pushItem(_makePayload(1))
+            for tm in tms:
+                tm.commit()
+            with db.transaction() as conn:
+                root = conn.root()['app_root']
+                self.assertEqual([(x, y.number) for x, y in root.latest()],
+                                 [('owner1/repo', '1'), ('owner2/repo', '1')])
+        finally:
+            db.close()
+
+    def test_concurrent_pushItem_updates_boards_wo_conflict(self):
+        import os
+        import shutil
+        import tempfile
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.FileStorage import FileStorage
+        from .models import Root
+        tmpdir = tempfile.mkdtemp()
+        db = DB(FileStorage(os.path.join(tmpdir, 'Data.fs')))
+        try:
+            with db.transaction() as conn:
+                root = conn.root()['app_root'] = Root()
+                owner = root.find_create('owner')
+                for name in ('repo1', 'repo2'):
+                    owner.find_create(name).pushItem(_makePayload(0))
+            tms = [transaction.TransactionManager() for i in range(2)]
+            conns = [db.open(transaction_manager=tm) for tm in tms]
+            for name, status, conn in zip(('repo1', 'repo2'),
+                                          (0, 1), conns):
+                owner = conn.root()['app_root']['owner']
+                owner[name].pushItem(_makePayload(1, status=status,
+                                                  status_message='Broken'))
+            for tm in tms:
+                tm.commit()
+            with db.transaction() as conn:
+                root = conn.root()['app_root']
+                self.assertEqual(
+                    [(x, y.status, y.number) for x, y in root.latest()],
+                    [('owner/repo1', 'OK', '1'),
+                     ('owner/repo2', 'FAILED', '1')])
+                self.assertEqual(
+                    [(x, y.status) for x, y in root['owner'].latest()],
+                    [('repo1', 'OK'), ('repo2', 'FAILED')])
+                self.assertEqual(root['owner'].serial, 6)  # 2 repos + 4
+                self.assertEqual(root.serial, 5)  # 1 owner + 4
+        finally:
+            db.close()
+            shutil.rmtree(tmpdir)
+
+    def test_concurrent_pushItem_commits_wo_conflict(self):
+        import os
+        import shutil
+        import tempfile
+        import threading
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.FileStorage import FileStorage
+        tmpdir = tempfile.mkdtemp()
+        db = DB(FileStorage(os.path.join(tmpdir, 'Data.fs')))
+        try:
+            with db.transaction() as conn:
+                repo = conn.root()['repo'] = self._makeOne()
+                for number in range(100):
+                    repo.pushItem(_makePayload(number))
+            tms = [transaction.TransactionManager() for i in range(2)]
+            conns = [db.open(transaction_manager=tm) for tm in tms]
+
+            def push(repo, numbers):
+                for number in numbers:
+                    repo.pushItem(_makePayload(number))
+
+            # Push enough from each to split the index's buckets, from
+            # separate threads, as the webhook views would.
+            for start, conn in zip((100, 200), conns):
+                thread = threading.Thread(
+                    target=push,
+                    args=(conn.root()['repo'], range(start, start + 50)))
+                thread.start()
+                thread.join()
+            for tm in tms:
+                tm.commit()
+            with db.transaction() as conn:
+                repo = conn.root()['repo']
+                self.assertEqual(len(repo.index), 200)
+                self.assertEqual(len(list(repo)), 200)
+                self.assertEqual(repo.serial, 200)
+                self.assertEqual(repo.index.by_number(249)['number'], '249')
+        finally:
+            db.close()
+            shutil.rmtree(tmpdir)
+
+    def test_concurrent_pushItem_overflowing_recent_conflicts(self):
+        import os
+        import shutil
+        import tempfile
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.FileStorage import FileStorage
+        from ZODB.POSException import ConflictError
+        from .models import RecentStack
+        tmpdir = tempfile.mkdtemp()
+        db = DB(FileStorage(os.path.join(tmpdir, 'Data.fs')))
+        try:
+            with db.transaction() as conn:
+                repo = conn.root()['repo'] = self._makeOne()
+                repo._recent = RecentStack(2, 2)
+                for number in range(3):  # layers [0, 1], [2]
+                    repo.pushItem(_makePayload(number))
+            tms = [transaction.TransactionManager() for i in range(2)]
+            conns = [db.open(transaction_manager=tm) for tm in tms]
+            for number, conn in zip((10, 20), conns):
+                conn.root()['repo'].pushItem(_makePayload(number))
+            tms[0].commit()
+            self.assertRaises(ConflictError, tms[1].commit)
+            tms[1].abort()
+            conns[1].root()['repo'].pushItem(_makePayload(20))  # retried
+            tms[1].commit()
+            with db.transaction() as conn:
+                repo = conn.root()['repo']
+                self.assertEqual([x['number'] for x in repo],
+                                 ['20', '10', '2', '1', '0'])
+                self.assertEqual(len(repo.index), 5)
+        finally:
+            db.close()
+            shutil.rmtree(tmpdir)
+
+    def test_pushItem_w_delivery(self):
+        repo = self._makeOne()
+        self.assertFalse(repo.seen('123:abc:0:Passed'))
+        repo.pushItem(_makePayload(1), '123:abc:0:Passed')
+        self.assertTrue(repo.seen('123:abc:0:Passed'))
+        self.assertFalse(repo.seen('123:abc:1:Failed'))
+
+    def test_deliveries_created_on_demand(self):
+        repo = self._makeOne()
+        del repo._deliveries
+        self.assertFalse(repo.seen('a'))
+        repo.pushItem(_makePayload(1), 'a')
+        self.assertTrue(repo.seen('a'))
+
+    def _makeArchived(self, count, finished=False):
+        # Layers of two items, one of them recent:  the rest archived.
+        # If ``finished``, build N finished N days after _EPOCH.
+        from appendonly import AppendStack
+        import time
+        repo = self._makeOne()
+        repo._recent = AppendStack(1, 2)
+        for number in range(count):
+            payload = _makePayload(number)
+            if finished:
+                payload['finished_at'] = time.strftime(
+                    '%Y-%m-%dT%H:%M:%SZ',
+                    time.gmtime(_EPOCH + number * 86400))
+            repo.pushItem(payload)
+        return repo
+
+    def test_prune_keep(self):
+        repo = self._makeArchived(9)
+        self.assertEqual(repo.prune(keep=4), 4)  # layers [0, 1], [2, 3]
+        self.assertEqual([x['number'] for x in repo],
+                         ['8', '7', '6', '5', '4'])
+        self.assertEqual(list(repo._archived.keys()), [2, 3])
+        self.assertEqual(len(repo.index), 5)
+        self.assertEqual(repo.index.by_number(3), None)
+        self.assertEqual(repo.serial, 10)
+
+    def test_prune_keep_all_archived(self):
+        repo = self._makeArchived(5)
+        self.assertEqual(repo.prune(keep=1), 4)
+        self.assertEqual([x['number'] for x in repo], ['4'])
+        self.assertEqual(repo._archive._head, None)
+        repo.pushItem(_makePayload(5))
+        repo.pushItem(_makePayload(6))
+        self.assertEqual([x['number'] for x in repo], ['6', '5', '4'])
+
+    def test_prune_noop(self):
+        repo = self._makeArchived(5)
+        self.assertEqual(repo.prune(), 0)
+        self.assertEqual(repo.prune(keep=5), 0)
+        self.assertEqual(len(list(repo)), 5)
+        self.assertEqual(repo.serial, 5)
+
+    def test_prune_before(self):
+        repo = self._makeArchived(5, finished=True)  # finished 0 .. 4 days
+        day = 86400
+        self.assertEqual(repo.prune(before=_EPOCH + day), 0)
+        self.assertEqual(repo.prune(before=_EPOCH + 1.5 * day), 2)
+        self.assertEqual([x['number'] for x in repo], ['4', '3', '2'])
+        self.assertEqual(len(repo.index), 3)
+        self.assertEqual(repo.prune(before=_EPOCH + 3.5 * day), 2)
+        self.assertEqual([x['number'] for x in repo], ['4'])
+
+    def test_prune_before_ignores_mtime(self):
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        db = DB(MappingStorage())
+        try:
+            with db.transaction() as conn:
+                repo = conn.root()['repo'] = self._makeArchived(
+                    5, finished=True)
+            with db.transaction() as conn:  # e.g. by travis_notify_migrate
+                repo = conn.root()['repo']
+                layer = repo._archive._head
+                while layer is not None:
+                    layer._p_changed = True
+                    layer = layer._next
+            with db.transaction() as conn:
+                repo = conn.root()['repo']
+                self.assertEqual(repo.prune(before=_EPOCH + 10 * 86400), 4)
+        finally:
+            db.close()
+
+    def test_prune_before_keeps_unfinished(self):
+        repo = self._makeArchived(5)
+        self.assertEqual(repo.prune(before=_EPOCH + 10 ** 10), 0)
+
+    def test_recent_sizes(self):
+        from .models import Repo
+        saved = Repo.recent_layers, Repo.layer_size
+        Repo.recent_layers, Repo.layer_size = 3, 7
+        try:
+            repo = self._makeOne()
+        finally:
+            Repo.recent_layers, Repo.layer_size = saved
+        self.assertEqual(repo._recent._max_layers, 3)
+        self.assertEqual(repo._recent._max_length, 7)
+
+    def test_index_created_on_demand(self):
+        repo = self._makeOne()
+        del repo._index
+        repo.pushItem(_makePayload(1))
+        self.assertEqual(len(repo.index), 1)
+
+    def test_pushItem_indexes_records(self):
+        from .models import BuildRecord
+        repo = self._makeOne()
+        repo.pushItem(BuildRecord.fromPayload(_makePayload(1)))
+        self.assertEqual(repo.index.by_number(1)['commit'], 'c1')
+
+    def test_reindex(self):
+        repo = self._makeOne()
+        for number in range(1, 4):
+            repo.pushItem(_makePayload(number))
+        repo._index = None
+        index = repo.reindex()
+        self.assertTrue(repo.index is index)
+        items, cursor = repo.history()
+        self.assertEqual([x['number'] for x in items], ['3', '2', '1'])
+
 
 class Test_appmaker(unittest.TestCase):
 
@@ -0,0 +1,306 @@
+import unittest
+
+from pyramid import testing
+
+
+def _makeResponse(body=b'<html/>', content_type='text/html', status=200):
+    from pyramid.response import Response
+    response = Response(body=body, content_type=content_type, status=status)
+    response.headers['Set-Cookie'] = 'foo=bar'
+    return response
+
+
+class PageCacheTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .pagecache import PageCache
+        return PageCache
+
+    def _makeOne(self, max_entries=10, ttl=300):
+        self._now = [1000.0]
+        return self._getTargetClass()(max_entries, ttl,
+                                      clock=lambda: self._now[0])
+
+    def test_get_miss(self):
+        cache = self._makeOne()
+        self.assertEqual(cache.get('/'), None)
+
+    def test_set_get(self):
+        cache = self._makeOne()
+        entry = cache.set('/', _makeResponse(), cache.generation)
+        self.assertTrue(cache.get('/') is entry)
+        self.assertEqual(entry.body, b'<html/>')
+        self.assertEqual(entry.last_modified, 1000)
+        self.assertEqual(entry.cached_at, 1000.0)
+        self.assertFalse('Set-Cookie' in dict(entry.headerlist))
+
+    def test_set_keeps_view_validators(self):
+        cache = self._makeOne(ttl=10)
+        response = _makeResponse()
+        response.etag = '42'
+        response.last_modified = 500
+        entry = cache.set('/', response, cache.generation)
+        self.assertEqual(entry.etag, '42')
+        self.assertEqual(entry.last_modified, 500)
+        self.assertTrue(cache.get('/') is entry)  # TTL from cached_at
+
+    def test_set_after_invalidation_skipped(self):
+        cache = self._makeOne()
+        generation = cache.generation
+        cache.invalidate('/owner')
+        self.assertEqual(cache.set('/', _makeResponse(), generation), None)
+        self.assertEqual(cache.get('/'), None)
+
+    def test_ttl(self):
+        cache = self._makeOne(ttl=10)
+        cache.set('/', _makeResponse(), cache.generation)
+        self._now[0] += 10
+        self.assertEqual(cache.get('/'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_bound(self):
+        cache = self._makeOne(max_entries=2)
+        cache.set('/a', _makeResponse(), cache.generation)
+        cache.set('/b', _makeResponse(), cache.generation)
+        cache.get('/a')
+        cache.set('/c', _makeResponse(), cache.generation)
+        self.assertEqual(cache.get('/b'), None)
+        self.assertNotEqual(cache.get('/a'), None)
+        self.assertNotEqual(cache.get('/c'), None)
+
+    def test_invalidate_path_and_below(self):
+        cache = self._makeOne()
+        for key in ('/', '/owner', '/owner/repo/', '/owner/repo/history?x=1',
+                    '/owner/repository'):
+            cache.set(key, _makeResponse(), cache.generation)
+        cache.invalidate('/owner/repo')
+        self.assertEqual(cache.get('/owner/repo/'), None)
+        self.assertEqual(cache.get('/owner/repo/history?x=1'), None)
+        self.assertNotEqual(cache.get('/owner/repository'), None)
+        self.assertNotEqual(cache.get('/owner'), None)
+        cache.invalidate('/')
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate_path_only(self):
+        cache = self._makeOne()
+        for key in ('/', '/?x=1', '/owner'):
+            cache.set(key, _makeResponse(), cache.generation)
+        cache.invalidate('/', below=False)
+        self.assertEqual(cache.get('/'), None)
+        self.assertEqual(cache.get('/?x=1'), None)
+        self.assertNotEqual(cache.get('/owner'), None)
+
+    def test_clear(self):
+        cache = self._makeOne()
+        cache.set('/', _makeResponse(), cache.generation)
+        generation = cache.generation
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertNotEqual(cache.generation, generation)
+
+
+class CacheEntryTests(unittest.TestCase):
+
+    def _makeOne(self):
+        from .pagecache import CacheEntry
+        return CacheEntry('200 OK', [('Content-Type', 'text/html')],
+                          b'<html/>', 1000.5)
+
+    def test_respond(self):
+        entry = self._makeOne()
+        response = entry.respond()
+        self.assertEqual(response.body, b'<html/>')
+        self.assertEqual(response.etag, entry.etag)
+        self.assertEqual(response.headers['Last-Modified'],
+                         'Thu, 01 Jan 1970 00:16:40 GMT')
+        self.assertTrue(response.conditional_response)
+
+
+class Test_invalidate_on_commit(unittest.TestCase):
+
+    def tearDown(self):
+        import transaction
+        from .pagecache import get_page_cache
+        transaction.abort()
+        get_page_cache().clear()
+
+    def _callFUT(self, resource):
+        from .pagecache import invalidate_on_commit
+        return invalidate_on_commit(resource)
+
+    def _populate(self):
+        from .pagecache import get_page_cache
+        cache = get_page_cache()
+        cache.set('/owner/', _makeResponse(), cache.generation)
+        return cache
+
+    def test_commit(self):
+        import transaction
+        cache = self._populate()
+        root = testing.DummyResource()
+        owner = root['owner'] = testing.DummyResource()
+        self._callFUT(owner)
+        self.assertNotEqual(cache.get('/owner/'), None)
+        transaction.commit()
+        self.assertEqual(cache.get('/owner/'), None)
+
+    def test_abort(self):
+        import transaction
+        cache = self._populate()
+        root = testing.DummyResource()
+        owner = root['owner'] = testing.DummyResource()
+        self._callFUT(owner)
+        transaction.abort()
+        self.assertNotEqual(cache.get('/owner/'), None)
+
+
+class Test_page_cache_tween_factory(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        from .pagecache import get_page_cache
+        get_page_cache().clear()
+        testing.tearDown()
+
+    def _callFUT(self, handler, registry):
+        from .pagecache import page_cache_tween_factory
+        return page_cache_tween_factory(handler, registry)
+
+    def _makeHandler(self, response_factory=_makeResponse):
+        _handled = []
+        def _handler(request):
+            _handled.append(request)
+            return response_factory()
+        return _handler, _handled
+
+    def test_disabled(self):
+        handler, _handled = self._makeHandler()
+        self.assertTrue(self._callFUT(handler, self.config.registry)
+                        is handler)
+
+    def _makeTween(self, handler):
+        settings = self.config.registry.settings
+        settings['travis_notify.page_cache'] = 'true'
+        settings['travis_notify.page_cache_size'] = '50'
+        settings['travis_notify.page_cache_ttl'] = '60'
+        tween = self._callFUT(handler, self.config.registry)
+        from .pagecache import get_page_cache
+        cache = get_page_cache()
+        self.assertEqual(cache.max_entries, 50)
+        self.assertEqual(cache.ttl, 60.0)
+        return tween
+
+    def test_caches_get(self):
+        from pyramid.request import Request
+        handler, _handled = self._makeHandler()
+        tween = self._makeTween(handler)
+        first = tween(Request.blank('/owner/'))
+        second = tween(Request.blank('/owner/'))
+        self.assertEqual(len(_handled), 1)
+        self.assertEqual(first.etag, second.etag)
+        self.assertEqual(second.body, b'<html/>')
+
+    def test_conditional_hit_returns_304(self):
+        from pyramid.request import Request
+        handler, _handled = self._makeHandler()
+        tween = self._makeTween(handler)
+        etag = tween(Request.blank('/')).etag
+        request = Request.blank('/', headers={'If-None-Match': '"%s"' % etag})
+        response = request.get_response(lambda environ, start_response:
+                                        tween(request)(environ,
+                                                       start_response))
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(len(_handled), 1)
+
+    def test_skips_post(self):
+        from pyramid.request import Request
+        handler, _handled = self._makeHandler()
+        tween = self._makeTween(handler)
+        tween(Request.blank('/', method='POST'))
+        tween(Request.blank('/', method='POST'))
+        self.assertEqual(len(_handled), 2)
+
+    def test_skips_uncacheable(self):
+        from pyramid.request import Request
+        def _attachment():
+            response = _makeResponse(content_type='application/json')
+            response.content_disposition = 'attachment'
+            return response
+        for factory in (lambda: _makeResponse(status=404),
+                        lambda: _makeResponse(content_type='text/css'),
+                        _attachment,
+                       ):
+            handler, _handled = self._makeHandler(factory)
+            tween = self._makeTween(handler)
+            tween(Request.blank('/'))
+            tween(Request.blank('/'))
+            self.assertEqual(len(_handled), 2)
+
+
+class Test_includeme(unittest.TestCase):
+
+    def setUp(self):
+        from .models import change_listeners
+        self._saved = change_listeners[:]
+        del change_listeners[:]
+
+    def tearDown(self):
+        from .models import change_listeners
+        change_listeners[:] = self._saved
+
+    def _callFUT(self, settings):
+        from .pagecache import includeme
+        _tweens = []
+
+        class _Config(object):
+            def add_tween(self, name, under=None):
+                _tweens.append((name, under))
+            def get_settings(self):
+                return settings
+
+        includeme(_Config())
+        return _tweens
+
+    def test_it(self):
+        from pyramid.tweens import INGRESS
+        from .models import change_listeners
+        _tweens = self._callFUT({})
+        self.assertEqual(_tweens,
+                         [('travis_notify.pagecache.page_cache_tween_factory',
+                           INGRESS)])
+        self.assertEqual(change_listeners, [])
+
+    def test_enabled_listens_for_changes_once(self):
+        from .models import change_listeners
+        from .pagecache import invalidate_on_commit
+        settings = {'travis_notify.page_cache': 'true'}
+        self._callFUT(settings)
+        self._callFUT(settings)
+        self.assertEqual(change_listeners, [invalidate_on_commit])
+
+    def test_enabled_invalidates_on_pushItem_commit(self):
+        import transaction
+        from pyramid.response import Response
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        from .models import Repo
+        from .pagecache import get_page_cache
+        self._callFUT({'travis_notify.page_cache': 'true'})
+        cache = get_page_cache()
+        db = DB(MappingStorage())
+        try:
+            tm = transaction.TransactionManager()  # not the thread's default
+            conn = db.open(transaction_manager=tm)
+            repo = conn.root()['repo'] = Repo()
+            tm.commit()
+            cache.set('/', Response(body=b'x'), cache.generation)
+            repo.pushItem('a')
+            transaction.commit()  # the default transaction:  no effect
+            self.assertNotEqual(cache.get('/'), None)
+            tm.commit()
+            self.assertEqual(cache.get('/'), None)
+        finally:
+            cache.clear()
+            db.close()
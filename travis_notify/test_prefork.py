@@ -0,0 +1,238 @@
+import unittest
+
+
+class Test_parse_address(unittest.TestCase):
+
+    def _callFUT(self, value):
+        from .prefork import parse_address
+        return parse_address(value)
+
+    def test_host_and_port(self):
+        self.assertEqual(self._callFUT('127.0.0.1:8080'), ('127.0.0.1', 8080))
+
+    def test_port_only(self):
+        self.assertEqual(self._callFUT('8080'), ('0.0.0.0', 8080))
+        self.assertEqual(self._callFUT(':8080'), ('0.0.0.0', 8080))
+
+
+class Test_zeo_address(unittest.TestCase):
+
+    def _callFUT(self, uri):
+        from .prefork import zeo_address
+        return zeo_address(uri)
+
+    def test_not_zeo(self):
+        self.assertEqual(self._callFUT('file:///tmp/Data.fs'), None)
+
+    def test_tcp(self):
+        self.assertEqual(self._callFUT('zeo://localhost:8100?cache_size=1MB'),
+                         ('localhost', 8100))
+        self.assertEqual(self._callFUT('zeo://localhost'),
+                         ('localhost', 9100))
+
+    def test_unix_socket(self):
+        self.assertEqual(self._callFUT('zeo:///var/run/zeo.sock'),
+                         '/var/run/zeo.sock')
+
+
+class Test_check_storage(unittest.TestCase):
+
+    def _callFUT(self, uri, workers):
+        from .prefork import check_storage
+        return check_storage(uri, workers)
+
+    def test_single_worker(self):
+        self._callFUT('file:///tmp/Data.fs', 1)
+
+    def test_shared(self):
+        self._callFUT('zeo://localhost:8100', 4)
+        self._callFUT('postgres://user@localhost/db', 4)
+
+    def test_unshared(self):
+        self.assertRaises(ValueError, self._callFUT, 'file:///tmp/Data.fs', 2)
+        self.assertRaises(ValueError, self._callFUT, 'memory://', 2)
+
+
+class Test_per_process_warnings(unittest.TestCase):
+
+    def _callFUT(self, settings):
+        from .prefork import per_process_warnings
+        return per_process_warnings(settings)
+
+    def test_none(self):
+        self.assertEqual(self._callFUT({}), [])
+        self.assertEqual(self._callFUT({'travis_notify.page_cache': 'false',
+                                        'travis_notify.digest_window': '0',
+                                       }), [])
+
+    def test_page_cache_and_digest(self):
+        page_cache, digest = self._callFUT({
+            'travis_notify.page_cache': 'true',
+            'travis_notify.page_cache_ttl': '30',
+            'travis_notify.digest_window': '60',
+        })
+        self.assertTrue('up to travis_notify.page_cache_ttl (30)'
+                        in page_cache)
+        self.assertTrue(digest.startswith('travis_notify.digest_window'))
+
+
+class Test_listen_and_wait_for(unittest.TestCase):
+
+    def test_it(self):
+        from .prefork import listen
+        from .prefork import wait_for
+        sock = listen(('127.0.0.1', 0))
+        try:
+            self.assertTrue(sock.get_inheritable())
+            wait_for(sock.getsockname(), timeout=1)
+        finally:
+            sock.close()
+
+    def test_timeout(self):
+        from .prefork import listen
+        from .prefork import wait_for
+        sock = listen(('127.0.0.1', 0))
+        address = sock.getsockname()
+        sock.close()
+        _slept = []
+        now = [0.0]
+
+        def _sleep(interval):
+            _slept.append(interval)
+            now[0] += interval
+
+        self.assertRaises(RuntimeError, wait_for, address, timeout=0.3,
+                          clock=lambda: now[0], sleep=_sleep)
+        self.assertEqual(len(_slept), 3)
+
+
+class SupervisorTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .prefork import Supervisor
+        return Supervisor
+
+    def _makeOne(self, exits=(), **kw):
+        self._pids = iter(range(100, 200))
+        self._exits = list(exits)
+        self._killed = []
+        self._now = [0.0]
+        self._slept = []
+
+        def _fork():
+            return next(self._pids)
+
+        def _waitpid(pid, options):
+            if not self._exits:
+                raise ChildProcessError()
+            exited = self._exits.pop(0)
+            if exited is None:  # still running
+                return 0, 0
+            return exited, 256
+
+        def _kill(pid, signum):
+            if pid == 101:
+                raise ProcessLookupError()
+            self._killed.append((pid, signum))
+
+        def _sleep(seconds):
+            self._slept.append(seconds)
+            self._now[0] += seconds
+
+        return self._getTargetClass()(_fork, _waitpid, _kill,
+                                      clock=lambda: self._now[0],
+                                      sleep=_sleep, **kw)
+
+    def test_spawn(self):
+        supervisor = self._makeOne()
+        target = object()
+        self.assertEqual(supervisor.spawn('writer', target), 100)
+        self.assertEqual(supervisor.spawn('worker-0', target), 101)
+        self.assertEqual(supervisor.children,
+                         {100: 'writer', 101: 'worker-0'})
+
+    def test_reap_restarts_after_backoff(self):
+        supervisor = self._makeOne(exits=[101])
+        supervisor.spawn('writer', object())
+        supervisor.spawn('worker-0', object())
+        self.assertEqual(supervisor.reap(), 101)
+        self.assertEqual(supervisor.children, {100: 'writer'})
+        self.assertEqual(supervisor.pending, {'worker-0': 1.0})
+        self.assertEqual(supervisor.restart_due(), 1.0)
+        self._now[0] = 1.0
+        self.assertEqual(supervisor.restart_due(), None)
+        self.assertEqual(supervisor.children,
+                         {100: 'writer', 102: 'worker-0'})
+
+    def test_backoff_doubles_and_gives_up(self):
+        supervisor = self._makeOne(exits=[100, 101, 102, 103],
+                                   max_restarts=3)
+        supervisor.spawn('worker-0', object())
+        delays = []
+        while True:
+            supervisor.reap()
+            wait = supervisor.restart_due()
+            if wait is None:
+                break
+            delays.append(wait)
+            self._now[0] += wait
+            supervisor.restart_due()
+        self.assertEqual(delays, [1.0, 2.0, 4.0])
+        self.assertEqual(supervisor.failed, set(['worker-0']))
+        self.assertEqual(supervisor.children, {})
+
+    def test_run_polls_until_restart_due(self):
+        supervisor = self._makeOne(exits=[100, None, None])
+        supervisor.spawn('worker-0', object())
+        supervisor.run()
+        self.assertEqual(self._slept, [0.5, 0.5])
+        self.assertEqual(next(self._pids), 102)  # restarted once
+        self.assertEqual(supervisor.pending, {})
+
+    def test_backoff_reset_after_stable_run(self):
+        supervisor = self._makeOne(exits=[100, 101], stable_after=60)
+        supervisor.spawn('worker-0', object())
+        supervisor.reap()
+        self._now[0] = 1.0
+        supervisor.restart_due()
+        self.assertEqual(supervisor.children, {101: 'worker-0'})
+        self._now[0] = 100.0
+        supervisor.reap()
+        self.assertEqual(supervisor.pending, {'worker-0': 101.0})
+
+    def test_backoff_capped(self):
+        supervisor = self._makeOne(exits=[100, 101, 102], backoff=10,
+                                   max_backoff=15)
+        supervisor.spawn('worker-0', object())
+        for delay in (10, 15):
+            supervisor.reap()
+            self.assertEqual(supervisor.restart_due(), delay)
+            self._now[0] += delay
+            supervisor.restart_due()
+
+    def test_reap_unknown_pid(self):
+        supervisor = self._makeOne(exits=[42])
+        supervisor.spawn('worker-0', object())
+        self.assertEqual(supervisor.reap(), 42)
+        self.assertEqual(supervisor.children, {100: 'worker-0'})
+
+    def test_reap_no_children(self):
+        supervisor = self._makeOne()
+        supervisor.children[100] = 'worker-0'
+        self.assertEqual(supervisor.reap(), None)
+        self.assertEqual(supervisor.children, {})
+
+    def test_stop_then_run(self):
+        import signal
+        supervisor = self._makeOne(exits=[100, 101, 102])
+        for number in range(3):
+            supervisor.spawn('worker-%d' % number, object())
+        supervisor.pending['worker-9'] = 1.0
+        supervisor.stop()
+        self.assertTrue(supervisor.stopping)
+        self.assertEqual(supervisor.pending, {})
+        self.assertEqual(self._killed, [(100, signal.SIGTERM),
+                                        (102, signal.SIGTERM)])
+        supervisor.run()
+        self.assertEqual(supervisor.children, {})
+        self.assertEqual(self._exits, [])
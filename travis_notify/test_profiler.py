@@ -0,0 +1,202 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class Test_collapse(unittest.TestCase):
+
+    def _callFUT(self, frame):
+        from .profiler import collapse
+        return collapse(frame)
+
+    def test_it(self):
+        import sys
+
+        def inner():
+            return self._callFUT(sys._getframe())
+
+        stack = inner().split(';')
+        self.assertEqual(stack[-1], 'inner (%s)' % __file__)
+        self.assertEqual(stack[-2], 'test_it (%s)' % __file__)
+
+
+class StackSamplerTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .profiler import StackSampler
+        return StackSampler
+
+    def _makeOne(self, threshold=1.0, clock=None):
+        if clock is None:
+            self._now = [0.0]
+            clock = lambda: self._now[0]
+        sampler = self._getTargetClass()(threshold, clock=clock)
+        sampler._thread = object()  # don't start the thread
+        return sampler
+
+    def test_sample_threshold(self):
+        from . import profiler
+        sampler = self._makeOne()
+        ident, (start, stacks) = sampler.begin()
+        sampler.sample()
+        self.assertEqual(stacks, {})
+        self._now[0] = 1.5
+        sampler.sample()
+        sampler.sample()
+        [(stack, count)] = stacks.items()
+        self.assertEqual(count, 2)
+        self.assertTrue(stack.endswith(
+            'test_sample_threshold (%s);sample (%s)' % (__file__,
+                                                        profiler.__file__)))
+        sampler.end(ident)
+        self.assertEqual(sampler._active, {})
+
+    def test_thread_samples_slow_request(self):
+        import time
+        sampler = self._getTargetClass()(0.01, interval=0.002)
+        ident, (start, stacks) = sampler.begin()
+        deadline = time.monotonic() + 10
+        while not stacks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        sampler.end(ident)
+        self.assertTrue(stacks)
+        self.assertTrue(all('test_thread_samples_slow_request' in x
+                            for x in stacks))
+
+
+class ProfilerMiddlewareTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _getTargetClass(self):
+        from .profiler import ProfilerMiddleware
+        return ProfilerMiddleware
+
+    def _makeOne(self, app=None, **kw):
+        if app is None:
+            app = self._app
+        return self._getTargetClass()(app, self.tmpdir, **kw)
+
+    def _app(self, environ, start_response):
+        start_response('200 OK', [])
+        return [b'body']
+
+    def _call(self, middleware, path='/owner/repo'):
+        environ = {'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '',
+                   'PATH_INFO': path}
+        app_iter = middleware(environ, lambda status, headers: None)
+        body = b''.join(app_iter)
+        app_iter.close()
+        return body
+
+    def _dumps(self):
+        return sorted(os.listdir(self.tmpdir))
+
+    def test_idle(self):
+        middleware = self._makeOne()
+        self.assertEqual(self._call(middleware), b'body')
+        self.assertEqual(self._dumps(), [])
+
+    def test_sampled(self):
+        import pstats
+        middleware = self._makeOne(sample_rate=0.5, random=lambda: 0.25)
+        self.assertEqual(self._call(middleware), b'body')
+        [name] = self._dumps()
+        self.assertTrue(name.endswith('.prof'))
+        self.assertTrue('-GET-owner_repo-' in name)
+        stats = pstats.Stats(os.path.join(self.tmpdir, name))
+        self.assertTrue(any(x[2] == '_app' for x in stats.stats))
+        self.assertFalse(middleware._profiling.locked())
+
+    def test_not_sampled(self):
+        middleware = self._makeOne(sample_rate=0.5, random=lambda: 0.75)
+        self._call(middleware)
+        self.assertEqual(self._dumps(), [])
+
+    def test_sampled_while_profiling(self):
+        middleware = self._makeOne(sample_rate=1.0)
+        middleware._profiling.acquire()
+        self._call(middleware)
+        self.assertEqual(self._dumps(), [])
+
+    def test_slow_request_stacks(self):
+        times = [0.0, 0.0, 2.0]
+        middleware = self._makeOne(threshold=1.0,
+                                   clock=lambda: times.pop(0))
+        middleware.sampler._thread = object()  # don't start the thread
+
+        def app(environ, start_response):
+            ident, (start, stacks) = list(
+                middleware.sampler._active.items())[0]
+            stacks['a;b'] += 2
+            return self._app(environ, start_response)
+
+        middleware.application = app
+        self._call(middleware)
+        [name] = self._dumps()
+        self.assertTrue(name.endswith('-2000ms.stacks'))
+        with open(os.path.join(self.tmpdir, name)) as f:
+            self.assertEqual(f.read(), 'a;b 2\n')
+        self.assertEqual(middleware.sampler._active, {})
+
+    def test_fast_request_no_stacks(self):
+        times = [0.0, 0.0, 0.5]
+        middleware = self._makeOne(threshold=1.0,
+                                   clock=lambda: times.pop(0))
+        middleware.sampler._thread = object()
+        self._call(middleware)
+        self.assertEqual(self._dumps(), [])
+
+    def test_app_raises(self):
+        def app(environ, start_response):
+            raise ValueError()
+
+        middleware = self._makeOne(app, sample_rate=1.0)
+        self.assertRaises(ValueError, self._call, middleware)
+        self.assertEqual(len(self._dumps()), 1)
+        self.assertFalse(middleware._profiling.locked())
+
+    def test_rotate(self):
+        middleware = self._makeOne(sample_rate=1.0, max_dumps=3)
+        for x in range(5):
+            self._call(middleware, '/%d' % x)
+        dumps = self._dumps()
+        self.assertEqual(len(dumps), 3)
+        self.assertEqual([x.split('-')[4] for x in dumps], ['2', '3', '4'])
+
+
+class Test_make_filter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _callFUT(self, app, **kw):
+        from .profiler import make_filter
+        return make_filter(app, {}, **kw)
+
+    def test_defaults(self):
+        app = object()
+        dump_dir = os.path.join(self.tmpdir, 'profiles')
+        middleware = self._callFUT(app, dump_dir=dump_dir)
+        self.assertTrue(middleware.application is app)
+        self.assertTrue(os.path.isdir(dump_dir))
+        self.assertEqual(middleware.sample_rate, 0.0)
+        self.assertEqual(middleware.sampler, None)
+        self.assertEqual(middleware.max_dumps, 100)
+
+    def test_options(self):
+        middleware = self._callFUT(object(), dump_dir=self.tmpdir,
+                                   sample_rate='0.01', threshold_ms='250',
+                                   interval_ms='10', max_dumps='5')
+        self.assertEqual(middleware.sample_rate, 0.01)
+        self.assertEqual(middleware.threshold, 0.25)
+        self.assertEqual(middleware.sampler.interval, 0.01)
+        self.assertEqual(middleware.max_dumps, 5)
@@ -0,0 +1,179 @@
+import unittest
+
+from pyramid import testing
+
+
+def _makeRoot(counts):
+    from appendonly import AppendStack
+    from .models import Root
+    root = Root()
+    for slug, count in counts.items():
+        owner_name, repo_name = slug.split('/')
+        repo = root.find_create(owner_name).find_create(repo_name)
+        repo._recent = AppendStack(1, 2)
+        for number in range(count):
+            repo.pushItem({'number': str(number)})
+    return root
+
+
+class DummyRepo(object):
+
+    def __init__(self):
+        self._pruned = []
+
+    def prune(self, keep=None, before=None):
+        self._pruned.append((keep, before))
+        return 0
+
+
+class RetentionPolicyTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .retention import RetentionPolicy
+        return RetentionPolicy
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def test_disabled(self):
+        policy = self._makeOne()
+        self.assertFalse(policy.enabled)
+        repo = DummyRepo()
+        policy.prune(repo)
+        self.assertEqual(repo._pruned, [(None, None)])
+
+    def test_keep_builds(self):
+        policy = self._makeOne(keep_builds=100)
+        self.assertTrue(policy.enabled)
+        repo = DummyRepo()
+        policy.prune(repo)
+        self.assertEqual(repo._pruned, [(100, None)])
+
+    def test_keep_days(self):
+        policy = self._makeOne(keep_days=2, clock=lambda: 1000000.0)
+        self.assertTrue(policy.enabled)
+        repo = DummyRepo()
+        policy.prune(repo)
+        self.assertEqual(repo._pruned, [(None, 1000000.0 - 2 * 86400)])
+
+
+class Test_policy_from_settings(unittest.TestCase):
+
+    def _callFUT(self, settings):
+        from .retention import policy_from_settings
+        return policy_from_settings(settings)
+
+    def test_defaults(self):
+        policy = self._callFUT({})
+        self.assertEqual(policy.keep_builds, None)
+        self.assertEqual(policy.keep_days, None)
+
+    def test_explicit(self):
+        policy = self._callFUT({'travis_notify.keep_builds': '500',
+                                'travis_notify.keep_days': '90'})
+        self.assertEqual(policy.keep_builds, 500)
+        self.assertEqual(policy.keep_days, 90.0)
+
+
+class Test_prune_all(unittest.TestCase):
+
+    def _callFUT(self, root, policy, transaction_manager=None):
+        from .retention import prune_all
+        return prune_all(root, policy, transaction_manager)
+
+    def test_it(self):
+        from .retention import RetentionPolicy
+        root = _makeRoot({'owner/a': 9, 'owner/b': 3, 'other/c': 1})
+        root['owner']['not_a_repo'] = testing.DummyResource()
+        self.assertEqual(self._callFUT(root, RetentionPolicy(2)), 6)
+        self.assertEqual(len(list(root['owner']['a'])), 3)
+        self.assertEqual(len(list(root['owner']['b'])), 3)
+
+    def test_w_transaction_manager(self):
+        import transaction
+        from .retention import RetentionPolicy
+        root = _makeRoot({'owner/a': 9})
+        tm = transaction.TransactionManager()
+        self.assertEqual(self._callFUT(root, RetentionPolicy(2), tm), 6)
+
+
+class Test_compact(unittest.TestCase):
+
+    def _callFUT(self, root, policy, transaction_manager=None, pack_days=0):
+        from .retention import compact
+        return compact(root, policy, transaction_manager, pack_days)
+
+    def test_prunes_and_packs(self):
+        import os
+        import shutil
+        import tempfile
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.FileStorage import FileStorage
+        from .retention import RetentionPolicy
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'Data.fs')
+        db = DB(FileStorage(path))
+        try:
+            tm = transaction.TransactionManager()
+            conn = db.open(transaction_manager=tm)
+            root = conn.root()['app_root'] = _makeRoot({'owner/a': 0})
+            tm.commit()
+            repo = root['owner']['a']
+            for number in range(200):
+                repo.pushItem({'number': str(number), 'blob': 'x' * 1000})
+                tm.commit()
+            size = os.path.getsize(path)
+            dropped = self._callFUT(root, RetentionPolicy(10), tm)
+            self.assertEqual(dropped, 190)
+            self.assertEqual(len(list(repo)), 10)
+            self.assertTrue(os.path.getsize(path) < size / 10)
+        finally:
+            db.close()
+            shutil.rmtree(tmpdir)
+
+    def test_disabled_policy_still_packs(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+        from .retention import RetentionPolicy
+        db = DB(MappingStorage())
+        try:
+            tm = transaction.TransactionManager()
+            conn = db.open(transaction_manager=tm)
+            root = conn.root()['app_root'] = _makeRoot({'owner/a': 5})
+            tm.commit()
+            self.assertEqual(self._callFUT(root, RetentionPolicy(), tm), 0)
+            self.assertEqual(len(list(root['owner']['a'])), 5)
+        finally:
+            db.close()
+
+
+class Test_main(unittest.TestCase):
+
+    def _callFUT(self, argv):
+        from .retention import main
+        return main(argv)
+
+    def test_locked_file_storage(self):
+        import logging
+        import os
+        import shutil
+        import tempfile
+        from pyramid import paster
+        from ZODB.FileStorage import FileStorage
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'Data.fs')
+        storage = FileStorage(path)  # as held by the running server
+        saved = paster.bootstrap, paster.setup_logging
+        paster.bootstrap = lambda config_uri: FileStorage(path)
+        paster.setup_logging = lambda config_uri: None
+        logger = logging.getLogger('travis_notify.retention')
+        disabled, logger.disabled = logger.disabled, True
+        try:
+            self.assertEqual(self._callFUT(['compact', 'production.ini']), 1)
+        finally:
+            logger.disabled = disabled
+            paster.bootstrap, paster.setup_logging = saved
+            storage.close()
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,219 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import cryptography
+except ImportError:  # pragma: no cover
+    cryptography = None
+
+_KEY = []
+
+
+def _getPrivateKey():
+    if not _KEY:
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        _KEY.append(rsa.generate_private_key(public_exponent=65537,
+                                             key_size=2048))
+    return _KEY[0]
+
+
+def _getPublicPEM():
+    from cryptography.hazmat.primitives import serialization
+    return _getPrivateKey().public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo).decode('ascii')
+
+
+def _sign(payload):
+    from base64 import b64encode
+    from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+    from cryptography.hazmat.primitives.hashes import SHA1
+    return b64encode(_getPrivateKey().sign(payload.encode('utf-8'),
+                                           PKCS1v15(), SHA1())).decode('ascii')
+
+
+class _TempDirMixin(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _writeKey(self, name='travis.pem'):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(_getPublicPEM())
+        return path
+
+
+@unittest.skipIf(cryptography is None, 'cryptography not installed')
+class Test_verify_signature(unittest.TestCase):
+
+    def _callFUT(self, public_key, payload, signature):
+        from .signature import verify_signature
+        return verify_signature(public_key, payload, signature)
+
+    def _getPublicKey(self):
+        from .signature import load_public_key
+        return load_public_key(_getPublicPEM())
+
+    def test_valid(self):
+        self.assertTrue(self._callFUT(self._getPublicKey(), '{"id": 1}',
+                                      _sign('{"id": 1}')))
+
+    def test_wrong_payload(self):
+        self.assertFalse(self._callFUT(self._getPublicKey(), '{"id": 2}',
+                                       _sign('{"id": 1}')))
+
+    def test_not_base64(self):
+        self.assertFalse(self._callFUT(self._getPublicKey(), '{"id": 1}',
+                                       'not base64!'))
+
+
+class Test_file_loader(_TempDirMixin, unittest.TestCase):
+
+    def test_it(self):
+        from .signature import file_loader
+        path = os.path.join(self.tmpdir, 'key.pem')
+        with open(path, 'w') as f:
+            f.write('PEM')
+        self.assertEqual(file_loader(path)(), 'PEM')
+
+
+@unittest.skipIf(cryptography is None, 'cryptography not installed')
+class PublicKeyCacheTests(_TempDirMixin, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .signature import PublicKeyCache
+        return PublicKeyCache
+
+    def _makeOne(self, *args, **kw):
+        return self._getTargetClass()(*args, **kw)
+
+    def test_get_wo_key_starts_background_load(self):
+        import threading
+        from .signature import file_loader
+        release = threading.Event()
+        load = file_loader(self._writeKey())
+
+        def _slow_loader():
+            release.wait()
+            return load()
+
+        cache = self._makeOne(_slow_loader)
+        self.assertEqual(cache.get(), None)  # doesn't wait
+        release.set()
+        cache.join()
+        self.assertFalse(cache.stale)
+        self.assertTrue(cache.get() is not None)
+
+    def test_get_stale_returns_old_key(self):
+        from .signature import file_loader
+        clock = [1000.0]
+        cache = self._makeOne(file_loader(self._writeKey()), ttl=10,
+                              clock=lambda: clock[0])
+        self.assertTrue(cache.refresh())
+        key = cache.key
+        clock[0] += 20
+        self.assertTrue(cache.stale)
+        self.assertTrue(cache.get() is key)
+        cache.join()
+        self.assertFalse(cache.stale)
+        self.assertFalse(cache.key is key)
+
+    def test_get_stale_returns_old_key_if_refresh_finishes_first(self):
+        from .signature import file_loader
+        clock = [1000.0]
+        cache = self._makeOne(file_loader(self._writeKey()), ttl=10,
+                              clock=lambda: clock[0])
+        self.assertTrue(cache.refresh())
+        key = cache.key
+        clock[0] += 20
+        cache.refresh_async = cache.refresh  # the thread wins the race
+        self.assertTrue(cache.get() is key)
+        self.assertFalse(cache.key is key)
+
+    def test_refresh_failure_keeps_key(self):
+        from .signature import file_loader
+        path = self._writeKey()
+        cache = self._makeOne(file_loader(path))
+        cache.refresh()
+        key = cache.key
+        os.remove(path)
+        self.assertFalse(cache.refresh())
+        self.assertTrue(cache.key is key)
+
+    def test_failed_load_retried_later_warning_once(self):
+        from .signature import file_loader
+        from .signature import logger
+        clock = [1000.0]
+        path = self._writeKey()
+        os.rename(path, path + '.missing')
+        cache = self._makeOne(file_loader(path), retry=30,
+                              clock=lambda: clock[0])
+        with self.assertLogs(logger, 'DEBUG') as logged:
+            self.assertEqual(cache.get(), None)
+            cache.join()
+            started = []
+            cache.refresh_async = lambda: started.append(True)
+            clock[0] += 10
+            self.assertEqual(cache.get(), None)
+            self.assertEqual(started, [])  # too soon
+            clock[0] += 30
+            cache.get()
+            self.assertEqual(started, [True])
+            self.assertFalse(cache.refresh())
+        self.assertEqual([x.levelname for x in logged.records],
+                         ['WARNING', 'DEBUG'])
+        os.rename(path + '.missing', path)
+        self.assertTrue(cache.refresh())
+        self.assertEqual(cache.failed_at, None)
+
+    def test_disk_cache(self):
+        from .signature import file_loader
+        cache_path = os.path.join(self.tmpdir, 'cached.pem')
+        cache = self._makeOne(file_loader(self._writeKey()), cache_path)
+        self.assertEqual(cache.key, None)
+        cache.refresh()
+        with open(cache_path) as f:
+            self.assertEqual(f.read(), _getPublicPEM())
+
+        def _broken_loader():
+            raise IOError('offline')
+
+        restarted = self._makeOne(_broken_loader, cache_path, ttl=3600)
+        self.assertTrue(restarted.key is not None)
+        self.assertFalse(restarted.stale)
+
+    def test_unreadable_disk_cache(self):
+        cache_path = os.path.join(self.tmpdir, 'cached.pem')
+        with open(cache_path, 'w') as f:
+            f.write('garbage')
+        cache = self._makeOne(lambda: None, cache_path)
+        self.assertEqual(cache.key, None)
+        self.assertTrue(cache.stale)
+
+
+@unittest.skipIf(cryptography is None, 'cryptography not installed')
+class Test_key_cache_from_settings(_TempDirMixin, unittest.TestCase):
+
+    def _callFUT(self, settings):
+        from .signature import key_cache_from_settings
+        return key_cache_from_settings(settings)
+
+    def test_disabled(self):
+        self.assertEqual(self._callFUT({}), None)
+
+    def test_w_key_file(self):
+        cache = self._callFUT({
+            'travis_notify.signature': 'true',
+            'travis_notify.signature_key_file': self._writeKey(),
+            'travis_notify.signature_key_ttl': '60',
+        })
+        cache.join()
+        self.assertEqual(cache.ttl, 60.0)
+        self.assertEqual(cache.cache_path, None)
+        self.assertTrue(cache.key is not None)
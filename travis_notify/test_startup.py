@@ -0,0 +1,147 @@
+import unittest
+
+from pyramid import testing
+
+
+def _makeDB(repos=(), pool_size=7):
+    from ZODB.DB import DB
+    from ZODB.MappingStorage import MappingStorage
+    from .models import Root
+    db = DB(MappingStorage(), pool_size=pool_size)
+    if repos:
+        with db.transaction() as conn:
+            root = conn.root()['app_root'] = Root()
+            for slug in repos:
+                owner_name, repo_name = slug.split('/')
+                root.find_create(owner_name).find_create(repo_name)
+    return db
+
+
+def _cached(db):
+    """Return the number of non-ghost objects in each pooled connection."""
+    return sorted(conn._cache.cache_non_ghost_count
+                  for when, conn in db.pool.available)
+
+
+class Test_create_root(unittest.TestCase):
+
+    def _callFUT(self, db):
+        from .startup import create_root
+        return create_root(db)
+
+    def test_it(self):
+        from .models import Root
+        db = _makeDB()
+        try:
+            self.assertTrue(self._callFUT(db))
+            with db.transaction() as conn:
+                root = conn.root()['app_root']
+                self.assertTrue(isinstance(root, Root))
+                oid = root._p_oid
+            self.assertFalse(self._callFUT(db))
+            with db.transaction() as conn:
+                self.assertEqual(conn.root()['app_root']._p_oid, oid)
+        finally:
+            db.close()
+
+
+class Test_warm_connection(unittest.TestCase):
+
+    def _callFUT(self, conn):
+        from .startup import warm_connection
+        return warm_connection(conn)
+
+    def test_wo_root(self):
+        db = _makeDB()
+        try:
+            with db.transaction() as conn:
+                self.assertEqual(self._callFUT(conn), (0, 0))
+        finally:
+            db.close()
+
+    def test_it(self):
+        db = _makeDB(['a/x', 'a/y', 'b/z'])
+        try:
+            with db.transaction() as conn:
+                conn.root()['app_root']['a']['not_a_repo'] = (
+                    testing.DummyResource())
+            conn = db.open()
+            conn.cacheMinimize()
+            self.assertEqual(self._callFUT(conn), (2, 3))
+            repo = conn.root()['app_root']['b']['z']
+            self.assertTrue(repo._p_changed is False)
+            self.assertTrue(repo._recent._p_changed is False)
+            conn.close()
+        finally:
+            db.close()
+
+
+class Test_warm_database(unittest.TestCase):
+
+    def _callFUT(self, db, count):
+        from .startup import warm_database
+        return warm_database(db, count)
+
+    def test_it(self):
+        db = _makeDB(['a/x', 'b/y'], pool_size=3)
+        try:
+            db.pool.clear()
+            self.assertEqual(self._callFUT(db, 10), (3, 2, 2))
+            cached = _cached(db)
+            self.assertEqual(len(cached), 3)
+            self.assertEqual(len(set(cached)), 1)
+            self.assertTrue(cached[0] > 5)
+        finally:
+            db.close()
+
+
+class Test_startup(unittest.TestCase):
+
+    def _callFUT(self, registry):
+        from .startup import startup
+        return startup(registry)
+
+    def test_wo_databases(self):
+        self._callFUT(testing.DummyResource(settings={}))
+        self._callFUT(testing.DummyResource(settings={}, _zodb_databases={}))
+
+    def test_creates_and_warms(self):
+        db = _makeDB(pool_size=2)
+        try:
+            registry = testing.DummyResource(settings={},
+                                             _zodb_databases={'': db})
+            self._callFUT(registry)
+            with db.transaction() as conn:
+                self.assertTrue('app_root' in conn.root())
+            self.assertEqual(len(_cached(db)), 2)
+        finally:
+            db.close()
+
+    def test_warm_connections_and_read_only_db(self):
+        db = _makeDB(['a/x'])
+        other = _makeDB(['a/x'])
+        try:
+            db.pool.clear()
+            registry = testing.DummyResource(
+                settings={'travis_notify.warm_connections': '1',
+                          'travis_notify.read_only_db': 'readonly'},
+                _zodb_databases={'': db, 'readonly': other})
+            self._callFUT(registry)
+            self.assertEqual(len(_cached(db)), 1)
+            self.assertEqual(len(_cached(other)), 1)
+        finally:
+            db.close()
+            other.close()
+
+    def test_disabled(self):
+        db = _makeDB(['a/x'])
+        try:
+            db.pool.clear()
+            registry = testing.DummyResource(
+                settings={'travis_notify.warm_connections': '0'},
+                _zodb_databases={'': db})
+            self._callFUT(registry)
+            # Only create_root's connection, holding the ZODB root.
+            self.assertEqual(_cached(db), [1])
+        finally:
+            db.close()
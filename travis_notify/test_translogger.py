@@ -0,0 +1,204 @@
+import unittest
+
+
+class DummyLogger(object):
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.logged = []
+
+    def isEnabledFor(self, level):
+        return self.enabled
+
+    def log(self, level, message):
+        self.logged.append((level, message))
+
+
+class TransLoggerTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from .translogger import TransLogger
+        return TransLogger
+
+    def _makeOne(self, app, **kw):
+        self._logger = DummyLogger()
+        kw.setdefault('logger', self._logger)
+        return self._getTargetClass()(app, **kw)
+
+    def _makeApp(self, chunks, status='200 OK', headers=()):
+        self._closed = []
+
+        class AppIter(object):
+            def __iter__(self):
+                return iter(chunks)
+            def close(self_):
+                self._closed.append(True)
+
+        def app(environ, start_response):
+            start_response(status, list(headers))
+            return AppIter()
+
+        return app
+
+    def _environ(self, **kw):
+        environ = {'REQUEST_METHOD': 'GET',
+                   'SCRIPT_NAME': '',
+                   'PATH_INFO': '/owner/repo',
+                   'QUERY_STRING': 'limit=5',
+                   'SERVER_PROTOCOL': 'HTTP/1.1',
+                   'REMOTE_ADDR': '10.0.0.1',
+                   'HTTP_USER_AGENT': 'curl',
+                  }
+        environ.update(kw)
+        return environ
+
+    def _call(self, logger, environ=None):
+        if environ is None:
+            environ = self._environ()
+        written = []
+        app_iter = logger(environ, lambda status, headers, exc_info=None:
+                          written.append)
+        body = b''.join(app_iter)
+        app_iter.close()
+        return body
+
+    def test_combined_format(self):
+        # Content-Length is wrong on purpose:  the bytes sent are counted.
+        app = self._makeApp([b'abc', b'de'],
+                            headers=[('Content-Length', '100')])
+        logger = self._makeOne(app, clock=lambda: 0.0)
+        logger.offsets = ('+0000', '+0100')
+        self.assertEqual(self._call(logger), b'abcde')
+        self.assertEqual(self._closed, [True])
+        [(level, message)] = self._logger.logged
+        self.assertEqual(level, 20)
+        self.assertTrue(message.startswith('10.0.0.1 - - ['))
+        self.assertTrue(message.endswith(
+            ' "GET /owner/repo?limit=5 HTTP/1.1" 200 5 "-" "curl"'))
+
+    def test_structured(self):
+        from json import loads
+        times = [1.0, 1.25]
+        app = self._makeApp([b'abc'], status='404 Not Found')
+        logger = self._makeOne(app, structured=True,
+                               timer=lambda: times.pop(0))
+        self._call(logger, self._environ(HTTP_X_FORWARDED_FOR='1.2.3.4'))
+        [(level, message)] = self._logger.logged
+        logged = loads(message)
+        self.assertEqual(logged['status'], 404)
+        self.assertEqual(logged['bytes'], 3)
+        self.assertEqual(logged['duration_ms'], 250.0)
+        self.assertEqual(logged['remote_addr'], '1.2.3.4')
+        self.assertEqual(logged['uri'], '/owner/repo?limit=5')
+        self.assertEqual(logged['referer'], None)
+
+    def test_counts_write(self):
+        def app(environ, start_response):
+            write = start_response('200 OK', [])
+            write(b'written')
+            return [b'!']
+
+        logger = self._makeOne(app, structured=True)
+        self.assertEqual(self._call(logger), b'!')
+        [(level, message)] = self._logger.logged
+        self.assertTrue('"bytes": 8' in message)
+
+    def test_app_raises(self):
+        def app(environ, start_response):
+            raise ValueError()
+
+        logger = self._makeOne(app)
+        self.assertRaises(ValueError, logger, self._environ(), None)
+        [(level, message)] = self._logger.logged
+        self.assertTrue(' 500 - ' in message)
+
+    def test_disabled(self):
+        logger = self._makeOne(self._makeApp([b'abc']))
+        self._logger.enabled = False
+        self._call(logger)
+        self.assertEqual(self._logger.logged, [])
+
+    def test_format_time_cached(self):
+        import time
+        logger = self._makeOne(None)
+        first = logger.format_time(1000.2)
+        self.assertTrue(logger.format_time(1000.9) is first)
+        self.assertEqual(first, time.strftime(
+            '%d/%b/%Y:%H:%M:%S ', time.localtime(1000)) +
+            logger.offsets[time.localtime(1000).tm_isdst > 0])
+        self.assertFalse(logger.format_time(1001.0) is first)
+
+    def test_console_handler_queued(self):
+        import logging
+        app = self._makeApp([b'abc'])
+        logger = self._getTargetClass()(
+            app, logger_name='travis_notify.test_translogger')
+        handler = logger.handler
+        console = logger.listener.handlers[0]
+        emitted = []
+        console.emit = emitted.append
+        try:
+            self._call(logger)
+        finally:
+            logger.close()
+        self.assertEqual(len(emitted), 1)
+        self.assertTrue(logger.listener is None)
+        self.assertFalse(handler in logging.getLogger(
+            'travis_notify.test_translogger').handlers)
+
+
+class Test_offset(unittest.TestCase):
+
+    def _callFUT(self, seconds_west):
+        from .translogger import _offset
+        return _offset(seconds_west)
+
+    def test_it(self):
+        self.assertEqual(self._callFUT(0), '+0000')
+        self.assertEqual(self._callFUT(-3600), '+0100')
+        self.assertEqual(self._callFUT(18000), '-0500')
+        self.assertEqual(self._callFUT(-19800), '+0530')
+        self.assertEqual(self._callFUT(12600), '-0330')
+
+
+class DroppingQueueHandlerTests(unittest.TestCase):
+
+    def _makeOne(self, size):
+        import queue
+        from .translogger import DroppingQueueHandler
+        return DroppingQueueHandler(queue.Queue(size))
+
+    def test_drops_when_full(self):
+        import logging
+        handler = self._makeOne(1)
+        record = logging.LogRecord('wsgi', logging.INFO, __file__, 1,
+                                   'message', (), None)
+        handler.handle(record)
+        handler.handle(record)
+        self.assertEqual(handler.queue.qsize(), 1)
+        self.assertEqual(handler.dropped, 1)
+
+
+class Test_make_filter(unittest.TestCase):
+
+    def _callFUT(self, app, **kw):
+        from .translogger import make_filter
+        return make_filter(app, {}, **kw)
+
+    def test_level_names(self):
+        app = object()
+        logger = self._callFUT(app, logging_level='WARNING',
+                               set_logger_level='10',
+                               setup_console_handler='false',
+                               structured='true',
+                               logger_name='travis_notify.test_make_filter')
+        self.assertTrue(logger.application is app)
+        self.assertEqual(logger.logging_level, 30)
+        self.assertEqual(logger.logger.level, 10)
+        self.assertTrue(logger.structured)
+        self.assertTrue(logger.listener is None)
+
+    def test_bad_level(self):
+        self.assertRaises(ValueError, self._callFUT, object(),
+                          logging_level='LOUD',
+                          setup_console_handler='false')
@@ -2,6 +2,11 @@ import unittest
 
 from pyramid import testing
 
+try:
+    import cryptography
+except ImportError:  # pragma: no cover
+    cryptography = None
+
 
 class TravisAuthorizationCheckTests(unittest.TestCase):
 
@@ -72,6 +77,185 @@ class TravisAuthorizationCheckTests(unittest.TestCase):
         request.headers['Authorization'] = expected
         self.assertTrue(tac(context, request))
 
+    def _makeRequest(self, slug, token):
+        from hashlib import sha256
+        request = testing.DummyRequest()
+        request.headers['Travis-Repo-Slug'] = slug
+        request.headers['Authorization'] = sha256(
+            (slug + token).encode('ascii')).hexdigest()
+        return request
+
+    def test_ctor_w_multiple_tokens(self):
+        config = DummyConfig(my_token='NEW\n OLD')
+        tac = self._makeOne('my_token', config)
+        self.assertEqual(tac.tokens, ('NEW', 'OLD'))
+        self.assertEqual(tac.token, 'NEW')
+
+    def test___call___w_multiple_tokens(self):
+        from pyramid.httpexceptions import HTTPForbidden
+        config = DummyConfig(my_token='NEW OLD')
+        tac = self._makeOne('my_token', config)
+        context = testing.DummyResource()
+        self.assertTrue(tac(context, self._makeRequest('owner/repo', 'NEW')))
+        self.assertTrue(tac(context, self._makeRequest('owner/repo', 'OLD')))
+        self.assertRaises(HTTPForbidden, tac, context,
+                          self._makeRequest('owner/repo', 'OTHER'))
+
+    def test___call___caches_digests_for_matched_slugs(self):
+        from pyramid.httpexceptions import HTTPForbidden
+        config = DummyConfig(my_token='TOKEN')
+        tac = self._makeOne('my_token', config)
+        context = testing.DummyResource()
+        self.assertRaises(HTTPForbidden, tac, context,
+                          self._makeRequest('owner/repo', 'OTHER'))
+        self.assertEqual(len(tac._expected), 0)
+        tac(context, self._makeRequest('owner/repo', 'TOKEN'))
+        self.assertEqual(list(tac._expected), ['owner/repo'])
+        tac.digests = None  # cache hits must not hash
+        self.assertTrue(tac(context, self._makeRequest('owner/repo', 'TOKEN')))
+        self.assertRaises(HTTPForbidden, tac, context,
+                          self._makeRequest('owner/repo', 'OTHER'))
+
+    def test___call___cache_is_bounded(self):
+        config = DummyConfig(my_token='TOKEN')
+        tac = self._makeOne('my_token', config)
+        tac.MAX_CACHED_SLUGS = 2
+        context = testing.DummyResource()
+        for slug in ('owner/a', 'owner/b', 'owner/c'):
+            tac(context, self._makeRequest(slug, 'TOKEN'))
+        self.assertEqual(list(tac._expected), ['owner/b', 'owner/c'])
+
+    def test___call___after_token_changed(self):
+        from pyramid.httpexceptions import HTTPForbidden
+        config = DummyConfig(my_token='TOKEN')
+        tac = self._makeOne('my_token', config)
+        context = testing.DummyResource()
+        tac(context, self._makeRequest('owner/repo', 'TOKEN'))
+        config.settings['my_token'] = 'CHANGED'
+        self.assertRaises(HTTPForbidden, tac, context,
+                          self._makeRequest('owner/repo', 'TOKEN'))
+        self.assertTrue(tac(context,
+                            self._makeRequest('owner/repo', 'CHANGED')))
+        self.assertEqual(tac.token, 'CHANGED')
+
+    def test___call___w_non_ascii_Authorization_header(self):
+        from pyramid.httpexceptions import HTTPForbidden
+        config = DummyConfig(my_token='TOKEN')
+        tac = self._makeOne('my_token', config)
+        context = testing.DummyResource()
+        request = testing.DummyRequest()
+        request.headers['Travis-Repo-Slug'] = 'owner/repo'
+        request.headers['Authorization'] = u'\xe9t\xe9'
+        self.assertRaises(HTTPForbidden, tac, context, request)
+
+
+@unittest.skipIf(cryptography is None, 'cryptography not installed')
+class TravisAuthorizationCheckSignatureTests(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        from .test_signature import _getPublicPEM
+        self.tmpdir = tempfile.mkdtemp()
+        self.key_file = os.path.join(self.tmpdir, 'travis.pem')
+        with open(self.key_file, 'w') as f:
+            f.write(_getPublicPEM())
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOne(self, **kw):
+        from .views import TravisAuthorizationCheck
+        settings = {'my_token': 'TOKEN',
+                    'travis_notify.signature': 'true',
+                    'travis_notify.signature_key_file': self.key_file,
+                   }
+        settings.update(kw)
+        tac = TravisAuthorizationCheck('my_token', DummyConfig(**settings))
+        tac.key_cache.join()
+        return tac
+
+    PAYLOAD = ('{"id": 1, '
+               '"repository": {"owner_name": "owner", "name": "repo"}}')
+
+    def _makeRequest(self, payload=PAYLOAD, signature=None, auth=None):
+        from .test_signature import _sign
+        request = testing.DummyRequest(post={'payload': payload})
+        request.headers['Travis-Repo-Slug'] = 'owner/repo'
+        request.headers['Signature'] = signature or _sign(payload)
+        if auth is not None:
+            request.headers['Authorization'] = auth
+        return request
+
+    def test_ctor_wo_signature_setting(self):
+        from .views import TravisAuthorizationCheck
+        tac = TravisAuthorizationCheck('my_token',
+                                       DummyConfig(my_token='TOKEN'))
+        self.assertEqual(tac.key_cache, None)
+
+    def test___call___w_valid_signature(self):
+        tac = self._makeOne()
+        context = testing.DummyResource()
+        self.assertTrue(tac(context, self._makeRequest()))
+
+    def test___call___w_bad_signature(self):
+        from pyramid.httpexceptions import HTTPForbidden
+        from .test_signature import _sign
+        tac = self._makeOne()
+        context = testing.DummyResource()
+        request = self._makeRequest(signature=_sign('{"id": 2}'))
+        self.assertRaises(HTTPForbidden, tac, context, request)
+
+    def test___call___w_signature_for_other_repo(self):
+        # A validly signed payload replayed under another repo's slug.
+        from pyramid.httpexceptions import HTTPForbidden
+        tac = self._makeOne()
+        context = testing.DummyResource()
+        request = self._makeRequest()
+        request.headers['Travis-Repo-Slug'] = 'victim/repo'
+        self.assertRaises(HTTPForbidden, tac, context, request)
+
+    def test___call___w_signed_payload_wo_repository(self):
+        from pyramid.httpexceptions import HTTPForbidden
+        tac = self._makeOne()
+        context = testing.DummyResource()
+        for payload in ('{"id": 1}', '[1]', 'not JSON'):
+            request = self._makeRequest(payload)
+            self.assertRaises(HTTPForbidden, tac, context, request)
+
+    def test___call___w_signature_wo_payload(self):
+        from pyramid.httpexceptions import HTTPForbidden
+        tac = self._makeOne()
+        context = testing.DummyResource()
+        request = self._makeRequest()
+        del request.POST['payload']
+        self.assertRaises(HTTPForbidden, tac, context, request)
+
+    def test___call___wo_key_falls_back_to_token(self):
+        from hashlib import sha256
+        from pyramid.httpexceptions import HTTPForbidden
+        tac = self._makeOne(**{'travis_notify.signature_key_file':
+                               self.key_file + '.missing'})
+        context = testing.DummyResource()
+        self.assertRaises(HTTPForbidden, tac, context, self._makeRequest())
+        auth = sha256(b'owner/repoTOKEN').hexdigest()
+        self.assertTrue(tac(context, self._makeRequest(auth=auth)))
+
+    def test___call___wo_key_warns_once(self):
+        from hashlib import sha256
+        from .views import logger
+        tac = self._makeOne(**{'travis_notify.signature_key_file':
+                               self.key_file + '.missing'})
+        context = testing.DummyResource()
+        auth = sha256(b'owner/repoTOKEN').hexdigest()
+        with self.assertLogs(logger, 'WARNING') as logged:
+            for i in range(3):
+                self.assertTrue(tac(context, self._makeRequest(auth=auth)))
+                tac.key_cache.join()
+        self.assertEqual(len([x for x in logged.records
+                              if 'no public key' in x.getMessage()]), 1)
+
 
 class Test_generate_notification_mail(unittest.TestCase):
 
@@ -280,6 +464,73 @@ class Test_generate_notification_mail(unittest.TestCase):
         self.assertEqual(message['To'], ['foo@example.com'])
         self.assertEqual(message['Subject'], 'FAILED: repo [Travis-CI]')
 
+    def test_w_mail_queue_path(self):
+        import os
+        import shutil
+        import tempfile
+        import transaction
+        mailer = self._getMailer()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            queue_path = os.path.join(tmpdir, 'queue')
+            settings = self.config.registry.settings
+            settings['travis_notify.mail_queue_path'] = queue_path
+            settings['travis_notify.recipients'] = 'foo@example.com'
+            context = testing.DummyResource()
+            request = testing.DummyRequest()
+            payload = {
+                "type": "push",
+                "status": 0,
+                "status_message": "Passed",
+                "build_url": "https://travis-ci.org/owner/repo/builds/1",
+                "branch": "master",
+                "compare_url":
+                    "https://github.com/owner/repo/compare/master...develop",
+                "committer_name": "J. Random Hacker",
+                "committer_email": "jrandom@example.com",
+                "message": "the commit message",
+                "repository": {
+                    "name": "repo",
+                }
+            }
+            self._callFUT(context, request, payload)
+            self.assertEqual(len(mailer.outbox), 0)
+            transaction.commit()
+            queued = os.listdir(os.path.join(queue_path, 'new'))
+            self.assertEqual(len(queued), 1)
+        finally:
+            transaction.abort()
+            shutil.rmtree(tmpdir)
+
+    def test_w_digest_window(self):
+        import transaction
+        mailer = self._getMailer()
+        self.config.registry.settings['travis_notify.digest_window'] = '60'
+        context = testing.DummyResource()
+        request = testing.DummyRequest()
+        payload = {
+            "type": "push",
+            "status": 0,
+            "status_message": "Passed",
+            "build_url": "https://travis-ci.org/owner/repo/builds/1",
+            "branch": "master",
+            "commit": "abc123",
+            "compare_url":
+                "https://github.com/owner/repo/compare/master...develop",
+            "committer_name": "J. Random Hacker",
+            "committer_email": "jrandom@example.com",
+            "message": "the commit message",
+            "repository": {
+                "name": "repo",
+                "owner_name": "owner",
+            }
+        }
+        digest = self.config.registry._travis_notify_digest = DummyDigest()
+        self._callFUT(context, request, payload)
+        self._callFUT(context, request, payload)
+        self.assertEqual(len(mailer.outbox), 0)
+        self.assertEqual(digest._added, [(payload, 'OK'), (payload, 'OK')])
+
 
 class Test_webook(unittest.TestCase):
 
@@ -295,6 +546,7 @@ class Test_webook(unittest.TestCase):
 
     def test_it(self):
         from json import dumps
+        from .models import BuildRecord
         from .models import Root
         PAYLOAD = {}
         _called_with = []
@@ -305,10 +557,91 @@ class Test_webook(unittest.TestCase):
         request.headers['Travis-Repo-Slug'] = 'owner/repo'
         request.POST['payload'] = dumps(PAYLOAD)
         info = self._callFUT(context, request, generator=_generator)
-        self.assertEqual(list(context['owner']['repo']), [PAYLOAD])
+        record, = list(context['owner']['repo'])
+        self.assertTrue(isinstance(record, BuildRecord))
+        self.assertEqual(record.raw, None)
         self.assertEqual(_called_with,
                          [(context, request, PAYLOAD)])
 
+    def test_w_keep_raw_payload(self):
+        from json import dumps
+        from .models import Root
+        PAYLOAD = {'number': '1', 'matrix': [{'id': 1}, {'id': 2}]}
+        self.config.registry.settings[
+            'travis_notify.keep_raw_payload'] = 'true'
+        context = Root()
+        request = testing.DummyRequest()
+        request.headers['Travis-Repo-Slug'] = 'owner/repo'
+        request.POST['payload'] = dumps(PAYLOAD)
+        self._callFUT(context, request, generator=lambda *args: None)
+        record, = list(context['owner']['repo'])
+        self.assertEqual(record['number'], '1')
+        self.assertEqual(record.payload, PAYLOAD)
+
+    def _makeRequest(self, payload):
+        from json import dumps
+        request = testing.DummyRequest()
+        request.headers['Travis-Repo-Slug'] = 'owner/repo'
+        request.POST['payload'] = dumps(payload)
+        return request
+
+    def test_redelivery_after_commit(self):
+        import transaction
+        from .models import Root
+        PAYLOAD = {'id': 1, 'status': 0, 'status_message': 'Passed'}
+        _called_with = []
+        def _generator(context, request, payload):
+            _called_with.append(payload)
+        context = Root()
+        try:
+            self._callFUT(context, self._makeRequest(PAYLOAD),
+                          generator=_generator)
+            transaction.commit()
+            repo = context['owner']['repo']
+            repo._deliveries = None  # only the in-process cache knows it
+            self._callFUT(context, self._makeRequest(PAYLOAD),
+                          generator=_generator)
+        finally:
+            transaction.abort()
+        self.assertEqual(len(list(repo)), 1)
+        self.assertEqual(_called_with, [PAYLOAD])
+
+    def test_redelivery_from_repo(self):
+        import transaction
+        from .dedupe import get_recent_deliveries
+        from .models import Root
+        PAYLOAD = {'id': 1, 'status': 0, 'status_message': 'Passed'}
+        _called_with = []
+        def _generator(context, request, payload):
+            _called_with.append(payload)
+        context = Root()
+        try:
+            self._callFUT(context, self._makeRequest(PAYLOAD),
+                          generator=_generator)
+            # e.g., stored by another process:  not yet committed here.
+            self._callFUT(context, self._makeRequest(PAYLOAD),
+                          generator=_generator)
+            recent = get_recent_deliveries(self.config.registry)
+            self.assertEqual(len(recent), 1)
+        finally:
+            transaction.abort()
+        self.assertEqual(len(list(context['owner']['repo'])), 1)
+        self.assertEqual(_called_with, [PAYLOAD])
+
+    def test_new_status_is_not_redelivery(self):
+        from .models import Root
+        _called_with = []
+        def _generator(context, request, payload):
+            _called_with.append(payload)
+        context = Root()
+        for payload in ({'id': 1, 'status': None,
+                         'status_message': 'Pending'},
+                        {'id': 1, 'status': 0, 'status_message': 'Passed'}):
+            self._callFUT(context, self._makeRequest(payload),
+                          generator=_generator)
+        self.assertEqual(len(list(context['owner']['repo'])), 2)
+        self.assertEqual(len(_called_with), 2)
+
 
 class Test_get_main_template(unittest.TestCase):
 
@@ -329,6 +662,94 @@ class Test_get_main_template(unittest.TestCase):
             mt.filename.endswith('travis_notify/templates/main.pt'))
 
 
+class Test_check_not_modified(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _callFUT(self, context, request, format='html'):
+        from .views import check_not_modified
+        return check_not_modified(context, request, format)
+
+    def _makeContext(self, serial=3, modified=1000.0):
+        context = testing.DummyResource()
+        context.serial = serial
+        context.modified = modified
+        return context
+
+    def test_wo_serial(self):
+        request = testing.DummyRequest()
+        self.assertEqual(self._callFUT(testing.DummyResource(), request),
+                         None)
+        self.assertFalse('ETag' in request.response.headers)
+
+    def test_sets_validators(self):
+        request = testing.DummyRequest()
+        self.assertEqual(self._callFUT(self._makeContext(), request), None)
+        self.assertEqual(request.response.headers['ETag'], _etag(3))
+        self.assertEqual(request.response.headers['Last-Modified'],
+                         'Thu, 01 Jan 1970 00:16:40 GMT')
+
+    def test_wo_modified(self):
+        request = testing.DummyRequest()
+        context = self._makeContext(modified=None)
+        request.headers['If-Modified-Since'] = 'Thu, 01 Jan 1970 00:16:40 GMT'
+        self.assertEqual(self._callFUT(context, request), None)
+        self.assertFalse('Last-Modified' in request.response.headers)
+
+    def test_if_none_match_hit(self):
+        from pyramid.httpexceptions import HTTPNotModified
+        request = testing.DummyRequest()
+        request.headers['If-None-Match'] = '"2", %s' % _etag(3)
+        result = self._callFUT(self._makeContext(), request)
+        self.assertTrue(isinstance(result, HTTPNotModified))
+        self.assertEqual(result.headers['ETag'], _etag(3))
+
+    def test_bare_serial_is_not_a_match(self):
+        request = testing.DummyRequest()
+        request.headers['If-None-Match'] = '"3"'
+        self.assertEqual(self._callFUT(self._makeContext(), request), None)
+
+    def test_etag_varies_with_format(self):
+        html = testing.DummyRequest()
+        self._callFUT(self._makeContext(), html)
+        json = testing.DummyRequest()
+        self._callFUT(self._makeContext(), json, 'json')
+        self.assertNotEqual(html.response.headers['ETag'],
+                            json.response.headers['ETag'])
+
+    def test_etag_varies_with_representation_version(self):
+        from . import views
+        first = testing.DummyRequest()
+        self._callFUT(self._makeContext(), first)
+        saved, views.REPRESENTATION_VERSION = views.REPRESENTATION_VERSION, 0
+        try:
+            second = testing.DummyRequest()
+            self._callFUT(self._makeContext(), second)
+        finally:
+            views.REPRESENTATION_VERSION = saved
+        self.assertNotEqual(first.response.headers['ETag'],
+                            second.response.headers['ETag'])
+
+    def test_if_none_match_miss_ignores_if_modified_since(self):
+        request = testing.DummyRequest()
+        request.headers['If-None-Match'] = '"2"'
+        request.headers['If-Modified-Since'] = 'Thu, 01 Jan 1970 00:16:40 GMT'
+        self.assertEqual(self._callFUT(self._makeContext(), request), None)
+
+    def test_if_modified_since(self):
+        from pyramid.httpexceptions import HTTPNotModified
+        request = testing.DummyRequest()
+        request.headers['If-Modified-Since'] = 'Thu, 01 Jan 1970 00:16:40 GMT'
+        result = self._callFUT(self._makeContext(), request)
+        self.assertTrue(isinstance(result, HTTPNotModified))
+        request.headers['If-Modified-Since'] = 'Thu, 01 Jan 1970 00:16:39 GMT'
+        self.assertEqual(self._callFUT(self._makeContext(), request), None)
+
+
 class Test_home_page(unittest.TestCase):
 
     def setUp(self):
@@ -355,6 +776,62 @@ class Test_home_page(unittest.TestCase):
         info = self._callFUT(context, request)
         self.assertEqual(info['owners'], ['other', 'sub'])
 
+    def test_w_statuses(self):
+        from .models import Root
+        context = Root()
+        repo = context.find_create('owner').find_create('repo')
+        repo.pushItem({'number': '1', 'status': 1,
+                       'status_message': 'Broken'})
+        request = testing.DummyRequest()
+        info = self._callFUT(context, request)
+        self.assertEqual([(x['name'], x['status'])
+                          for x in info['statuses']],
+                         [('owner/repo', 'FAILED')])
+        self.assertEqual(info['failing'], 1)
+
+    def test_not_modified(self):
+        from pyramid.httpexceptions import HTTPNotModified
+        context = testing.DummyResource()
+        context.serial, context.modified = 1, None
+        request = testing.DummyRequest()
+        request.headers['If-None-Match'] = _etag(1)
+        info = self._callFUT(context, request)
+        self.assertTrue(isinstance(info, HTTPNotModified))
+
+
+class Test_status_rows(unittest.TestCase):
+
+    def _callFUT(self, context, names=None):
+        from .views import status_rows
+        return status_rows(context, names)
+
+    def _makeContext(self):
+        from .models import LatestBuild
+        from .models import Owner
+        context = Owner()
+        context.board.update('green', LatestBuild('OK', 'master', 'abc',
+                                                  '2', 0.0))
+        context.board.update('red', LatestBuild('FAILED', 'fix', 'def',
+                                                '3', 60.0))
+        return context
+
+    def test_board(self):
+        rows = self._callFUT(self._makeContext())
+        self.assertEqual([(x['name'], x['status'], x['css'])
+                          for x in rows],
+                         [('green', 'OK', 'success'),
+                          ('red', 'FAILED', 'danger')])
+        self.assertEqual(rows[1]['when'], '1970-01-01 00:01 UTC')
+        self.assertEqual(rows[1]['commit'], 'def')
+
+    def test_names(self):
+        rows = self._callFUT(self._makeContext(), ['new', 'red'])
+        self.assertEqual([(x['name'], x['status']) for x in rows],
+                         [('new', None), ('red', 'FAILED')])
+
+    def test_wo_board(self):
+        self.assertEqual(self._callFUT(testing.DummyResource()), [])
+
 
 class Test_owner(unittest.TestCase):
 
@@ -385,6 +862,18 @@ class Test_owner(unittest.TestCase):
         info = self._callFUT(context, request)
         self.assertEqual(info['name'], 'owner2')
         self.assertEqual(info['repos'], ['other', 'sub'])
+        self.assertEqual([x['name'] for x in info['statuses']],
+                         ['other', 'sub'])
+
+    def test_not_modified(self):
+        from pyramid.httpexceptions import HTTPNotModified
+        root = testing.DummyResource()
+        context = root['owner'] = testing.DummyResource()
+        context.serial, context.modified = 1, None
+        request = testing.DummyRequest()
+        request.headers['If-None-Match'] = _etag(1)
+        info = self._callFUT(context, request)
+        self.assertTrue(isinstance(info, HTTPNotModified))
 
 
 class Test_repo(unittest.TestCase):
@@ -399,27 +888,234 @@ class Test_repo(unittest.TestCase):
         from .views import repo
         return repo(context, request)
 
-    def test_empty(self):
+    def _makeRepo(self, count=0):
+        from .models import Repo
         root = testing.DummyResource()
         owner = root['owner'] = testing.DummyResource()
-        context = owner['repo1'] = testing.DummyResource()
-        context.recent = []
+        repo = Repo()
+        repo.__parent__, repo.__name__ = owner, 'repo1'
+        for number in range(count):
+            repo.pushItem({'commit': '%040d' % number})
+        return repo
+
+    def test_empty(self):
+        context = self._makeRepo()
         request = testing.DummyRequest()
         info = self._callFUT(context, request)
         self.assertEqual(info['name'], 'repo1')
         self.assertEqual(info['recent'], [])
+        self.assertEqual(info['more'], None)
 
     def test_w_items(self):
+        context = self._makeRepo(3)
+        request = testing.DummyRequest()
+        info = self._callFUT(context, request)
+        self.assertEqual(info['name'], 'repo1')
+        self.assertEqual([x['commit'] for x in info['recent']],
+                         ['%040d' % x for x in (2, 1, 0)])
+        self.assertEqual(info['more'], None)
+
+    def test_w_more(self):
+        self.config.registry.settings['travis_notify.repo_page_size'] = '2'
+        context = self._makeRepo(3)
+        request = testing.DummyRequest()
+        info = self._callFUT(context, request)
+        self.assertEqual(len(info['recent']), 2)
+        self.assertEqual(info['more'], '0-1')
+        self.assertEqual(info['more_url'],
+                         'http://example.com/owner/repo1/recent')
+
+    def test_not_modified(self):
+        from pyramid.httpexceptions import HTTPNotModified
+        root = testing.DummyResource()
+        context = root['repo'] = testing.DummyResource()
+        context.serial, context.modified = 1, None
+        request = testing.DummyRequest()
+        request.headers['If-None-Match'] = _etag(1)
+        info = self._callFUT(context, request)
+        self.assertTrue(isinstance(info, HTTPNotModified))
+
+
+class Test_history(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _callFUT(self, context, request):
+        from .views import history
+        return history(context, request)
+
+    def _makeRepo(self, count=5):
+        from .models import Repo
+        repo = Repo()
+        for number in range(1, count + 1):
+            repo.index.add({'number': str(number),
+                            'branch': number % 2 and 'odd' or 'even',
+                            'status': 0,
+                           }, stamp=number)
+        return repo
+
+    def test_defaults(self):
+        repo = self._makeRepo()
+        request = testing.DummyRequest()
+        info = self._callFUT(repo, request)
+        self.assertEqual([x['number'] for x in info['items']],
+                         ['5', '4', '3', '2', '1'])
+        self.assertEqual(info['next'], None)
+
+    def test_paged(self):
+        repo = self._makeRepo()
+        request = testing.DummyRequest(params={'limit': '2'})
+        info = self._callFUT(repo, request)
+        self.assertEqual([x['number'] for x in info['items']], ['5', '4'])
+        request = testing.DummyRequest(params={'limit': '2',
+                                               'cursor': info['next']})
+        info = self._callFUT(repo, request)
+        self.assertEqual([x['number'] for x in info['items']], ['3', '2'])
+
+    def test_filtered_w_offset(self):
+        repo = self._makeRepo()
+        request = testing.DummyRequest(params={'branch': 'odd',
+                                               'status': 'OK',
+                                               'offset': '1'})
+        info = self._callFUT(repo, request)
+        self.assertEqual([x['number'] for x in info['items']], ['3', '1'])
+
+    def test_limit_clamped(self):
+        repo = self._makeRepo(120)
+        request = testing.DummyRequest(params={'limit': '1000'})
+        info = self._callFUT(repo, request)
+        self.assertEqual(len(info['items']), 100)
+        self.assertNotEqual(info['next'], None)
+
+    def test_number(self):
+        repo = self._makeRepo()
+        request = testing.DummyRequest(params={'number': '3'})
+        info = self._callFUT(repo, request)
+        self.assertEqual([x['number'] for x in info['items']], ['3'])
+        request = testing.DummyRequest(params={'number': '42'})
+        info = self._callFUT(repo, request)
+        self.assertEqual(info['items'], [])
+
+    def test_bad_params(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        repo = self._makeRepo()
+        for params in ({'limit': 'abc'}, {'limit': '0'}, {'offset': '-1'},
+                       {'cursor': str(2 ** 63)}, {'cursor': str(-2 ** 63 - 1)},
+                       {'offset': '99999999999999999999'}):
+            request = testing.DummyRequest(params=params)
+            self.assertRaises(HTTPBadRequest, self._callFUT, repo, request)
+
+    def test_not_modified(self):
+        from pyramid.httpexceptions import HTTPNotModified
+        context = testing.DummyResource()
+        context.serial, context.modified = 1, None
+        request = testing.DummyRequest()
+        request.headers['If-None-Match'] = _etag(1, 'json')
+        info = self._callFUT(context, request)
+        self.assertTrue(isinstance(info, HTTPNotModified))
+
+
+class Test_recent_page(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _callFUT(self, context, request):
+        from .views import recent_page
+        return recent_page(context, request)
+
+    def _makeRepo(self, count=5):
+        from appendonly import AppendStack
+        from .models import BuildRecord
+        from .models import Repo
+        repo = Repo()
+        repo._recent = AppendStack(1, 2)
+        for number in range(1, count + 1):
+            repo.pushItem(BuildRecord.fromPayload({'number': str(number),
+                                                   'commit': 'c%d' % number,
+                                                  }))
+        return repo
+
+    def test_paged(self):
+        repo = self._makeRepo()
+        request = testing.DummyRequest(params={'limit': '2'})
+        info = self._callFUT(repo, request)
+        self.assertEqual(info['items'], [
+            {'number': '5', 'commit': 'c5', 'branch': None,
+             'status_message': None},
+            {'number': '4', 'commit': 'c4', 'branch': None,
+             'status_message': None},
+        ])
+        numbers = []
+        while info['next'] is not None:
+            request = testing.DummyRequest(params={'limit': '2',
+                                                   'cursor': info['next']})
+            info = self._callFUT(repo, request)
+            numbers.extend(x['number'] for x in info['items'])
+        self.assertEqual(numbers, ['3', '2', '1'])
+
+    def test_limit_default(self):
+        self.config.registry.settings['travis_notify.repo_page_size'] = '3'
+        repo = self._makeRepo()
+        info = self._callFUT(repo, testing.DummyRequest())
+        self.assertEqual(len(info['items']), 3)
+        self.assertEqual(info['next'], '1-0')
+
+    def test_bad_params(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        repo = self._makeRepo()
+        for params in ({'limit': '0'}, {'cursor': 'abc'}, {'cursor': '1'},
+                       {'cursor': '%d-0' % 2 ** 63}):
+            request = testing.DummyRequest(params=params)
+            self.assertRaises(HTTPBadRequest, self._callFUT, repo, request)
+
+    def test_not_modified(self):
+        from pyramid.httpexceptions import HTTPNotModified
+        context = testing.DummyResource()
+        context.serial, context.modified = 1, None
+        request = testing.DummyRequest()
+        request.headers['If-None-Match'] = _etag(1, 'json')
+        info = self._callFUT(context, request)
+        self.assertTrue(isinstance(info, HTTPNotModified))
+
+
+class Test_export(unittest.TestCase):
+
+    def _callFUT(self, context, request):
+        from .views import export
+        return export(context, request)
+
+    def test_it(self):
+        from .models import Repo
         root = testing.DummyResource()
         owner = root['owner'] = testing.DummyResource()
-        context = owner['repo2'] = testing.DummyResource()
-        recent = context.recent = [object(), object()]
-        sub = context['sub'] = testing.DummyResource()
-        other = context['other'] = testing.DummyResource()
+        context = owner['repo'] = Repo()
+        context.__name__ = 'repo'
+        context.__parent__ = owner
+        context.pushItem({'number': '1'})
+        request = testing.DummyRequest()
+        response = self._callFUT(context, request)
+        self.assertEqual(response.content_type, 'application/x-ndjson')
+        self.assertEqual(response.content_disposition,
+                         'attachment; filename="owner-repo.ndjson"')
+        self.assertEqual(response.body, b'{"number": "1"}\n')
+        self.assertEqual(response.headers['ETag'], _etag(1, 'ndjson'))
+
+    def test_not_modified(self):
+        from pyramid.httpexceptions import HTTPNotModified
+        context = testing.DummyResource()
+        context.serial, context.modified = 1, None
         request = testing.DummyRequest()
+        request.headers['If-None-Match'] = _etag(1, 'ndjson')
         info = self._callFUT(context, request)
-        self.assertEqual(info['name'], 'repo2')
-        self.assertEqual(info['recent'], recent)
+        self.assertTrue(isinstance(info, HTTPNotModified))
 
 
 class Test_includeme(unittest.TestCase):
@@ -438,6 +1134,11 @@ class Test_includeme(unittest.TestCase):
         self.assertEqual(config._request_methods,
                          {'main_template': (get_main_template, True, True)})
 
+def _etag(serial, format='html', view_name=''):
+    from .views import representation_token
+    return '"%d-%s"' % (serial, representation_token(view_name, format))
+
+
 class DummyConfig(object):
 
     def __init__(self, **kw):
@@ -450,3 +1151,12 @@ class DummyConfig(object):
 
     def add_request_method(self, callable, name, property, reify):
         self._request_methods[name] = (callable, property, reify)
+
+
+class DummyDigest(object):
+
+    def __init__(self):
+        self._added = []
+
+    def add_on_commit(self, payload, status):
+        self._added.append((payload, status))
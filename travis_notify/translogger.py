@@ -2,6 +2,7 @@
 # Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
 """
 Middleware for logging requests, using Apache combined log format
+(or, with ``structured``, one JSON object per request).
 """
 
 def asbool(x):
@@ -9,36 +10,104 @@ def asbool(x):
         return x.lower() in ('y', 'yes', 'true', '1')
     return bool(x)
 
+import atexit
+from json import dumps
 import logging
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+import queue
 import time
-import urllib
+import urllib.parse
+
+
+def _offset(seconds_west):
+    """Return the ``+HHMM`` / ``-HHMM`` offset for ``seconds_west`` of UTC.
+    """
+    minutes = -seconds_west // 60
+    sign = minutes < 0 and '-' or '+'
+    return '%s%02d%02d' % ((sign,) + divmod(abs(minutes), 60))
+
+
+class DroppingQueueHandler(QueueHandler):
+    """``QueueHandler`` which drops records (counting them) rather than
+    blocking when its queue is full.
+    """
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _LoggedIterable(object):
+    """Wrap a response's ``app_iter``, counting the bytes it yields, and
+    call ``done()`` when it is closed.
+    """
+    def __init__(self, app_iter, counted, done):
+        self.app_iter = app_iter
+        self.counted = counted
+        self.done = done
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            self.counted[0] += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            close = getattr(self.app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.done()
+
 
 class TransLogger(object):
     """
     This logging middleware will log all requests as they go through.
     They are, by default, sent to a logger named ``'wsgi'`` at the
-    INFO level.
+    INFO level, once the response body has been sent (or the client has
+    gone away), with the number of body bytes actually sent.
+
+    If ``structured`` is true, each message is a JSON object, including the
+    request's duration in milliseconds.
 
     If ``setup_console_handler`` is true, then messages for the named
-    logger will be sent to the console.
+    logger will be sent to the console, from a background thread fed by a
+    queue of up to ``queue_size`` records, so that a slow console never
+    stalls the request threads (messages beyond that are dropped).
     """
 
     format = ('%(REMOTE_ADDR)s - %(REMOTE_USER)s [%(time)s] '
               '"%(REQUEST_METHOD)s %(REQUEST_URI)s %(HTTP_VERSION)s" '
               '%(status)s %(bytes)s "%(HTTP_REFERER)s" "%(HTTP_USER_AGENT)s"')
 
+    listener = None
+
     def __init__(self, application,
                  logger=None,
                  format=None,
                  logging_level=logging.INFO,
                  logger_name='wsgi',
                  setup_console_handler=True,
-                 set_logger_level=logging.DEBUG):
+                 set_logger_level=logging.DEBUG,
+                 structured=False,
+                 queue_size=10000,
+                 clock=time.time,
+                 timer=time.perf_counter):
         if format is not None:
             self.format = format
         self.application = application
         self.logging_level = logging_level
         self.logger_name = logger_name
+        self.structured = structured
+        self.clock = clock
+        self.timer = timer
+        # The offsets from UTC, without and with DST, for ``tm_isdst``.
+        self.offsets = (_offset(time.timezone), _offset(time.altzone))
+        self._cached_time = (None, None)  # (second, formatted)
         if logger is None:
             self.logger = logging.getLogger(self.logger_name)
             if setup_console_handler:
@@ -46,80 +115,150 @@ class TransLogger(object):
                 console.setLevel(logging.DEBUG)
                 # We need to control the exact format:
                 console.setFormatter(logging.Formatter('%(message)s'))
-                self.logger.addHandler(console)
+                self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+                self.listener = QueueListener(self.handler.queue, console,
+                                              respect_handler_level=True)
+                self.listener.start()
+                atexit.register(self.close)
+                self.logger.addHandler(self.handler)
                 self.logger.propagate = False
             if set_logger_level is not None:
                 self.logger.setLevel(set_logger_level)
         else:
             self.logger = logger
 
+    def close(self):
+        """Flush queued messages, and stop the console thread.
+        """
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+            self.logger.removeHandler(self.handler)
+
     def __call__(self, environ, start_response):
-        start = time.localtime()
+        started = self.timer()
+        start = self.clock()
         req_uri = urllib.parse.quote(environ.get('SCRIPT_NAME', '')
                                + environ.get('PATH_INFO', ''))
         if environ.get('QUERY_STRING'):
             req_uri += '?'+environ['QUERY_STRING']
         method = environ['REQUEST_METHOD']
+        counted = [0]
+        statuses = []
+
         def replacement_start_response(status, headers, exc_info=None):
-            # @@: Ideally we would count the bytes going by if no
-            # content-length header was provided; but that does add
-            # some overhead, so at least for now we'll be lazy.
-            bytes = None
-            for name, value in headers:
-                if name.lower() == 'content-length':
-                    bytes = value
-            self.write_log(environ, method, req_uri, start, status, bytes)
-            return start_response(status, headers)
-        return self.application(environ, replacement_start_response)
-
-    def write_log(self, environ, method, req_uri, start, status, bytes):
-        if bytes is None:
-            bytes = '-'
-        if time.daylight:
-                offset = time.altzone / 60 / 60 * -100
-        else:
-                offset = time.timezone / 60 / 60 * -100
-        if offset >= 0:
-                offset = "+%0.4d" % (offset)
-        elif offset < 0:
-                offset = "%0.4d" % (offset)
+            statuses.append(status)
+            write = start_response(status, headers, exc_info)
+
+            def counting_write(data):
+                counted[0] += len(data)
+                return write(data)
+
+            return counting_write
+
+        def done():
+            status = statuses and statuses[-1] or '500 Internal Server Error'
+            self.write_log(environ, method, req_uri, start, status,
+                           counted[0], self.timer() - started)
+
+        try:
+            app_iter = self.application(environ, replacement_start_response)
+        except Exception:
+            done()
+            raise
+        return _LoggedIterable(app_iter, counted, done)
+
+    def format_time(self, start):
+        """Return ``start`` in the log's time format, reusing the string
+        formatted for the previous request within the same second.
+        """
+        second = int(start)
+        cached, formatted = self._cached_time
+        if second != cached:
+            tm = time.localtime(second)
+            formatted = (time.strftime(self.time_format, tm) +
+                         self.offsets[tm.tm_isdst > 0])
+            self._cached_time = (second, formatted)
+        return formatted
+
+    @property
+    def time_format(self):
+        if self.structured:
+            return '%Y-%m-%dT%H:%M:%S'
+        return '%d/%b/%Y:%H:%M:%S '
+
+    def write_log(self, environ, method, req_uri, start, status, bytes,
+                  duration=None):
+        if not self.logger.isEnabledFor(self.logging_level):
+            return
         remote_addr = '-'
         if environ.get('HTTP_X_FORWARDED_FOR'):
             remote_addr = environ['HTTP_X_FORWARDED_FOR']
         elif environ.get('REMOTE_ADDR'):
             remote_addr = environ['REMOTE_ADDR']
-        d = {
-            'REMOTE_ADDR': remote_addr,
-            'REMOTE_USER': environ.get('REMOTE_USER') or '-',
-            'REQUEST_METHOD': method,
-            'REQUEST_URI': req_uri,
-            'HTTP_VERSION': environ.get('SERVER_PROTOCOL'),
-            'time': time.strftime('%d/%b/%Y:%H:%M:%S ', start) + offset,
-            'status': status.split(None, 1)[0],
-            'bytes': bytes,
-            'HTTP_REFERER': environ.get('HTTP_REFERER', '-'),
-            'HTTP_USER_AGENT': environ.get('HTTP_USER_AGENT', '-'),
-            }
-        message = self.format % d
+        if self.structured:
+            d = {
+                'remote_addr': remote_addr,
+                'remote_user': environ.get('REMOTE_USER'),
+                'method': method,
+                'uri': req_uri,
+                'protocol': environ.get('SERVER_PROTOCOL'),
+                'time': self.format_time(start),
+                'status': int(status.split(None, 1)[0]),
+                'bytes': bytes,
+                'duration_ms': (None if duration is None
+                                else round(duration * 1000, 3)),
+                'referer': environ.get('HTTP_REFERER'),
+                'user_agent': environ.get('HTTP_USER_AGENT'),
+                }
+            message = dumps(d, sort_keys=True)
+        else:
+            d = {
+                'REMOTE_ADDR': remote_addr,
+                'REMOTE_USER': environ.get('REMOTE_USER') or '-',
+                'REQUEST_METHOD': method,
+                'REQUEST_URI': req_uri,
+                'HTTP_VERSION': environ.get('SERVER_PROTOCOL'),
+                'time': self.format_time(start),
+                'status': status.split(None, 1)[0],
+                'bytes': bytes or '-',
+                'HTTP_REFERER': environ.get('HTTP_REFERER', '-'),
+                'HTTP_USER_AGENT': environ.get('HTTP_USER_AGENT', '-'),
+                }
+            message = self.format % d
         self.logger.log(self.logging_level, message)
 
+
+def _level(value):
+    """Return the numeric logging level for ``value`` (e.g., 20 or 'INFO').
+    """
+    if isinstance(value, str):
+        if value.isdigit():
+            return int(value)
+        level = logging.getLevelName(value.upper())
+        if not isinstance(level, int):
+            raise ValueError('Unknown logging level: %r' % value)
+        return level
+    return value
+
+
 def make_filter(
     app, global_conf,
     logger_name='wsgi',
     format=None,
     logging_level=logging.INFO,
     setup_console_handler=True,
-    set_logger_level=logging.DEBUG):
-    if isinstance(logging_level, str):
-        logging_level = logging._levelNames[logging_level]
-    if isinstance(set_logger_level, str):
-        set_logger_level = logging._levelNames[set_logger_level]
+    set_logger_level=logging.DEBUG,
+    structured=False,
+    queue_size=10000):
     return TransLogger(
         app,
         format=format or None,
-        logging_level=logging_level,
+        logging_level=_level(logging_level),
         logger_name=logger_name,
         setup_console_handler=asbool(setup_console_handler),
-        set_logger_level=set_logger_level)
+        set_logger_level=_level(set_logger_level),
+        structured=asbool(structured),
+        queue_size=int(queue_size))
 
 make_filter.__doc__ = TransLogger.__doc__
@@ -1,16 +1,45 @@
+from collections import OrderedDict
 from email.message import Message
+from hashlib import md5
 from hashlib import sha256
+from hmac import compare_digest
 from json import loads
 import logging
+import os
+import threading
+import time
 
+from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.httpexceptions import HTTPForbidden
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.httpexceptions import HTTPServiceUnavailable
 from pyramid.renderers import get_renderer
+from pyramid.response import Response
+from pyramid.settings import asbool
 from pyramid.view import view_config
-from pyramid_mailer import get_mailer
-
+from webob.datetime_utils import parse_date
+from webob.datetime_utils import serialize_date
+from webob.etag import ETagMatcher
+
+from .dedupe import delivery_key
+from .dedupe import get_recent_deliveries
+from .digest import get_digest
+from .export import export_app_iter
+from .groupcommit import get_group_committer
+from .mailqueue import SENDER
+from .mailqueue import send_message
+from .metrics import STAGE_SECONDS
+from .metrics import WEBHOOKS_DUPLICATED
+from .metrics import WEBHOOKS_RECEIVED
+from .metrics import WEBHOOKS_REJECTED
+from .metrics import time_commit
+from .models import status_summary
+from .models import BuildRecord
 from .models import Owner
 from .models import Root
 from .models import Repo
+from .signature import key_cache_from_settings
+from .signature import verify_signature
 
 try:
     text_type = unicode
@@ -35,50 +64,168 @@ class TravisAuthorizationCheck(object):
     See:
       http://docs.travis-ci.com/user/notifications/#Authorization-for-Webhooks
 
+    The setting may hold several whitespace-separated tokens, any of which
+    is accepted (e.g., the new and old tokens during a rotation).
+
+    The expected digests for each authenticated slug are cached (up to
+    ``MAX_CACHED_SLUGS``, oldest first out), so that most
+    requests cost a dictionary lookup rather than a hash.  Only successful
+    checks populate the cache, so that forged slugs cannot evict genuine
+    ones.  Changing the setting empties the cache.  Digests are compared in
+    constant time.
+
+    Requests carrying credentials are counted (as are those rejected), and
+    the time spent checking them recorded, in ``.metrics``.
+
+    If ``travis_notify.signature`` is enabled, a 'Signature' header is
+    verified instead, against Travis's public key (see ``.signature``), and
+    the payload's repository must match the slug (the signature does not
+    cover the header);  until that key has been loaded, the token is
+    checked as above (warning once per outage).
+
     .. note::
        This is really a permission check, mashed up with a short-circuited
        authentication polciy.
     """
     DEFAULT_TOKEN_KEY = 'travis_notify.token'
+    MAX_CACHED_SLUGS = 1000
 
     def __init__(self, val, config):
         if val is None:
             val = self.DEFAULT_TOKEN_KEY
         self.key = val
-        self.token = config.settings[val]
+        self.settings = config.settings
+        self._setting = None
+        self._expected = OrderedDict()  # slug -> expected digests
+        self._lock = threading.Lock()
+        self._refresh()
+        self.key_cache = key_cache_from_settings(config.settings)
+        self._warned_no_key = False
+
+    def _refresh(self):
+        setting = self.settings[self.key]
+        if setting != self._setting:
+            with self._lock:
+                self._setting = setting
+                self.tokens = tuple(setting.split())
+                self._expected.clear()
+
+    @property
+    def token(self):
+        return self.tokens[0]
 
     def text(self):  # pragma: no cover
         return 'travis authoriztion token'
 
     phash = text
 
+    def digests(self, slug, tokens=None):
+        """Return the digests accepted for ``slug``, one per token.
+        """
+        if tokens is None:
+            tokens = self.tokens
+        result = []
+        for token in tokens:
+            mashed = slug + token
+            if isinstance(mashed, text_type):  # pragma: no cover
+                mashed = mashed.encode('utf-8')
+            result.append(sha256(mashed).hexdigest().encode('ascii'))
+        return result
+
+    def _remember(self, slug, expected, tokens):
+        with self._lock:
+            if tokens is not self.tokens:  # setting changed meanwhile
+                return
+            self._expected[slug] = expected
+            while len(self._expected) > self.MAX_CACHED_SLUGS:
+                self._expected.popitem(last=False)
+
     def __call__(self, context, request):
         auth = request.headers.get('Authorization')
         slug = request.headers.get('Travis-Repo-Slug')
+        signature = request.headers.get('Signature')
 
-        if auth is None and slug is None:  # not for us.
-            logger.debug('TAC: no auth or slug')
+        if auth is None and slug is None and signature is None:
+            logger.debug('TAC: no auth or slug')  # not for us.
             return False
 
-        if auth is None:   # bad protocol, no donut!
-            logger.debug('TAC: no auth but slug')
-            raise HTTPForbidden()
-
-        if auth is None or slug is None:   # bad protocol, no donut!
+        WEBHOOKS_RECEIVED.inc()
+        try:
+            with STAGE_SECONDS.time('auth'):
+                return self.check(request, auth, slug, signature)
+        except HTTPForbidden:
+            WEBHOOKS_REJECTED.inc()
+            raise
+
+    def check(self, request, auth, slug, signature):
+        """Check the credentials of a request carrying any (see above).
+        """
+        if slug is None:   # bad protocol, no donut!
             logger.debug('TAC: auth but no slug')
             raise HTTPForbidden()
 
-        mashed = slug + self.token
-        if isinstance(mashed, text_type):  # pragma: no cover
-            mashed = mashed.encode('utf-8')
+        if signature is not None and self.key_cache is not None:
+            verified = self.check_signature(request, signature, slug)
+            if verified is not None:
+                if not verified:  # wicked, evil, naughty!
+                    logger.debug('TAC: bad signature')
+                    raise HTTPForbidden()
+                logger.debug('TAC: signature match')
+                return True
+            # No key yet:  fall back to the token.
+
+        if auth is None:   # bad protocol, no donut!
+            logger.debug('TAC: no auth but slug')
+            raise HTTPForbidden()
 
-        if auth != sha256(mashed).hexdigest():  # wicked, evil, naughty!
+        self._refresh()
+        tokens = self.tokens
+        cached = expected = self._expected.get(slug)
+        if expected is None:
+            expected = self.digests(slug, tokens)
+        if isinstance(auth, text_type):
+            auth = auth.encode('utf-8')
+        # Compare against every token, in constant time.
+        matches = [compare_digest(auth, x) for x in expected]
+
+        if not any(matches):  # wicked, evil, naughty!
             logger.debug('TAC: auth / slug mismatch')
             raise HTTPForbidden()
 
+        if cached is None:
+            self._remember(slug, expected, tokens)
         logger.debug('TAC: auth / slug match')
         return True
 
+    def check_signature(self, request, signature, slug):
+        """Verify ``signature`` against the request's payload, which must
+        be for the repo named by ``slug``.
+
+        Return None if the public key is not (yet) available.
+        """
+        public_key = self.key_cache.get()
+        if public_key is None:
+            if not self._warned_no_key:
+                self._warned_no_key = True
+                logger.warning('TAC: no public key to verify signatures')
+            return None
+        self._warned_no_key = False
+        payload = request.POST.get('payload')
+        if payload is None:
+            return False
+        if not verify_signature(public_key, payload, signature):
+            return False
+        try:
+            repository = loads(payload)['repository']
+            signed_slug = '%s/%s' % (repository['owner_name'],
+                                     repository['name'])
+        except (ValueError, TypeError, KeyError):
+            return False
+        if signed_slug != slug:
+            logger.debug('TAC: payload for %s, slug %s', signed_slug, slug)
+            return False
+        return True
+
 
 ZF_TEMPLATE = """\
 Status: %(summary)s
@@ -112,36 +259,41 @@ def generate_notification_mail(context, request, payload):
             #informing-the-zope-developer-community-about-build-results
 
     ATM, just format for ZF.
+
+    If ``travis_notify.mail_queue_path`` is configured, the message is only
+    added to that queue (when the transaction commits);  delivery is left
+    to the ``travis_notify_mailq`` workers.
+
+    If ``travis_notify.digest_window`` is non-zero, the notification is
+    coalesced into a per-commit summary mail instead (see ``.digest``).
     """
     info = payload.copy()
     if payload['type'] != 'push':  # don't report PR results
         return
 
-    if payload['status'] == 0:
-        status = 'OK'
-    else:
-        msg = payload['status_message']
-        if msg.lower() in ('broken', 'failed', 'still failing'):
-            status = "FAILED"
-        else:
-            status = "UNKNOWN"
+    status = status_summary(payload)
     info['summary'] = status
 
-    to = request.registry.settings['travis_notify.recipients']
+    settings = request.registry.settings
+    if float(settings.get('travis_notify.digest_window', 0)):
+        get_digest(request.registry).add_on_commit(payload, status)
+        return
+
+    to = settings['travis_notify.recipients']
     subject = '%s: %s [Travis-CI]' % (status, payload['repository']['name'])
     message = Message()
-    message['From'] = 'travis_notify@palladion.com'
+    message['From'] = SENDER
     message['To'] = to
     message['Subject'] = subject
     message.set_payload(ZF_TEMPLATE % info)
-    mailer = get_mailer(request)
-    mailer.send(message)
+    send_message(request.registry, message, SENDER, to)
 
 
 @view_config(context=Root, renderer='json',
              request_method="POST",
-             header="Content-Type: application/x-www-form-urlencoded",
-             travis_auth_check=None,  # use default key
+             header="Content-Type:application/x-www-form-urlencoded",
+             # Pyramid ignores predicates whose value is None.
+             travis_auth_check=TravisAuthorizationCheck.DEFAULT_TOKEN_KEY,
             )
 def webhook(context, request,
             generator=generate_notification_mail,  # testing hook
@@ -151,16 +303,66 @@ def webhook(context, request,
     - Crack the `payload` from the form data and decode as JSON.
 
     - Use the slug to find / create the appendonly log based on the repo;
-      store the deocded JSON in the log.
+      store a compact ``BuildRecord`` of the decoded JSON in the log
+      (keeping the full payload, compressed, if
+      ``travis_notify.keep_raw_payload`` is set).
 
     - Delegate mail delivery to ``generator``.
+
+    Redelivered notifications (same build, jobs and status) are ignored,
+    without writing to the database or generating mail:  see ``.dedupe``.
+
+    If ``travis_notify.group_commit`` is enabled, the notification is
+    stored (and mail generated) in a transaction shared with concurrent
+    requests instead, which has committed when the view returns (else,
+    after ``travis_notify.group_commit_timeout``, it answers 503):  see
+    ``.groupcommit``.
     """
-    owner_name, repo_name = request.headers['Travis-Repo-Slug'].split('/')
-    owner = context.find_create(owner_name)
-    repo = owner.find_create(repo_name)
+    slug = request.headers['Travis-Repo-Slug']
     payload = loads(request.POST['payload'])
-    repo.pushItem(payload)
-    generator(context, request, payload)
+    committer = get_group_committer(request.registry)
+    if committer is not None:
+        record = {'slug': slug, 'payload': request.POST['payload']}
+        if not committer.store(record):
+            raise HTTPServiceUnavailable('Timed out storing notification')
+        return
+    process_notification(context, request, slug, payload, generator)
+
+
+def process_notification(root, request, slug, payload,
+                         generator=generate_notification_mail):
+    """Store ``payload``, for the repo named by ``slug``, under ``root``,
+    and delegate mail delivery to ``generator``.
+
+    Shared by :func:`webhook` and the asynchronous front end (see
+    ``.ingest``).  Return False if ``payload`` is a redelivery.
+    """
+    owner_name, repo_name = slug.split('/')
+    key = delivery_key(payload)
+    recent = get_recent_deliveries(request.registry)
+    if (slug, key) in recent:
+        logger.info('Ignoring redelivery of %s for %s', key, slug)
+        WEBHOOKS_DUPLICATED.inc()
+        return False
+    owner = root.get(owner_name)
+    repo = None
+    if owner is not None:
+        repo = owner.get(repo_name)
+    if repo is not None and repo.seen(key):
+        logger.info('Ignoring redelivery of %s for %s', key, slug)
+        recent.add((slug, key))
+        WEBHOOKS_DUPLICATED.inc()
+        return False
+    owner = root.find_create(owner_name)
+    repo = owner.find_create(repo_name)
+    keep_raw = asbool(request.registry.settings.get(
+        'travis_notify.keep_raw_payload', False))
+    with STAGE_SECONDS.time('push_item'):
+        repo.pushItem(BuildRecord.fromPayload(payload, keep_raw), key)
+    time_commit()
+    recent.add_on_commit((slug, key))
+    generator(root, request, payload)
+    return True
 
 
 def get_main_template(request):
@@ -168,25 +370,269 @@ def get_main_template(request):
     return main_template.implementation()
 
 
+# Bump when a view's output changes without its template changing.
+REPRESENTATION_VERSION = 1
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+_templates_digest = None
+
+
+def representation_token(view_name, format):
+    """Return a short token identifying the representation rendered by view
+    ``view_name`` in ``format`` ('html', 'json', ...), changing with
+    ``REPRESENTATION_VERSION`` and the templates' contents.
+    """
+    global _templates_digest
+    if _templates_digest is None:
+        digest = md5()
+        for name in sorted(os.listdir(TEMPLATES_DIR)):
+            with open(os.path.join(TEMPLATES_DIR, name), 'rb') as f:
+                digest.update(f.read())
+        _templates_digest = digest.hexdigest()
+    key = '%d:%s:%s:%s' % (REPRESENTATION_VERSION, _templates_digest,
+                           view_name, format)
+    return md5(key.encode('utf-8')).hexdigest()[:12]
+
+
+def check_not_modified(context, request, format='html'):
+    """Set ETag / Last-Modified from ``context``'s modification serial.
+
+    The ETag also carries a :func:`representation_token`, so that clients
+    revalidating a page after a template or representation change (or
+    holding another format of it) get it afresh rather than a 304.
+
+    Return an ``HTTPNotModified`` response if the client's copy (per
+    If-None-Match, else If-Modified-Since) is current;  otherwise None.
+    """
+    serial = getattr(context, 'serial', None)
+    if serial is None:
+        return None
+    etag = '%d-%s' % (serial, representation_token(request.view_name,
+                                                   format))
+    modified = getattr(context, 'modified', None)
+    headers = {'ETag': '"%s"' % etag}
+    if modified is not None:
+        headers['Last-Modified'] = serialize_date(int(modified))
+    request.response.headers.update(headers)
+
+    if_none_match = request.headers.get('If-None-Match')
+    if_modified_since = parse_date(request.headers.get('If-Modified-Since'))
+    if if_none_match is not None:
+        fresh = etag in ETagMatcher.parse(if_none_match, strong=True)
+    elif modified is not None and if_modified_since is not None:
+        fresh = int(modified) <= int(if_modified_since.timestamp())
+    else:
+        fresh = False
+    if fresh:
+        return HTTPNotModified(headers=headers)
+
+
+STATUS_CLASSES = {'OK': 'success', 'FAILED': 'danger'}
+
+
+def status_rows(context, names=None):
+    """Return a row for the dashboard of ``context`` (a ``Root`` or
+    ``Owner``) per name on its status board, or per name in ``names``.
+
+    Reads only the board, never the repos themselves.
+    """
+    latest = getattr(context, 'latest', None)
+    latest = latest is not None and dict(latest()) or {}
+    if names is None:
+        names = sorted(latest)
+    rows = []
+    for name in names:
+        build = latest.get(name)
+        row = {'name': name, 'status': None, 'branch': None,
+               'commit': None, 'number': None, 'when': None,
+               'css': ''}
+        if build is not None:
+            row.update(build._asdict())
+            row['when'] = time.strftime('%Y-%m-%d %H:%M UTC',
+                                        time.gmtime(build.stamp))
+            row['css'] = STATUS_CLASSES.get(build.status, 'warning')
+        rows.append(row)
+    return rows
+
+
 @view_config(context=Root, renderer='templates/homepage.pt',
              request_method="GET",
             )
 def home_page(context, request):
-    return {'owners': sorted(context.keys())}
+    """List the owners, and the latest build of every repo.
+    """
+    not_modified = check_not_modified(context, request)
+    if not_modified is not None:
+        return not_modified
+    rows = status_rows(context)
+    return {'owners': sorted(context.keys()),
+            'statuses': rows,
+            'failing': len([x for x in rows if x['status'] == 'FAILED']),
+           }
 
 
 @view_config(context=Owner, renderer='templates/owner.pt',
              request_method="GET",
             )
 def owner(context, request):
-    return {'name': context.__name__, 'repos': sorted(context.keys())}
+    """List the owner's repos, with the latest build of each.
+    """
+    not_modified = check_not_modified(context, request)
+    if not_modified is not None:
+        return not_modified
+    repos = sorted(context.keys())
+    return {'name': context.__name__,
+            'repos': repos,
+            'statuses': status_rows(context, repos),
+           }
+
+
+def _page_size(request):
+    return int(request.registry.settings.get('travis_notify.repo_page_size',
+                                             20))
+
+
+def _format_cursor(cursor):
+    if cursor is None:
+        return None
+    return '%d-%d' % cursor
 
 
 @view_config(context=Repo, renderer='templates/repo.pt',
              request_method="GET",
             )
 def repo(context, request):
-    return {'name': context.__name__, 'recent': list(context.recent)}
+    """Render the newest ``travis_notify.repo_page_size`` items;  the page
+    fetches older ones from :func:`recent_page` on demand.
+    """
+    not_modified = check_not_modified(context, request)
+    if not_modified is not None:
+        return not_modified
+    items, next_cursor = context.page(limit=_page_size(request))
+    return {'name': context.__name__,
+            'recent': items,
+            'more': _format_cursor(next_cursor),
+            'more_url': request.resource_url(context, 'recent'),
+           }
+
+
+MAX_HISTORY_LIMIT = 100
+
+
+def _int_param(request, name, default=None, minimum=0, maximum=2 ** 63 - 1):
+    # The default ``maximum`` is the largest key of the index's BTrees.
+    value = request.GET.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise HTTPBadRequest('Invalid %s: %r' % (name, value))
+    if not minimum <= value <= maximum:
+        raise HTTPBadRequest('Invalid %s: %r' % (name, value))
+    return value
+
+
+@view_config(context=Repo, name='history', renderer='json',
+             request_method="GET",
+            )
+def history(context, request):
+    """Return a page of the repo's build history as JSON, newest first.
+
+    Query parameters:
+
+    - ``limit`` (default 20, at most 100) and ``offset``;
+
+    - ``cursor``, the ``next`` value returned with the previous page;
+
+    - ``branch`` and ``status`` ('OK', 'FAILED' or 'UNKNOWN') filters;
+
+    - ``number``, to fetch a single build by its number.
+    """
+    not_modified = check_not_modified(context, request, 'json')
+    if not_modified is not None:
+        return not_modified
+    number = request.GET.get('number')
+    if number is not None:
+        found = context.index.by_number(number)
+        return {'items': found is not None and [found] or [], 'next': None}
+    limit = min(_int_param(request, 'limit', 20, 1), MAX_HISTORY_LIMIT)
+    items, next_cursor = context.history(
+        branch=request.GET.get('branch'),
+        status=request.GET.get('status'),
+        cursor=_int_param(request, 'cursor', minimum=-2 ** 63),
+        offset=_int_param(request, 'offset', 0),
+        limit=limit,
+    )
+    if next_cursor is not None:
+        next_cursor = str(next_cursor)
+    return {'items': items, 'next': next_cursor}
+
+
+def _cursor_param(request):
+    value = request.GET.get('cursor')
+    if value is None:
+        return None
+    try:
+        generation, index = [int(x) for x in value.split('-')]
+    except ValueError:
+        raise HTTPBadRequest('Invalid cursor: %r' % value)
+    if not 0 <= generation < 2 ** 63:  # the archive's LOBTree keys
+        raise HTTPBadRequest('Invalid cursor: %r' % value)
+    return generation, index
+
+
+def _summary(item):
+    return {'number': item.get('number'),
+            'branch': item.get('branch'),
+            'commit': item.get('commit'),
+            'status_message': item.get('status_message'),
+           }
+
+
+@view_config(context=Repo, name='recent', renderer='json',
+             request_method="GET",
+            )
+def recent_page(context, request):
+    """Return a page of the repo's items, newest first, as JSON:  the
+    recent history, then the archive (unlike :func:`history`, which reads
+    the index).
+
+    Query parameters:
+
+    - ``limit`` (default ``travis_notify.repo_page_size``, at most 100);
+
+    - ``cursor``, the ``next`` value returned with the previous page (or
+      rendered by :func:`repo`).
+    """
+    not_modified = check_not_modified(context, request, 'json')
+    if not_modified is not None:
+        return not_modified
+    limit = min(_int_param(request, 'limit', _page_size(request), 1),
+                MAX_HISTORY_LIMIT)
+    items, next_cursor = context.page(_cursor_param(request), limit)
+    return {'items': [_summary(x) for x in items],
+            'next': _format_cursor(next_cursor),
+           }
+
+
+@view_config(context=Repo, name='export', request_method="GET")
+def export(context, request):
+    """Stream the repo's full history as newline-delimited JSON.
+    """
+    not_modified = check_not_modified(context, request, 'ndjson')
+    if not_modified is not None:
+        return not_modified
+    response = Response(content_type='application/x-ndjson',
+                        charset='utf-8')
+    for name in ('ETag', 'Last-Modified'):
+        if name in request.response.headers:
+            response.headers[name] = request.response.headers[name]
+    response.content_disposition = 'attachment; filename="%s-%s.ndjson"' % (
+        context.__parent__.__name__, context.__name__)
+    response.app_iter = export_app_iter(context)
+    return response
 
 
 def includeme(config):